@@ -8,11 +8,6 @@ import sqlite3
 import uuid
 
 import mimetypes
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
 
 from datetime import datetime, timezone
 #from pytz import timezone
@@ -62,8 +57,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '2'
 
 def filelist(dir):
   allfiles = []
@@ -86,6 +81,12 @@ def _get_option_parser():
     parser.add_option("", "--input",
                       action="store", dest="input_path", default=[],
                       help="Path to input SQLite directory")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="default",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: default)")
     return parser
 
 def main(args):
@@ -117,22 +118,26 @@ def main(args):
     # Check if input resources directory exists
     common.error("input resources path '%s' does not exist." % (inputResourcesPath,))
 
-  notesdbfile = os.path.join(inputPath, 'notesdb.sqlite')
 
-  new_database = (not os.path.isfile(notesdbfile))
-
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
   sqlconn.row_factory = sqlite3.Row
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    common.error("database not found")
+  files = filelist(inputResourcesPath)
 
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
+  if not notesdb.note_resources_indexed(sqlcur):
+    print("indexing note resources...")
+    notesdb.index_note_resources(sqlconn, inputResourcesPath)
 
-  files = filelist(inputResourcesPath)
+  # Resources referenced by notes
+  sqlcur.execute('''SELECT DISTINCT resource_id, path FROM note_resources''')
+  referenced = set()
+  for row in sqlcur:
+    if row['resource_id'] is not None:
+      referenced.add(row['resource_id'].lower())
+    if row['path'] is not None:
+      referenced.add(os.path.splitext(os.path.basename(row['path']))[0].lower())
 
   # Remove unused resource files
   
@@ -142,14 +147,10 @@ def main(args):
 
     resource_id, file_extension = os.path.splitext(filename)
 
-    query =  "SELECT note_id FROM notes WHERE apple_attachment_path LIKE '%" + resource_id
-    query += "%' OR note_data LIKE '%(:/" + resource_id + ")%';"
-
-    sqlcur.execute(query)
-  
-    result = sqlcur.fetchone()
+    if resource_id.lower() in referenced:
+      continue
 
-    if result is None:
+    if not notesdb.note_references(sqlcur, resource_id):
       # delete file
       print("deleting '%s'..." % (filepath,))
       if os.path.isfile(filepath):
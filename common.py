@@ -7,33 +7,27 @@ import optparse
 import sqlite3
 import uuid
 import json
+import codecs
 
 import mimetypes
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
 
 import urllib
 from urllib.parse import urlparse
 from urllib.parse import unquote
 from urllib.parse import quote
 
-import mistune
-
+import bisect
+import collections
 from collections import namedtuple
 
 from datetime import datetime, timezone
 #from pytz import timezone
 
-from html2txt import converters
-
 import html
+from html.parser import HTMLParser
 
 import hashlib
-
-import requests
+import shutil
 
 import time
 
@@ -74,6 +68,7 @@ def unshorten_url(url, url_dict, error_dict, http_timeout=5):
 
   if url in url_dict:
     return (url_dict[url], url_dict, error_dict)
+  import requests
   while tries < maxRetries:
     try:
       isError = False
@@ -152,59 +147,36 @@ def cleanup_http_tco_url(s):
 def cleanup_tco_url(s):
   return cleanup_http_tco_url(cleanup_https_tco_url(s))
 
+# t.co links: https links are 23 characters long, http links end at the
+# first character that is not a letter or digit
+HTTPS_TCO_LINK_RE = re.compile(r'https://t\.co/.{0,10}', re.DOTALL)
+HTTP_TCO_LINK_RE = re.compile(r'http://t\.co/[^\W_]*')
+TCO_LINK_RE = re.compile(r'https://t\.co/.{0,10}|http://t\.co/(?:(?!https://t\.co/)[^\W_])*', re.DOTALL)
+
+def _space_link(match):
+  return " " + match.group(0) + " "
+
 def space_http_tco_links(s):
-  pos = s.find("http://t.co/")
-  while pos >= 0:
-    path_len = length_http_tco_link(s[pos:])
-    s = s[:pos] + " " + s[pos:pos+path_len] + " " + s[pos+path_len:]
-    pos += (12 + path_len + 2) # length of http://t.co prefix plus path plus 2 spaces
-    pos = s.find("http://t.co/", pos)
-  return s
+  return HTTP_TCO_LINK_RE.sub(_space_link, s)
 
 def space_https_tco_links(s):
-  pos = s.find("https://t.co/")
-  while pos >= 0:
-    s = s[:pos] + " " + s[pos:pos+23] + " " + s[pos+23:]
-    pos += 25 # length of t.co link plus 2 spaces
-    pos = s.find("https://t.co/", pos)
-  return s
+  return HTTPS_TCO_LINK_RE.sub(_space_link, s)
+
+def space_tco_links(s):
+  # Same as space_http_tco_links(space_https_tco_links(s)) in one pass
+  return TCO_LINK_RE.sub(_space_link, s)
 
 def expand_urls(txt, url_dict, error_dict):
-  lines = space_http_tco_links(space_https_tco_links(txt)).splitlines()
-  expanded_lines = ""
-  for line in lines:
-    words = line.split()
-    expanded_line = ""
+  lines = [line.split() for line in space_tco_links(txt).splitlines()]
+  # Expand each URL once, whether it is in the cache (url_dict) or not
+  expanded_urls = {}
+  for words in lines:
     for word in words:
-      if word.startswith("https://") or word.startswith("http://"):
-        word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # if word.startswith("https://t.co/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("http://t.co/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)        
-      # elif word.startswith("https://bit.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("http://bit.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("https://ow.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("http://ow.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("https://buff.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("http://buff.ly/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("https://tinyurl.com/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      # elif word.startswith("http://tinyurl.com/"):
-      #   word, url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
-      if expanded_line != "":
-        expanded_line += " "
-      expanded_line += word
-    if expanded_lines != "":
-      expanded_lines += "\n"
-    expanded_lines += expanded_line
-  return (expanded_lines, url_dict, error_dict)
+      if (word.startswith("https://") or word.startswith("http://")) and word not in expanded_urls:
+        expanded_urls[word], url_dict, error_dict = unshorten_url(word, url_dict, error_dict)
+  expanded_lines = [" ".join([expanded_urls.get(word, word) for word in words]) for words in lines]
+  # Lines before the first line with text are left out
+  return ("\n".join(expanded_lines).lstrip("\n"), url_dict, error_dict)
 
 def save_dict(file, mydict):
   with open(file, 'w') as fp:
@@ -307,6 +279,26 @@ def format_uuid_string(uuid_str):
 def create_uuid_string():
   return format_uuid_string(str(uuid.uuid4()))
 
+# Note fingerprints are a byte naming the algorithm followed by its digest
+# so notes hashed with different algorithms are never taken for each other
+FINGERPRINT_BLAKE2B_128 = b'\x01'
+
+def note_fingerprint(note_data):
+  # Fingerprint (stored in note_hash) used to find notes with the same text
+  if note_data is None:
+    note_data = ''
+  h = hashlib.blake2b(note_data.encode('utf-8'), digest_size=16)
+  return FINGERPRINT_BLAKE2B_128 + h.digest()
+
+def create_file_uuid_string(filepath):
+  # Identifier derived from the file contents so the same file always gets
+  # the same resource name
+  h = hashlib.sha256()
+  with open(filepath, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+      h.update(chunk)
+  return h.hexdigest()[:32]
+
 def create_universally_unique_identifier():
   return str(uuid.uuid4())
 
@@ -331,6 +323,7 @@ def defaultTitleFromBody(body):
   return 'Untitled'
   
 def text_to_html(data):
+  import mistune
   markdown = mistune.Markdown() 
   html_text = markdown.render(escape_html(data))
   return html_text
@@ -338,23 +331,492 @@ def text_to_html(data):
 def text_to_markdown(data):
   return html_to_markdown(text_to_html(data))
 
-class NoAutolinkRenderer(mistune.Renderer):
-  def __init__(self, escape=True, allow_harmful_protocols=None):
-    super(NoAutolinkRenderer, self).__init__(escape=escape, allow_harmful_protocols=allow_harmful_protocols)
+_noautolink_renderer_class = None
+
+def _get_noautolink_renderer_class():
+  # Defined on first use so that mistune is only imported by tools that
+  # convert markdown
+  global _noautolink_renderer_class
+  if _noautolink_renderer_class is None:
+    import mistune
+
+    class NoAutolinkRenderer(mistune.Renderer):
+      def __init__(self, escape=True, allow_harmful_protocols=None):
+        super(NoAutolinkRenderer, self).__init__(escape=escape, allow_harmful_protocols=allow_harmful_protocols)
 
-  def autolink(self, link, is_email=False):
-    return link
+      def autolink(self, link, is_email=False):
+        return link
+
+    _noautolink_renderer_class = NoAutolinkRenderer
+  return _noautolink_renderer_class
 
 def markdown_to_html(data):
+  import mistune
   # NOTE: Autolinking is only done when converting from text to markdown
-  noautolink_renderer = NoAutolinkRenderer()
+  noautolink_renderer = _get_noautolink_renderer_class()()
   markdown = mistune.Markdown(renderer=noautolink_renderer) 
   return markdown.render(data)
 
+# HTML to markdown for the tags used by Apple Notes (and by mistune for text
+# notes) without building an html2txt tree. The output is the same as
+# html2txt's, including its quirks:
+#
+# - an end tag closes the innermost open element whatever its name
+#   (so an unclosed <br> holds the text that follows it)
+# - text is unescaped and escaped again (escape_html)
+# - text before the first element and after a list item is dropped
+#
+# Anything else raises UnsupportedHtml and is converted by html2txt, unless
+# the parser is lenient (see iter_markdown).
+
+MARKDOWN_TAGS = {
+  "html": ("", ""),
+  "body": ("", ""),
+  "span": ("", ""),
+  "b": ("**", "**"),
+  "strong": ("**", "**"),
+  "i": ("*", "*"),
+  "em": ("*", "*"),
+  "h1": ("# ", ""),
+  "h2": ("## ", ""),
+  "h3": ("### ", ""),
+  "div": None,
+  "p": None,
+  "br": None,
+  "ul": None,
+  "ol": None,
+  "li": None,
+  "a": None,
+  "img": None
+}
+
+# Other tags in a lenient parser: the contents of skipped tags are left out,
+# block tags are written like a div, void tags have no end tag and the rest
+# are written like a span. Past LENIENT_MAX_DEPTH open elements, br and img
+# have no end tag either.
+LENIENT_TAGS = {"h4": ("#### ", ""), "h5": ("##### ", ""), "h6": ("###### ", ""), "td": ("", " "), "th": ("", " ")}
+LENIENT_SKIPPED_TAGS = set(["head", "script", "style", "template", "svg", "math", "object", "iframe", "canvas", "audio", "video"])
+LENIENT_BLOCK_TAGS = set(["address", "article", "aside", "blockquote", "caption", "center", "dd", "dl", "dt", "fieldset", "figcaption",
+  "figure", "footer", "form", "header", "main", "nav", "pre", "section", "table", "tbody", "tfoot", "thead", "tr"])
+LENIENT_VOID_TAGS = {"area": "", "base": "", "col": "", "embed": "", "hr": "\n---\n", "input": "", "link": "", "meta": "",
+  "param": "", "source": "", "track": "", "wbr": ""}
+LENIENT_MAX_DEPTH = 10000
+
+# Start tags that html2txt's XML parser reads the same way as html.parser
+# (lowercase names, quoted attribute values without whitespace to normalize)
+MARKDOWN_STARTTAG_RE = re.compile(r'<[a-z][a-z0-9]*(?:\s+[a-z_][-a-z0-9_.]*\s*=\s*(?:"[^"\t\n\r]*"|\'[^\'\t\n\r]*\'))*\s*/?>')
+
+class UnsupportedHtml(Exception):
+  pass
+
+class _MarkdownElement(object):
+  __slots__ = ('tag', 'close', 'block', 'skip', 'has_children', 'last_child', 'text', 'text_written', 'link_slot', 'br_slot')
+
+  def __init__(self, tag, close=''):
+    self.tag = tag
+    self.close = close
+    # The text of a block (div or p) is stripped
+    self.block = False
+    # Nothing inside the element is written
+    self.skip = False
+    self.has_children = False
+    self.last_child = None
+    # Whitespace at the end of the text of a block, which is held back until
+    # more text follows it
+    self.text = None
+    self.text_written = False
+    # Index in the output of the open tag of a link, which changes if the
+    # link has text, and of a br, which changes if the text after it starts
+    # with a newline
+    self.link_slot = None
+    self.br_slot = None
+
+def _markdown_link(attrs):
+  # Same as html2txt MarkdownVisitor.format_link for a link without text
+  # (the open tag of a link with text is "[")
+  href = attrs.get('href')
+  if href is None or href == '':
+    raise UnsupportedHtml("link without href")
+  url = urllib.parse.urlsplit(href)
+  if url.scheme == '':
+    href = 'https://' + url.path
+  if href.startswith('joplin:'):
+    parts = href.split('/')
+    return ('[', "%s](:/%s)" % (parts[-1], parts[-2]))
+  open_tag = '[' + escape_html(href)
+  href = escape_url(href)
+  title = attrs.get('title')
+  if title is None:
+    return (open_tag, "](%s)" % (href,))
+  return (open_tag, "](%s \"%s\")" % (href, escape_html(title)))
+
+def _markdown_image(attrs):
+  # Same as html2txt MarkdownVisitor.format_img_link
+  src = attrs.get('src')
+  if src is None:
+    raise UnsupportedHtml("image without src")
+  alt = attrs.get('alt')
+  if alt is None:
+    alt = ''
+  if src.startswith('joplin:'):
+    parts = src.split('/')
+    return ('![', "%s](:/%s)" % (parts[-1], parts[-2]))
+  title = attrs.get('title')
+  if title is None:
+    return ('![', "%s](%s)" % (escape_html(alt), escape_url(src)))
+  return ('![', "%s](%s \"%s\")" % (escape_html(alt), escape_url(src), escape_html(title)))
+
+class MarkdownParser(HTMLParser):
+  def __init__(self, lenient=False):
+    super(MarkdownParser, self).__init__()
+    self.lenient_ = lenient
+    self.output_ = []
+    # Number of output pieces returned by pop_output
+    self.popped_ = 0
+    # Output pieces that may still change (the open tags of links and brs)
+    self.slots_ = set()
+    self.list_stack_ = []
+    self.open_elements_ = [_MarkdownElement(None)]
+    # Text that html.parser passed in pieces (e.g. when it is fed a chunk
+    # at a time), which is written as one piece like html2txt does
+    self.data_ = []
+    self.data_size_ = 0
+
+  def set_slot(self, slot, value):
+    self.output_[slot - self.popped_] = value
+    self.slots_.discard(slot)
+
+  def end_text(self, element):
+    # The text of the element (before its first child) is complete
+    if element.block:
+      if element.text is None or not element.text.endswith('\n'):
+        element.close = '\n'
+      else:
+        element.close = ''
+      element.text = None
+    elif element.link_slot is not None:
+      self.slots_.discard(element.link_slot)
+      element.link_slot = None
+
+  def end_tail(self, element):
+    # The text after the last child of the element is complete
+    child = element.last_child
+    if child is not None and child.br_slot is not None:
+      self.slots_.discard(child.br_slot)
+      child.br_slot = None
+
+  def start_element(self, tag, attrs):
+    # Returns the element for a start tag in the subset
+    if not self.lenient_:
+      if MARKDOWN_STARTTAG_RE.fullmatch(self.get_starttag_text()) is None:
+        raise UnsupportedHtml("start tag '%s' is read differently by html2txt" % (tag,))
+      if len(set(name for name, value in attrs)) != len(attrs):
+        raise UnsupportedHtml("duplicate attributes")
+    attrs = dict(attrs)
+    tags = MARKDOWN_TAGS[tag]
+    if tags is not None:
+      open_tag, close_tag = tags
+    elif tag == 'div' or tag == 'p':
+      open_tag, close_tag = ('', '\n')
+    elif tag == 'br':
+      open_tag, close_tag = ('\n  \n', '')
+    elif tag == 'ul' or tag == 'ol':
+      self.list_stack_.append('* ' if tag == 'ul' else '1. ')
+      open_tag, close_tag = ('', '')
+    elif tag == 'li':
+      indent = '    ' * (len(self.list_stack_) - 1) if len(self.list_stack_) > 1 else ''
+      prefix = self.list_stack_[-1] if len(self.list_stack_) > 0 else '- '
+      open_tag, close_tag = (indent + prefix, '\n')
+    elif tag == 'a':
+      open_tag, close_tag = _markdown_link(attrs)
+    else:
+      open_tag, close_tag = _markdown_image(attrs)
+    element = _MarkdownElement(tag, close_tag)
+    element.block = (tag == 'div' or tag == 'p')
+    if tag == 'a':
+      element.link_slot = self.popped_ + len(self.output_)
+      self.slots_.add(element.link_slot)
+    elif tag == 'br':
+      element.br_slot = self.popped_ + len(self.output_)
+      self.slots_.add(element.br_slot)
+    self.output_.append(open_tag)
+    return element
+
+  def start_lenient_element(self, tag, attrs):
+    # Returns the element for a start tag in a lenient parser
+    if tag in MARKDOWN_TAGS:
+      try:
+        return self.start_element(tag, attrs)
+      except UnsupportedHtml:
+        # A link without href or an image without src
+        pass
+    element = _MarkdownElement(tag)
+    if tag in LENIENT_SKIPPED_TAGS:
+      element.skip = True
+    elif tag in LENIENT_BLOCK_TAGS:
+      element.block = True
+      element.close = '\n'
+    elif tag in LENIENT_TAGS:
+      open_tag, element.close = LENIENT_TAGS[tag]
+      self.output_.append(open_tag)
+    return element
+
+  def handle_starttag(self, tag, attrs):
+    self.flush_data()
+    parent = self.open_elements_[-1]
+    if parent.skip:
+      element = _MarkdownElement(tag)
+      element.skip = True
+      if not (self.lenient_ and tag in LENIENT_VOID_TAGS):
+        self.open_elements_.append(element)
+      return
+    if parent.has_children:
+      self.end_tail(parent)
+    else:
+      parent.has_children = True
+      self.end_text(parent)
+    if self.lenient_ and tag in LENIENT_VOID_TAGS:
+      self.output_.append(LENIENT_VOID_TAGS[tag])
+      parent.last_child = _MarkdownElement(tag)
+      return
+    if self.lenient_:
+      element = self.start_lenient_element(tag, attrs)
+    elif tag in MARKDOWN_TAGS:
+      element = self.start_element(tag, attrs)
+    else:
+      raise UnsupportedHtml("unsupported tag '%s'" % (tag,))
+    parent.last_child = element
+    if self.lenient_ and (tag == 'br' or tag == 'img') and len(self.open_elements_) > LENIENT_MAX_DEPTH:
+      self.close_element(element)
+      return
+    self.open_elements_.append(element)
+
+  def handle_endtag(self, tag):
+    self.flush_data()
+    if len(self.open_elements_) == 1:
+      if self.lenient_:
+        return
+      raise UnsupportedHtml("end tag '%s' without a start tag" % (tag,))
+    if self.lenient_ and (tag in LENIENT_VOID_TAGS or
+        ((tag == 'br' or tag == 'img') and len(self.open_elements_) > LENIENT_MAX_DEPTH)):
+      return
+    self.close_element(self.open_elements_.pop())
+
+  def close_element(self, element):
+    if element.skip:
+      return
+    if element.has_children:
+      self.end_tail(element)
+    else:
+      self.end_text(element)
+    self.output_.append(element.close)
+    if element.tag == 'ul' or element.tag == 'ol':
+      if len(self.list_stack_) > 0:
+        self.list_stack_.pop()
+
+  def handle_data(self, data):
+    self.data_.append(data)
+    self.data_size_ += len(data)
+    if self.data_size_ > STREAMING_CHUNK_SIZE:
+      data = ''.join(self.data_)
+      # Keep back what may be the start of a character reference
+      split = data.rfind('&', max(0, len(data) - 64))
+      if split < 0:
+        split = len(data)
+      self.data_ = [data[split:]]
+      self.data_size_ = len(data) - split
+      self.write_data(data[:split])
+
+  def flush_data(self):
+    if self.data_size_ > 0:
+      data = ''.join(self.data_)
+      self.data_ = []
+      self.data_size_ = 0
+      self.write_data(data)
+
+  def write_data(self, data):
+    element = self.open_elements_[-1]
+    if element.skip:
+      return
+    if element.has_children:
+      # Tail of the last child
+      child = element.last_child
+      if child.tag == 'li':
+        return
+      if child.br_slot is not None:
+        if data.startswith('\n'):
+          self.set_slot(child.br_slot, '\n  ')
+        self.slots_.discard(child.br_slot)
+        child.br_slot = None
+      self.output_.append(escape_html(data))
+    elif element.tag is None or element.tag == 'ul' or element.tag == 'ol':
+      return
+    elif element.block:
+      # The text of a block is written stripped
+      text = escape_html(data)
+      if element.text is not None:
+        text = element.text + text
+      stripped = text.rstrip()
+      element.text = text[len(stripped):]
+      if not element.text_written:
+        stripped = stripped.lstrip()
+      if len(stripped) > 0:
+        self.output_.append(stripped)
+        element.text_written = True
+    else:
+      if element.link_slot is not None:
+        self.set_slot(element.link_slot, '[')
+        element.link_slot = None
+      self.output_.append(escape_html(data))
+
+  def handle_comment(self, data):
+    self.flush_data()
+    if not self.lenient_:
+      raise UnsupportedHtml("comment")
+
+  def handle_decl(self, data):
+    self.flush_data()
+    if not self.lenient_:
+      raise UnsupportedHtml("declaration")
+
+  def handle_pi(self, data):
+    self.flush_data()
+    if not self.lenient_:
+      raise UnsupportedHtml("processing instruction")
+
+  def unknown_decl(self, data):
+    self.flush_data()
+    if not self.lenient_:
+      raise UnsupportedHtml("declaration")
+
+  def pop_output(self):
+    # Returns the markdown written so far that can't change any more
+    if len(self.slots_) > 0:
+      end = min(self.slots_) - self.popped_
+    else:
+      end = len(self.output_)
+    text = ''.join(self.output_[:end])
+    del self.output_[:end]
+    self.popped_ += end
+    return text
+
+  def finish(self):
+    # NOTE: html2txt doesn't call close() so text that html.parser holds
+    #       back at the end of the data is dropped there too (all the text
+    #       after the last tag, even if it was passed a chunk at a time)
+    if self.rawdata.startswith('<') or len(self.rawdata) == 0:
+      self.flush_data()
+    while len(self.open_elements_) > 1:
+      self.close_element(self.open_elements_.pop())
+    self.slots_.clear()
+    return self.pop_output()
+
+  def convert(self, data):
+    self.feed(data)
+    return self.finish()
+
 def html_to_markdown(data):
+  try:
+    return MarkdownParser().convert(data)
+  except UnsupportedHtml:
+    pass
+  from html2txt import converters
   markdown = converters.Html2Markdown().convert(data)
   return markdown
 
+# convertnotes and sql2joplin convert notes larger than STREAMING_MIN_SIZE
+# characters a chunk at a time (iter_markdown), so that a huge note is never
+# held as an html2txt or mistune tree. HTML is converted by a lenient
+# MarkdownParser; text is rendered to HTML by mistune one group of paragraphs
+# at a time first. The markdown can differ from convert_to_markdown's, which
+# never streams.
+STREAMING_MIN_SIZE = 8 * 1024 * 1024
+STREAMING_CHUNK_SIZE = 1024 * 1024
+
+def iter_markdown_blocks(chunks, block_size=STREAMING_CHUNK_SIZE):
+  # Regroups text into pieces of about block_size characters that end with
+  # a blank line outside of a fenced code block, so that each piece renders
+  # to the same HTML as it does as part of the whole text
+  block = []
+  size = 0
+  fence = None
+  rest = ''
+  for chunk in chunks:
+    lines = (rest + chunk).split('\n')
+    rest = lines.pop()
+    for line in lines:
+      block.append(line + '\n')
+      size += len(line) + 1
+      marker = line.lstrip()[:3]
+      if marker == '```' or marker == '~~~':
+        if fence is None:
+          fence = marker
+        elif fence == marker:
+          fence = None
+      if size >= block_size and ((fence is None and line.strip() == '') or size >= block_size * 4):
+        yield ''.join(block)
+        block = []
+        size = 0
+    if len(rest) > block_size * 4:
+      # A line that goes on and on (e.g. a data: URL) is split
+      block.append(rest)
+      yield ''.join(block)
+      block = []
+      size = 0
+      rest = ''
+  block.append(rest)
+  text = ''.join(block)
+  if len(text) > 0:
+    yield text
+
+def iter_rendered_markdown(chunks, render):
+  # Renders text to HTML with render one group of paragraphs at a time and
+  # converts the HTML back to markdown, yielding it a piece at a time
+  parser = MarkdownParser(lenient=True)
+  for block in iter_markdown_blocks(chunks):
+    parser.feed(render(block))
+    yield parser.pop_output()
+  yield parser.finish()
+
+def iter_markdown(chunks, data_format):
+  # Converts text given a chunk at a time to markdown, yielding the markdown
+  # a piece at a time
+  if data_format == 'text/plain':
+    yield from iter_rendered_markdown(chunks, text_to_html)
+  elif data_format == 'text/html':
+    parser = MarkdownParser(lenient=True)
+    for chunk in chunks:
+      parser.feed(chunk)
+      yield parser.pop_output()
+    yield parser.finish()
+  elif data_format == 'text/markdown':
+    # no conversion required
+    for chunk in chunks:
+      yield chunk
+
+def convert_to_markdown(data, data_format):
+  if data is None:
+    data = ''
+  markdown_text = ''
+  if data_format == 'text/plain':
+    markdown_text = text_to_markdown(data)
+  elif data_format == 'text/html':
+    markdown_text = html_to_markdown(data)
+  elif data_format == 'text/markdown':
+    # no conversion required
+    markdown_text = data
+  return markdown_text
+
+def sniff_note_format(note_data):
+  # Guess the format of Apple Notes text
+  if note_data is None:
+    return 'text/plain'
+  if note_data.find('<http') != -1:
+    return 'text/markdown'
+  elif note_data.find('<div') != -1 or note_data.find('<span') != -1 or note_data.find('<html>') != -1:
+    return 'text/html'
+  return 'text/plain'
+
 def remove_prefix(text, prefix):
   if text.startswith(prefix):
     return text[len(prefix):]
@@ -373,27 +835,225 @@ def checkExtension(file, exts=None):
     return True
   return False
 
-def getFileMimeType(filepath):
-  mimetypes.init()
+def _read_filelist(fp, exts):
+  try:
+    for line in fp:
+      filename = line.strip()
+      if len(filename) == 0 or filename.startswith("#"):
+        # Skip blank lines and files that are commented out
+        continue
+      if checkExtension(filename, exts):
+        yield filename.replace("$CWD", os.getcwd())
+  finally:
+    if fp is not sys.stdin:
+      fp.close()
+
+def iter_filelist(filelist, exts=None):
+  # Yield file names from a file list one line at a time ('-' reads from stdin)
+  if filelist == '-':
+    return _read_filelist(sys.stdin, exts)
+  if not os.path.exists(filelist):
+    error('%s: no such filelist file' % (filelist, ))
+  return _read_filelist(open(filelist, "r"), exts)
+
+def iter_directory(path, exts=None):
+  # Yield files in a directory without building the full listing
+  with os.scandir(path) as it:
+    for entry in it:
+      if entry.is_file() and checkExtension(entry.name, exts):
+        yield entry.path
+
+# Bytes read from a file to guess its mime type from its contents
+MIME_SNIFF_SIZE = 4096
+
+# Signatures of the files attached to notes: (mime type, [(offset, bytes)])
+MIME_MAGIC = [
+  ('image/jpeg', [(0, b'\xff\xd8\xff')]),
+  ('image/png', [(0, b'\x89PNG\r\n\x1a\n')]),
+  ('image/gif', [(0, b'GIF87a')]),
+  ('image/gif', [(0, b'GIF89a')]),
+  ('image/tiff', [(0, b'II*\x00')]),
+  ('image/tiff', [(0, b'MM\x00*')]),
+  ('image/webp', [(0, b'RIFF'), (8, b'WEBP')]),
+  ('audio/x-wav', [(0, b'RIFF'), (8, b'WAVE')]),
+  ('video/x-msvideo', [(0, b'RIFF'), (8, b'AVI ')]),
+  ('application/pdf', [(0, b'%PDF-')]),
+  ('application/rtf', [(0, b'{\\rtf')]),
+  ('application/zip', [(0, b'PK\x03\x04')]),
+  ('application/gzip', [(0, b'\x1f\x8b')]),
+  ('application/vnd.sqlite3', [(0, b'SQLite format 3\x00')]),
+  ('audio/mpeg', [(0, b'ID3')]),
+  ('audio/ogg', [(0, b'OggS')]),
+  ('audio/flac', [(0, b'fLaC')]),
+  ('text/vcard', [(0, b'BEGIN:VCARD')]),
+  ('text/calendar', [(0, b'BEGIN:VCALENDAR')])
+]
+
+# Mime types of ISO media files (HEIC photos, videos and voice memos) by
+# the brand that follows 'ftyp'
+MIME_FTYP_BRANDS = {
+  b'heic': 'image/heic',
+  b'heix': 'image/heic',
+  b'hevc': 'image/heic',
+  b'mif1': 'image/heif',
+  b'msf1': 'image/heif',
+  b'qt  ': 'video/quicktime',
+  b'M4A ': 'audio/mp4',
+  b'M4V ': 'video/mp4',
+  b'isom': 'video/mp4',
+  b'iso2': 'video/mp4',
+  b'mp41': 'video/mp4',
+  b'mp42': 'video/mp4',
+  b'avc1': 'video/mp4',
+  b'3gp4': 'video/3gpp',
+  b'3gp5': 'video/3gpp'
+}
+
+# Mime types by file extension, looked up once per extension
+_extension_mime_types = {}
+
+def sniffFileMimeType(filepath):
+  # Guess the mime type of a file from its first bytes (None if unknown)
+  try:
+    with open(filepath, 'rb') as fp:
+      head = fp.read(MIME_SNIFF_SIZE)
+  except OSError:
+    return None
+  for mimetype, signature in MIME_MAGIC:
+    if all(head.startswith(magic, offset) for offset, magic in signature):
+      return mimetype
+  if head.startswith(b'ftyp', 4):
+    return MIME_FTYP_BRANDS.get(head[8:12])
+  if len(head) == 0 or b'\x00' in head:
+    return None
+  try:
+    # the last character may have been cut off
+    text = codecs.getincrementaldecoder('utf-8')().decode(head)
+  except UnicodeDecodeError:
+    return None
+  start = text.lstrip()[:64].lower()
+  if start.startswith('<!doctype html') or start.startswith('<html'):
+    return 'text/html'
+  elif start.startswith('<?xml'):
+    return 'application/xml'
+  return 'text/plain'
 
+def getFileMimeType(filepath):
+  # Returns (type, subtype) from the file extension or, when the extension
+  # is missing or unknown (e.g. Apple Notes attachments), the file contents
   if filepath is None:
     return ('application', 'octet-stream')
-  
-  pathname, filename = os.path.split(filepath)
 
-  basename, file_extension = os.path.splitext(filename)
+  basename, file_extension = os.path.splitext(filepath)
 
-  mimetype = 'application/octet-stream'
-  try:
-    mimetype = mimetypes.types_map[file_extension]
-  except KeyError as ke:
-    mimetype = 'application/octet-stream'
+  mimetype = _extension_mime_types.get(file_extension, False)
+  if mimetype is False:
+    # mimetypes.init() re-reads the system mime.types files on every call
+    if not mimetypes.inited:
+      mimetypes.init()
+    mimetype = mimetypes.types_map.get(file_extension)
+    if mimetype is None:
+      mimetype = mimetypes.types_map.get(file_extension.lower())
+    _extension_mime_types[file_extension] = mimetype
+
+  if mimetype is None:
+    mimetype = sniffFileMimeType(filepath)
+    if mimetype is None:
+      mimetype = 'application/octet-stream'
 
-  mime_type_list = mimetype.split("/")
-  mime_type, mime_subtype = [mime_type_list[i] for i in (0, 1)]
+  mime_type, mime_subtype = mimetype.split("/", 1)
 
   return (mime_type, mime_subtype)
 
+# How attachment files are placed in the resources directory
+LINK_MODES = ['copy', 'hardlink', 'reflink', 'symlink']
+
+# Linux ioctl to share the data blocks of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+def _reflink_file(src, dst):
+  import fcntl
+  with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+    fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+
+def _copy_file_range(src, dst):
+  with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+    remaining = os.fstat(src_fp.fileno()).st_size
+    while remaining > 0:
+      copied = os.copy_file_range(src_fp.fileno(), dst_fp.fileno(), remaining)
+      if copied == 0:
+        break
+      remaining -= copied
+
+def copy_resource_file(src, dst, link_mode='copy'):
+  # Links or copies src next to dst and renames it into place, so that an
+  # interrupted or failed copy never leaves a partly written dst
+  partial_dst = dst + '.partial'
+  try:
+    os.remove(partial_dst)
+  except FileNotFoundError:
+    pass
+  try:
+    _copy_resource_file(src, partial_dst, link_mode)
+    os.replace(partial_dst, dst)
+  except BaseException:
+    try:
+      os.remove(partial_dst)
+    except OSError:
+      pass
+    raise
+
+def _copy_resource_file(src, dst, link_mode):
+  # Fall back to a plain copy when the file system cannot link or clone files
+  if link_mode == 'hardlink':
+    try:
+      os.link(src, dst)
+      return
+    except OSError:
+      pass
+  elif link_mode == 'symlink':
+    try:
+      os.symlink(os.path.abspath(src), dst)
+      return
+    except OSError:
+      pass
+  elif link_mode == 'reflink':
+    try:
+      _reflink_file(src, dst)
+      shutil.copystat(src, dst)
+      return
+    except (ImportError, OSError):
+      pass
+    if hasattr(os, 'copy_file_range'):
+      try:
+        _copy_file_range(src, dst)
+        shutil.copystat(src, dst)
+        return
+      except OSError:
+        pass
+  shutil.copy2(src, dst)
+
+def parallel_map(fn, iterable, workers=None, max_pending=None):
+  # Like map() but runs fn in a pool of worker processes, yielding results in
+  # order and only keeping max_pending items in flight
+  if workers is None:
+    workers = os.cpu_count() or 1
+  if workers <= 1:
+    for item in iterable:
+      yield fn(item)
+    return
+  if max_pending is None:
+    max_pending = workers * 4
+  import concurrent.futures
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    pending = collections.deque()
+    for item in iterable:
+      pending.append(executor.submit(fn, item))
+      if len(pending) >= max_pending:
+        yield pending.popleft().result()
+    while len(pending) > 0:
+      yield pending.popleft().result()
+
 def getResourceFileName(resourcesPath, resource):
   matches = []
   for filename in os.listdir(resourcesPath):
@@ -402,6 +1062,48 @@ def getResourceFileName(resourcesPath, resource):
 
   return matches
 
+class ResourceIndex(object):
+  # Files in a resources directory listed once, sorted so that the files
+  # whose names start with a resource id can be found with a binary search
+  def __init__(self, resources_path):
+    self.resources_path_ = resources_path
+    self.sizes_ = {}
+    if resources_path is not None and os.path.isdir(resources_path):
+      with os.scandir(resources_path) as it:
+        for entry in it:
+          if entry.is_file():
+            self.sizes_[entry.name] = entry.stat().st_size
+    self.filenames_ = sorted(self.sizes_)
+
+  def add(self, filename):
+    # Index a file copied into the resources directory after the index was built
+    try:
+      size = os.path.getsize(os.path.join(self.resources_path_, filename))
+    except OSError:
+      return
+    if filename not in self.sizes_:
+      bisect.insort(self.filenames_, filename)
+    self.sizes_[filename] = size
+
+  def find(self, resource):
+    # Same matches as getResourceFileName
+    matches = []
+    i = bisect.bisect_left(self.filenames_, resource)
+    while i < len(self.filenames_) and self.filenames_[i].startswith(resource):
+      matches.append(self.filenames_[i])
+      i += 1
+    return matches
+
+  def path(self, filename):
+    return os.path.join(self.resources_path_, filename)
+
+  def size(self, path):
+    # Size of an indexed file or None if the file is not in the index
+    pathname, filename = os.path.split(path)
+    if pathname != self.resources_path_:
+      return None
+    return self.sizes_.get(filename)
+
 def getResourceLinks(lines):
   # e.g. ![IMAGE.JPG](:/7dd8b560cbc1467693f024d650870a0c)
   #      [FILE.pdf](:/a56a1e70f3b14bb085f8b8d7794c05fc)
@@ -417,6 +1119,61 @@ def getResourceLinks(lines):
         links.append((url, filename, resource))
   return links
 
+# e.g. file:///Users/username/notesdb/resources/a56a1e70f3b14bb085f8b8d7794c05fc.pdf
+FILE_URL_RE = re.compile(r'file://(/[^\s\)\]"\'<>]+)')
+
+def getResourceIdFromPath(path):
+  # /Users/username/Library/Group Containers/group.com.apple.notes/Media/12345678-1234-1234-1234-123456789012/filename.ext
+  parts = path.split('/')
+  if len(parts) > 4 and parts[-4] == 'group.com.apple.notes' and parts[-3] == 'Media':
+    return format_uuid_string(parts[-2])
+  basename, extension = os.path.splitext(parts[-1])
+  return format_uuid_string(basename)
+
+def getNoteResources(note_data, resource_index=None, attachment_id=None, attachment_path=None):
+  # Returns (resource_id, path, mime, size) for each resource referenced by a
+  # note's attachment path, (:/id) links and file:// URLs
+  references = []
+  if attachment_path is not None:
+    if attachment_id is not None:
+      references.append((format_uuid_string(attachment_id), attachment_path))
+    else:
+      references.append((getResourceIdFromPath(attachment_path), attachment_path))
+
+  if note_data:
+    for url, filename, resource in getResourceLinks(note_data.split()):
+      path = None
+      if resource_index is not None:
+        matches = resource_index.find(resource)
+        if len(matches) > 0:
+          path = resource_index.path(matches[0])
+      references.append((resource, path))
+
+    for m in FILE_URL_RE.finditer(note_data):
+      path = unquote(m.group(1))
+      references.append((getResourceIdFromPath(path), path))
+
+  resources = []
+  seen = set()
+  for resource_id, path in references:
+    if (resource_id, path) in seen:
+      continue
+    seen.add((resource_id, path))
+    mime = None
+    size = None
+    if path is not None:
+      mime_type, mime_subtype = getFileMimeType(path)
+      mime = mime_type + '/' + mime_subtype
+      if resource_index is not None:
+        size = resource_index.size(path)
+      if size is None:
+        try:
+          size = os.path.getsize(path)
+        except OSError:
+          size = None
+    resources.append((resource_id, path, mime, size))
+  return resources
+
 def noteTypeFromJoplinType(type_):
   if int(type_) == constants.JoplinType.JOPLIN_TYPE_NOTE:
     return "note"
@@ -36,6 +36,10 @@ NOTES_FOLDER_NAME = "Notes"
 NOTES_FOLDER_UUID = "2e7ca3c0de554a7b870630ea2848e731"
 NOTES_UNTITLED    = "Untitled"
 
+# Incremented when the markdown conversion changes so that notes converted
+# by an older version can be converted again (see convertnotes)
+CONVERTER_VERSION = 1
+
 #
 # Joplin note type
 #
@@ -129,4 +133,6 @@ class NotesColumns(IntEnum):
   JOPLIN_NOTE_ID = 66
   JOPLIN_TAG_ID = 67
   JOPLIN_MIME = 68
-  JOPLIN_FILENAME = 69
\ No newline at end of file
+  JOPLIN_FILENAME = 69
+  JOPLIN_FILE_EXTENSION = 70
+  NOTE_CONVERTER_VERSION = 71
\ No newline at end of file
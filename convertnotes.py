@@ -0,0 +1,358 @@
+import re
+import os
+import argparse
+import sys
+import errno
+import optparse
+import sqlite3
+import tempfile
+import hashlib
+
+import notesdb
+import constants
+import common
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program converts notes stored in their original format (see the --raw
+# option of the loaders) or converted by an older version of the markdown
+# converter to markdown.
+#
+
+global __name__, __author__, __email__, __version__, __license__
+__program_name__ = 'convertnotes'
+__author__ = 'Rene Sugar'
+__email__ = 'rene.sugar@gmail.com'
+__version__ = '1.00'
+__license__ = 'MIT License (https://opensource.org/licenses/MIT)'
+__website__ = 'https://github.com/renesugar'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
+
+CHECKPOINT_SETTING = 'convertnotes_checkpoint'
+VERSION_SETTING = 'convertnotes_version'
+
+def _get_option_parser():
+    parser = optparse.OptionParser('%prog [options]',
+                                   version='%prog ' + __version__)
+    parser.add_option('', "--email",
+                      action="store", dest="email_address", default=None,
+                      help="Email address")
+    parser.add_option("", "--input",
+                      action="store", dest="input_path", default=[],
+                      help="Path to input SQLite directory")
+    parser.add_option('', "--workers",
+                      action="store", dest="workers", type="int", default=None,
+                      help="Number of processes used to convert notes (default: number of CPUs)")
+    parser.add_option('', "--chunk-size",
+                      action="store", dest="chunk_size", type="int", default=1000,
+                      help="Number of note ids converted per transaction")
+    parser.add_option('', "--stream-size",
+                      action="store", dest="stream_size", type="int", default=common.STREAMING_MIN_SIZE,
+                      help="Notes larger than this (in bytes) are converted a chunk at a time by the main process")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do when a converted note has the same text as another note: keep-first (keep the note loaded first), keep-newest (keep the newer note) or merge-metadata (keep the note loaded first and fill in the fields it is missing from the other note) (default: keep-first)")
+    parser.add_option('', "--restart",
+                      action="store_true", dest="restart", default=False,
+                      help="Ignore the checkpoint left by a previous run")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
+    return parser
+
+def source_for_row(row):
+  # Returns the text to convert and its format or None if the note cannot
+  # be converted again
+  if row['note_data_format'] != 'text/markdown':
+    note_data_format = row['note_data_format']
+    if note_data_format is None:
+      note_data_format = common.sniff_note_format(row['note_data'])
+    return (row['note_data'], note_data_format)
+  if row['note_original_format'] == 'email':
+    return (row['email_body'], row['email_content_type'])
+  elif row['note_original_format'] == 'apple':
+    return (row['apple_data'], common.sniff_note_format(row['apple_data']))
+  elif row['note_original_format'] == 'icloud':
+    return (row['apple_data'], 'text/plain')
+  return None
+
+def convert_note(task):
+  # Runs in a worker process
+  note_id, data, data_format = task
+  if note_id is None:
+    # end of chunk marker
+    return task
+
+  note_data = common.convert_to_markdown(data, data_format)
+
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
+
+  return (note_id, note_data, note_hash)
+
+# Size of the text convert_tasks reads for a note
+SOURCE_SIZE_SQL = '''MAX(IFNULL(%s, 0), IFNULL(%s, 0), IFNULL(%s, 0))''' % (notesdb.text_size_sql('notes.note_data'),
+  notesdb.text_size_sql('note_email.email_body'), notesdb.text_size_sql('note_apple.apple_data'))
+
+def convert_tasks(sqlconn, start_id, max_id, chunk_size, stream_size):
+  # Yields the notes to convert one note id range at a time followed by a
+  # marker holding the range. Notes larger than stream_size are left to
+  # convert_large_notes.
+  sqlcur = sqlconn.cursor()
+  while start_id < max_id:
+    end_id = min(start_id + chunk_size, max_id)
+    sqlcur.execute('''SELECT notes.note_id,
+notes.note_original_format,
+note_text(notes.note_data) AS note_data,
+notes.note_data_format,
+note_text(note_email.email_body) AS email_body,
+note_email.email_content_type,
+note_text(COALESCE(note_apple.apple_data, notes.note_data)) AS apple_data FROM notes
+LEFT JOIN note_email ON note_email.note_id = notes.note_id
+LEFT JOIN note_apple ON note_apple.note_id = notes.note_id
+WHERE notes.note_id > ? AND notes.note_id <= ? AND notes.note_type = 'note' AND
+      (notes.note_data_format IS NULL OR notes.note_data_format != 'text/markdown' OR
+       notes.note_converter_version < ?) AND %s <= ?''' % (SOURCE_SIZE_SQL,),
+      (start_id, end_id, constants.CONVERTER_VERSION, stream_size))
+    for row in sqlcur.fetchall():
+      source = source_for_row(row)
+      if source is None:
+        continue
+      yield (row['note_id'], source[0], source[1])
+    yield (None, end_id, start_id)
+    start_id = end_id
+
+def large_source_for_row(sqlconn, row):
+  # Same as source_for_row but returns the column holding the text to
+  # convert (table name, column name, note id) and its format
+  note_id = row['note_id']
+  if row['note_data_format'] != 'text/markdown':
+    column = ('notes', 'note_data', note_id)
+    note_data_format = row['note_data_format']
+  elif row['note_original_format'] == 'email':
+    return (('note_email', 'email_body', note_id), row['email_content_type'])
+  elif row['note_original_format'] in ['apple', 'icloud']:
+    column = ('notes', 'note_data', note_id)
+    if row['has_apple_data']:
+      column = ('note_apple', 'apple_data', note_id)
+    note_data_format = None
+    if row['note_original_format'] == 'icloud':
+      note_data_format = 'text/plain'
+  else:
+    return None
+  if note_data_format is None:
+    # NOTE: the format is guessed from the first chunk of the text
+    first_chunk = next(notesdb.iter_text(sqlconn, *column), None)
+    note_data_format = common.sniff_note_format(first_chunk)
+  return (column, note_data_format)
+
+def convert_large_notes(sqlconn, start_id, end_id, stream_size, compression, on_duplicate):
+  # Converts and stores the notes in the note id range that are larger than
+  # stream_size, yielding what store_note returns for each. The note is read
+  # with blob I/O and the markdown is written to a temporary file and hashed
+  # a chunk at a time. When the database is not compressed the markdown is
+  # copied from the file into the note with blob I/O too; compressing it
+  # needs the whole text in memory (once).
+  sqlcur = sqlconn.cursor()
+  sqlcur.execute('''SELECT notes.note_id,
+notes.note_original_format,
+notes.note_data_format,
+note_email.email_content_type,
+note_apple.apple_data IS NOT NULL AS has_apple_data FROM notes
+LEFT JOIN note_email ON note_email.note_id = notes.note_id
+LEFT JOIN note_apple ON note_apple.note_id = notes.note_id
+WHERE notes.note_id > ? AND notes.note_id <= ? AND notes.note_type = 'note' AND
+      (notes.note_data_format IS NULL OR notes.note_data_format != 'text/markdown' OR
+       notes.note_converter_version < ?) AND %s > ?''' % (SOURCE_SIZE_SQL,),
+    (start_id, end_id, constants.CONVERTER_VERSION, stream_size))
+  for row in sqlcur.fetchall():
+    source = large_source_for_row(sqlconn, row)
+    if source is None:
+      continue
+    with tempfile.TemporaryFile() as f:
+      # same as common.note_fingerprint
+      h = hashlib.blake2b(digest_size=16)
+      size = 0
+      for markdown in common.iter_markdown(notesdb.iter_text(sqlconn, *source[0]), source[1]):
+        data = markdown.encode('utf-8')
+        h.update(data)
+        f.write(data)
+        size += len(data)
+      note_hash = common.FINGERPRINT_BLAKE2B_128 + h.digest()
+      f.seek(0)
+      if compression != "none":
+        yield store_note(sqlconn, row['note_id'], f.read().decode('utf-8'), note_hash, on_duplicate)
+      else:
+        yield store_note_file(sqlconn, row['note_id'], f, size, note_hash, on_duplicate)
+
+def remove_duplicate(sqlconn, note_id, note_hash, on_duplicate):
+  # Notes are unique by hash, so if another note has the markdown text of
+  # the converted note one of them is removed as on_duplicate says (see
+  # notesdb.duplicate_policies; the note loaded first has the lower note id).
+  # Returns the id of the note removed or None.
+  sqlcur = sqlconn.cursor()
+  sqlcur.execute('''SELECT note_id, note_uuid, note_internal_date FROM notes
+WHERE note_type = 'note' AND (note_id = ? OR note_hash = ?) ORDER BY note_id''', (note_id, note_hash))
+  rows = sqlcur.fetchall()
+  if len(rows) < 2:
+    return None
+  kept, removed = rows[0], rows[1]
+  if (on_duplicate == "keep-newest" and kept[2] is not None and removed[2] is not None and
+      removed[2] > kept[2]):
+    kept, removed = removed, kept
+  elif on_duplicate == "merge-metadata":
+    notesdb.merge_note(sqlconn, kept[0], removed[0])
+  sqlconn.execute('''DELETE FROM notes WHERE note_id = ?''', (removed[0],))
+  print("removed note %d (%s), a duplicate of note %d once converted" % (removed[0], removed[1], kept[0]))
+  return removed[0]
+
+def store_note(sqlconn, note_id, note_data, note_hash, on_duplicate):
+  # Returns the id of the note removed as a duplicate or None
+  removed = remove_duplicate(sqlconn, note_id, note_hash, on_duplicate)
+  if removed != note_id:
+    sqlconn.execute('''UPDATE notes SET note_data = note_compress(?),
+note_data_format = 'text/markdown',
+note_hash = ?,
+note_converter_version = ? WHERE note_id = ?''', (note_data, note_hash, constants.CONVERTER_VERSION, note_id))
+  return removed
+
+def store_note_file(sqlconn, note_id, fp, size, note_hash, on_duplicate):
+  # Same as store_note for the size bytes of utf-8 text in the file fp,
+  # which are written into the (uncompressed) note with blob I/O. The
+  # search index trigger would read the placeholder text, so the note is
+  # indexed here instead.
+  removed = remove_duplicate(sqlconn, note_id, note_hash, on_duplicate)
+  if removed == note_id:
+    return removed
+  sqlconn.execute('''DROP TRIGGER IF EXISTS "notes_fts_update";''')
+  sqlconn.execute('''INSERT INTO notes_fts (notes_fts, rowid, note_title, note_data, note_url)
+SELECT 'delete', note_id, note_title, note_data, note_url FROM notes_text WHERE note_id = ?''', (note_id,))
+  sqlconn.execute('''UPDATE notes SET note_data = CAST(zeroblob(?) AS TEXT),
+note_data_format = 'text/markdown',
+note_hash = ?,
+note_converter_version = ? WHERE note_id = ?''', (size, note_hash, constants.CONVERTER_VERSION, note_id))
+  with sqlconn.blobopen('notes', 'note_data', note_id) as blob:
+    data = fp.read(common.STREAMING_CHUNK_SIZE)
+    while data:
+      blob.write(data)
+      data = fp.read(common.STREAMING_CHUNK_SIZE)
+  sqlconn.execute('''INSERT INTO notes_fts (rowid, note_title, note_data, note_url)
+SELECT note_id, note_title, note_data, note_url FROM notes_text WHERE note_id = ?''', (note_id,))
+  notesdb.create_search_index(sqlconn)
+  return removed
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  email_address = ''
+  if hasattr(options, 'email_address') and options.email_address:
+    email_address = options.email_address
+    if common.check_email_address(email_address) == False:
+      # Check if email address is valid
+      common.error("email address '%s' is not valid." % (email_address,))
+  else:
+    common.error("email address not specified.")
+
+  inputPath = ''
+
+  if hasattr(options, 'input_path') and options.input_path:
+    inputPath = os.path.abspath(os.path.expanduser(options.input_path))
+    if os.path.isdir(inputPath) == False:
+      # Check if input directory exists
+      common.error("input path '%s' does not exist." % (inputPath,))
+  else:
+    common.error("input path not specified.")
+
+  if options.chunk_size < 1:
+    common.error("chunk size must be at least 1.")
+
+  if options.stream_size < 0:
+    common.error("stream size must not be negative.")
+
+
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
+  sqlconn.row_factory = sqlite3.Row
+  sqlcur = sqlconn.cursor()
+  compression = notesdb.compression_setting(sqlconn)
+
+  # Resume after the last note id converted by an interrupted run of the
+  # same converter version
+  start_id = 0
+  if (not options.restart and
+      db_settings.get(VERSION_SETTING) == str(constants.CONVERTER_VERSION) and
+      CHECKPOINT_SETTING in db_settings):
+    start_id = int(db_settings[CHECKPOINT_SETTING])
+
+  sqlcur.execute('''SELECT MAX(note_id) FROM notes''')
+  max_id = sqlcur.fetchone()[0]
+  if max_id is None:
+    max_id = 0
+
+  notesdb.set_db_setting(sqlconn, VERSION_SETTING, str(constants.CONVERTER_VERSION))
+  sqlconn.commit()
+
+  count = 0
+  duplicates = 0
+  updates = []
+  tasks = convert_tasks(sqlconn, start_id, max_id, options.chunk_size, options.stream_size)
+  for result in common.parallel_map(convert_note, tasks, options.workers):
+    if result[0] is not None:
+      updates.append(result)
+      continue
+    # end of chunk: convert the large notes of the chunk here rather than
+    # in a worker, then write the converted notes and the checkpoint
+    # together
+    for update in updates:
+      if store_note(sqlconn, *update, options.on_duplicate) is not None:
+        duplicates += 1
+    count += len(updates)
+    updates = []
+    for removed in convert_large_notes(sqlconn, result[2], result[1], options.stream_size, compression, options.on_duplicate):
+      if removed is not None:
+        duplicates += 1
+      count += 1
+    notesdb.set_db_setting(sqlconn, CHECKPOINT_SETTING, str(result[1]))
+    sqlconn.commit()
+    print("converted %d notes (note id %d of %d)" % (count, result[1], max_id))
+
+  if duplicates > 0:
+    print("removed %d notes that were duplicates once converted" % (duplicates,))
+
+  # Start from the beginning the next time the converter version changes
+  notesdb.set_db_setting(sqlconn, CHECKPOINT_SETTING, str(0))
+  sqlconn.commit()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -1,4 +1,3 @@
-import regex
 import re
 import os
 import argparse
@@ -8,15 +7,9 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 import hashlib
 
-import mailbox
+import time
 
 import common
 
@@ -70,16 +63,86 @@ def _get_option_parser():
     parser.add_option("", "--input",
                       action="store", dest="input_path", default=[],
                       help="Path to input SQLite directory")
+    parser.add_option("", "--filelist",
+                      action="store", dest="filelist", default=None,
+                      help="file containing list of RFC822 email files to be packaged ('-' for stdin)")
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output emails directory")
+    parser.add_option('', "--max-size",
+                      action="store", type="int", dest="max_size", default=None,
+                      help="Maximum size of each output mbox file in megabytes")
+    parser.add_option('', "--max-messages",
+                      action="store", type="int", dest="max_messages", default=None,
+                      help="Maximum number of messages in each output mbox file")
     return parser
 
+# Lines starting with "From " are escaped the same way as mailbox.mbox (mboxo)
+FROM_LINE_RE = re.compile(rb'^From ', re.MULTILINE)
+
+class MboxWriter(object):
+  def __init__(self, output_path, max_size=None, max_messages=None):
+    self.output_path_ = output_path
+    self.max_size_ = max_size
+    self.max_messages_ = max_messages
+    self.fp_ = None
+    self.size_ = 0
+    self.count_ = 0
+
+  def _open(self):
+    mboxfile = os.path.join(self.output_path_, str(uuid.uuid4()).replace('-', '') + '.mbox')
+    print("writing %s" % (mboxfile,))
+    self.fp_ = open(mboxfile, 'wb')
+    self.size_ = 0
+    self.count_ = 0
+
+  def _is_full(self, length):
+    if self.count_ == 0:
+      # Always write at least one message per file
+      return False
+    if self.max_messages_ is not None and self.count_ >= self.max_messages_:
+      return True
+    if self.max_size_ is not None and self.size_ + length > self.max_size_:
+      return True
+    return False
+
+  def add(self, data):
+    # Messages are copied as raw bytes so they are not decoded and re-encoded
+    data = data.replace(b'\r\n', b'\n')
+
+    if data.startswith(b'From '):
+      from_line, sep, data = data.partition(b'\n')
+      from_line += b'\n'
+    else:
+      from_line = b'From MAILER-DAEMON ' + time.asctime(time.gmtime()).encode('ascii') + b'\n'
+
+    data = FROM_LINE_RE.sub(b'>From ', data)
+
+    if not data.endswith(b'\n'):
+      data += b'\n'
+    data += b'\n'
+
+    length = len(from_line) + len(data)
+
+    if self.fp_ is None or self._is_full(length):
+      self.close()
+      self._open()
+
+    self.fp_.write(from_line)
+    self.fp_.write(data)
+    self.size_ += length
+    self.count_ += 1
+
+  def close(self):
+    if self.fp_ is not None:
+      self.fp_.close()
+      self.fp_ = None
+
 def process_email(filename, mbox):
   print("processing %s" % (filename,))
-  with open(filename, 'r') as fp:
+  with open(filename, 'rb') as fp:
     try:
-        mbox.add(fp)
+        mbox.add(fp.read())
     except:
         mbox.close()
         raise
@@ -99,11 +162,14 @@ def main(args):
 
   inputPath = ''
 
-  if hasattr(options, 'input_path') and options.input_path:
+  if hasattr(options, 'filelist') and options.filelist:
+    filenames = common.iter_filelist(options.filelist, ['eml'])
+  elif hasattr(options, 'input_path') and options.input_path:
     inputPath = os.path.abspath(os.path.expanduser(options.input_path))
     if os.path.isdir(inputPath) == False:
       # Check if input directory exists
       common.error("input path '%s' does not exist." % (inputPath,))
+    filenames = common.iter_directory(inputPath, ['eml'])
   else:
     common.error("input path not specified.")
 
@@ -116,20 +182,18 @@ def main(args):
       common.error("output path '%s' does not exist." % (outputPath,))
   else:
     common.error("output path not specified.")
-  
-  mboxfile = os.path.join(outputPath, str(uuid.uuid4()).replace('-', '') + '.mbox')
 
-  output_mbox = mailbox.mbox(mboxfile, create=True)
-  output_mbox.lock()
+  max_size = None
+  if options.max_size is not None:
+    max_size = options.max_size * 1024 * 1024
+
+  output_mbox = MboxWriter(outputPath, max_size=max_size, max_messages=options.max_messages)
 
   count = 0
-  for filename in os.listdir(inputPath):
-    if filename.split('.')[-1] == "eml":
-      filePath = os.path.join(inputPath, filename)
-      process_email(filePath, output_mbox)
-      count += 1
+  for filePath in filenames:
+    process_email(filePath, output_mbox)
+    count += 1
   output_mbox.close()
 
 if __name__ == "__main__":
   main(sys.argv[1:])
-
@@ -6,17 +6,18 @@ import errno
 import optparse
 import sqlite3
 import uuid
+import io
 
 import email
 import email.utils
+import email.header
 from email.message import EmailMessage
 from email.parser import BytesParser, Parser
-from email.policy import default
-
-import hashlib
+from email.policy import default, compat32
 
 import notesdb
 import common
+import constants
 
 #
 # MIT License
@@ -56,8 +57,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 ALL_EXTS = ['.eml']
 
@@ -72,7 +73,19 @@ def _get_option_parser():
                       help="Path to output SQLite directory")
     parser.add_option("", "--filelist",
                       action="store", dest="filelist", default=[],
-                      help="file containing list of RFC822 email files to be loaded")
+                      help="file containing list of RFC822 email files to be loaded ('-' for stdin)")
+    parser.add_option('', "--raw",
+                      action="store_true", dest="raw", default=False,
+                      help="Store notes in their original format (convert later with convertnotes)")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
 def extract_filenames(args):
@@ -85,31 +98,104 @@ def extract_filenames(args):
   return filenames
 
 def extract_filelist(options):
-  filenames = []
-  if not os.path.exists(options.filelist):
-    common.error('%s: no such filelist file' % (options.filelist, ))
-  with open(options.filelist, "r") as filelist_file:
-    lines = filelist_file.readlines()
-  for line in lines:
-    filename = line.strip()
-    if filename.startswith("#"):
-      # Skip files that are commented out
-      continue
-    if (filename.endswith('.eml')):
-      filename = filename.replace("$CWD", os.getcwd())
-      if not os.path.exists(filename):
-          common.error('%s: Invalid filelist entry - no such file or directory' % (line, ))
-      filenames.append(filename)
-  return filenames
+  # Generator so that loading starts with the first file in the list
+  return common.iter_filelist(options.filelist, ['eml'])
+
+# Blank line separating the message headers from the body
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+# Headers used when loading a message as a note
+NOTE_HEADERS = [
+  'date',
+  'x-mail-created-date',
+  'subject',
+  'mime-version',
+  'x-universally-unique-identifier',
+  'message-id',
+]
+
+def _decode_header_value(value):
+  # Unfold and decode RFC 2047 encoded words the same way as email.policy.default
+  if value is None:
+    return None
+  value = ''.join(value.splitlines())
+  return str(email.header.make_header(email.header.decode_header(value)))
+
+def _read_full_message(data):
+  # Parsed as a file so that CRLF line endings are read as LF
+  msg = email.message_from_binary_file(io.BytesIO(data), policy=default)
+
+  headers = {}
+  for name in NOTE_HEADERS:
+    value = msg.get(name)
+    headers[name] = (str(value) if value is not None else None)
+
+  msg_body = msg.get_body(preferencelist=('html', 'plain'))
+  email_body = msg_body.get_content()
+  if hasattr(msg_body['content-type'], 'content_type'):
+    email_content_type = msg_body['content-type'].content_type
+  else:
+    email_content_type = 'text/plain'
+  email_content_transfer_encoding = msg_body['content-transfer-encoding']
+  if email_content_transfer_encoding is not None:
+    email_content_transfer_encoding = str(email_content_transfer_encoding)
+
+  return (headers, email_body, email_content_type, email_content_transfer_encoding)
+
+def read_message(filename):
+  # Read the file once and only parse the header block; the body of single
+  # part text messages (e.g. Apple Notes) is decoded directly, anything else
+  # falls back to the full parser.
+  with open(filename, 'rb') as fp:
+    data = fp.read()
+
+  m = HEADER_END_RE.search(data)
+  if m is None:
+    header_bytes = data
+    body_bytes = b''
+  else:
+    header_bytes = data[:m.start()] + b'\n'
+    body_bytes = data[m.end():]
+
+  if not header_bytes.isascii():
+    return _read_full_message(data)
+
+  msg = BytesParser(policy=compat32).parsebytes(header_bytes, headersonly=True)
+
+  email_content_type = msg.get_content_type()
+  if email_content_type not in ('text/html', 'text/plain'):
+    return _read_full_message(data)
 
-def process_message(filename, email_address, sqlconn, sqlcur):
+  headers = {}
+  for name in NOTE_HEADERS:
+    headers[name] = _decode_header_value(msg.get(name))
+
+  if headers['date'] is not None:
+    # email.policy.default normalizes the date header
+    try:
+      headers['date'] = email.utils.format_datetime(email.utils.parsedate_to_datetime(headers['date']))
+    except (TypeError, ValueError):
+      pass
+
+  msg.set_payload(body_bytes.replace(b'\r\n', b'\n').decode('ascii', 'surrogateescape'))
+  content = msg.get_payload(decode=True)
+  charset = msg.get_param('charset', 'ASCII')
+  try:
+    email_body = content.decode(charset, errors='replace')
+  except LookupError:
+    email_body = content.decode('utf-8', errors='replace')
+
+  email_content_transfer_encoding = _decode_header_value(msg.get('content-transfer-encoding'))
+
+  return (headers, email_body, email_content_type, email_content_transfer_encoding)
+
+def process_message(filename, email_address, sqlconn, sqlcur, raw=False, on_duplicate="keep-first"):
   print("processing %s" % (filename,))
 
   # process email messages as notes
 
   # load email message from file
-  with open(filename, 'rb') as fp:
-    msg = email.message_from_binary_file(fp, policy=default)
+  headers, email_body, email_content_type, email_content_transfer_encoding = read_message(filename)
 
   # email_filename
   email_filename = filename
@@ -124,71 +210,56 @@ def process_message(filename, email_address, sqlconn, sqlcur):
   note_original_format = "email"
 
   # email_date
-  email_date = msg.get('date')
+  email_date = headers['date']
   if email_date is None:
     email_date = email.utils.formatdate()
   # note_internal_date
   note_internal_date = email.utils.parsedate_to_datetime(email_date)
   # email_x_mail_created_date
-  email_x_mail_created_date = msg.get('x-mail-created-date')
+  email_x_mail_created_date = headers['x-mail-created-date']
   if email_x_mail_created_date is None:
     email_x_mail_created_date = email_date
 
   # email_subject
-  email_subject = msg.get('subject')
+  email_subject = headers['subject']
   if email_subject is None:
     email_subject = "New Note"
   # note_title
   note_title = common.remove_line_breakers(email_subject).strip()
 
   # email_body
-  msg_body = msg.get_body(preferencelist=('html', 'plain'))
-  email_body = msg_body.get_content()
   # note_data
   note_data = email_body
   # email_content_type
-  if hasattr(msg_body['content-type'], 'content_type'):
-    email_content_type = msg_body['content-type'].content_type
-  else:
-    email_content_type = 'text/plain'
   # note_data_format
   note_data_format = email_content_type
   # email_content_transfer_encoding
-  email_content_transfer_encoding = msg_body['content-transfer-encoding']
 
-  markdown_text = ''
-  if note_data_format == 'text/plain':
-    markdown_text = common.text_to_markdown(note_data)
-  elif note_data_format == 'text/html':
-    markdown_text = common.html_to_markdown(note_data)
-  elif note_data_format == 'text/markdown':
-    # no conversion required
-    markdown_text = note_data
-
-  # note_data
-  note_data = markdown_text
+  # note_converter_version
+  note_converter_version = None
 
-  # note_data_format
-  note_data_format = 'text/markdown'
+  if not raw:
+    # convert to markdown (raw notes are converted later by convertnotes)
+    note_data = common.convert_to_markdown(note_data, note_data_format)
+    note_data_format = 'text/markdown'
+    note_converter_version = constants.CONVERTER_VERSION
 
-  # note_hash (hash the plain text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the plain text)
+  note_hash = common.note_fingerprint(note_data)
 
   # email_x_uniform_type_identifier
   email_x_uniform_type_identifier = "com.apple.mail-note"
 
   # email_mime_version
-  email_mime_version = msg.get('mime-version')
+  email_mime_version = headers['mime-version']
   if email_mime_version is None:
     email_mime_version = "1.0"
   # email_x_universally_unique_identifier
-  email_x_universally_unique_identifier = msg.get('X-Universally-Unique-Identifier')
+  email_x_universally_unique_identifier = headers['x-universally-unique-identifier']
   if email_x_universally_unique_identifier is None:
     email_x_universally_unique_identifier = common.create_universally_unique_identifier().upper()
   # email_message_id
-  email_message_id = msg.get('message-id')
+  email_message_id = headers['message-id']
   if email_message_id is None:
     email_message_id = common.create_message_id()
 
@@ -203,6 +274,7 @@ def process_message(filename, email_address, sqlconn, sqlcur):
   columns["note_data"] = note_data
   columns["note_data_format"] = note_data_format
   columns["note_url"] = None
+  columns["note_converter_version"] = note_converter_version
   columns["email_filename"] = email_filename
   columns["email_from"] = email_from
   columns["email_x_uniform_type_identifier"] = email_x_uniform_type_identifier
@@ -216,7 +288,7 @@ def process_message(filename, email_address, sqlconn, sqlcur):
   columns["email_message_id"] = email_message_id
   columns["email_body"] = email_body
 
-  notesdb.add_email_note(sqlconn, columns)
+  notesdb.add_email_note(sqlconn, columns, on_duplicate)
   sqlconn.commit()
 
 def main(args):
@@ -236,7 +308,6 @@ def main(args):
     filenames = extract_filelist(options)
   else:
     filenames = extract_filenames(args)
-  filenames = [os.path.realpath(f) for f in filenames]
 
   outputPath = ''
 
@@ -248,22 +319,18 @@ def main(args):
   else:
     common.error("output path not specified.")
   
-  notesdbfile = os.path.join(options.output_path, 'notesdb.sqlite')
-
-  new_database = (not os.path.isfile(notesdbfile))
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   for f in filenames:
-    process_message(f, email_address, sqlconn, sqlcur)
+    f = os.path.realpath(f)
+    if not os.path.isfile(f):
+      print('WARNING! file %s does not exist' % (f,))
+      print('  this message will be skipped.')
+      continue
+    process_message(f, email_address, sqlconn, sqlcur, options.raw, options.on_duplicate)
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -26,32 +26,17 @@ __db_schema_min_version__ = '6'        #Minimum for restore
 global options, gmail
 
 import argparse
-import importlib
 import sys
 import os
 import os.path
-import time
-import calendar
-import random
 import struct
 import platform
 import datetime
-import socket
 import sqlite3
 import ssl
-import email
-import hashlib
-import re
-import string
-from itertools import islice, chain
-import base64
-import json
-import xml.etree.ElementTree as etree
-from urllib.parse import urlencode
-import configparser
-import webbrowser
-
-import httplib2
+
+import notesdb
+import eml2sql
 
 def getGYBVersion(divider="\n"):
   return ('gyb2mbox %s~DIV~%s~DIV~%s - %s~DIV~Python %s.%s.%s %s-bit \
@@ -65,7 +50,7 @@ def SetupOptionParser(argv):
   parser.add_argument('--email',
     dest='email',
     help='Full email address of user or group to act against')
-  action_choices = ['backup','restore', 'restore-group', 'restore-mbox', 'list-files']
+  action_choices = ['backup','restore', 'restore-group', 'restore-mbox', 'list-files', 'load-notes']
   parser.add_argument('--action',
     choices=action_choices,
     dest='action',
@@ -76,6 +61,51 @@ def SetupOptionParser(argv):
     help='Optional: On backup, restore, estimate, local folder to use. \
 Default is GYB-GMail-Backup-<email>',
     default='XXXuse-email-addressXXX')
+  parser.add_argument('--output',
+    dest='output',
+    help='Optional: On load-notes, path to output notes SQLite directory.')
+  parser.add_argument('--after',
+    dest='after',
+    help='Optional: On list-files and load-notes, only messages with an \
+internal date after this date (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS).')
+  parser.add_argument('--before',
+    dest='before',
+    help='Optional: On list-files and load-notes, only messages with an \
+internal date before this date (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS).')
+  parser.add_argument('--label',
+    dest='labels',
+    action='append',
+    default=[],
+    help='Optional: On list-files and load-notes, only messages with this \
+label. May be given more than once.')
+  parser.add_argument('--raw',
+    action='store_true',
+    dest='raw',
+    help='Optional: On load-notes, store notes in their original format \
+(convert later with convertnotes).')
+  parser.add_argument('--on-duplicate',
+    choices=list(notesdb.duplicate_policies.keys()),
+    default='keep-first',
+    dest='on_duplicate',
+    help='Optional: On load-notes, what to do with a note that is already in \
+the notes database: keep-first (skip it), keep-newest (replace the loaded note \
+if this one is newer) or merge-metadata (fill in the fields the loaded note is \
+missing). Default is keep-first.')
+  parser.add_argument('--migrate',
+    action='store_true',
+    dest='migrate',
+    help='Optional: On load-notes, upgrade the notes database if it was \
+created by an older version of the database schema.')
+  parser.add_argument('--db-preset',
+    choices=list(notesdb.db_presets.keys()),
+    default='load',
+    dest='db_preset',
+    help='Optional: On load-notes, SQLite settings for the notes database: \
+load (bulk loading), export (read-mostly) or default. Default is load.')
+  parser.add_argument('--incremental',
+    action='store_true',
+    help='Optional: On load-notes, only load messages newer than the last \
+message loaded into the notes database from this backup.')
   parser.add_argument('--noresume', 
     action='store_true',
     help='Optional: On restores, start from beginning. Default is to resume \
@@ -132,10 +162,105 @@ database schema while GYB %s requires version %s - %s for restores"
 __db_schema_version__))
     sys.exit(4)
  
+def message_file_exists(local_folder, message_filename, dir_cache):
+  # List each backup directory once with os.scandir instead of calling
+  # os.path.isfile for every message
+  path = os.path.join(local_folder, message_filename)
+  dirname, basename = os.path.split(path)
+  names = dir_cache.get(dirname)
+  if names is None:
+    try:
+      with os.scandir(dirname) as it:
+        names = set(entry.name for entry in it if entry.is_file())
+    except FileNotFoundError:
+      names = set()
+    dir_cache[dirname] = names
+  return basename in names
+
+def parse_internaldate(s):
+  # Format dates the same way as message_internaldate is stored
+  if s is None:
+    return None
+  try:
+    return datetime.datetime.fromisoformat(s).strftime('%Y-%m-%d %H:%M:%S')
+  except ValueError:
+    print('ERROR: date %s is not valid.' % (s,))
+    sys.exit(1)
+
+def select_messages(sqlcur, after, before, labels, order, since=None):
+  # since is inclusive: internal dates only have one second resolution, so
+  # messages from the same second as since may not have been loaded yet
+  query = '''SELECT message_num, message_internaldate, \
+      message_filename FROM messages'''
+  conditions = []
+  params = []
+  if after is not None:
+    conditions.append('message_internaldate > ?')
+    params.append(after)
+  if since is not None:
+    conditions.append('message_internaldate >= ?')
+    params.append(since)
+  if before is not None:
+    conditions.append('message_internaldate < ?')
+    params.append(before)
+  if len(labels) > 0:
+    conditions.append('''message_num IN (SELECT message_num FROM labels
+                      WHERE label IN (%s))''' % (', '.join('?' * len(labels)),))
+    params.extend(labels)
+  if len(conditions) > 0:
+    query += ' WHERE ' + ' AND '.join(conditions)
+  query += ' ORDER BY message_internaldate ' + order
+  sqlcur.execute(query, params)
+
+def load_notes(options, sqlcur):
+  # Load messages from the backup straight into the notes database
+  if not options.output:
+    print('ERROR: --output is required.')
+    sys.exit(1)
+
+  outputPath = os.path.abspath(os.path.expanduser(options.output))
+  if not os.path.isdir(outputPath):
+    print('ERROR: output path %s does not exist.' % (outputPath,))
+    sys.exit(3)
+
+  notes_sqlconn, db_settings = notesdb.open_database(outputPath, options.email, __version__, eml2sql.__db_schema_min_version__, eml2sql.__db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
+  notes_sqlcur = notes_sqlconn.cursor()
+
+  # Date of the newest message loaded from this backup
+  last_setting = 'gyb_last_internaldate_%s' % (options.email,)
+
+  after = parse_internaldate(options.after)
+  before = parse_internaldate(options.before)
+  # The messages of the last loaded second are seen again and skipped as
+  # duplicates (notes are unique by hash)
+  since = None
+  if options.incremental and last_setting in db_settings:
+    since = db_settings[last_setting]
+
+  # Oldest first so the last loaded date only moves forward
+  select_messages(sqlcur, after, before, options.labels, 'ASC', since)
+
+  dir_cache = {}
+  for x in sqlcur:
+    message_num, message_internaldate, message_filename = x
+    if not message_file_exists(options.local_folder, message_filename, dir_cache):
+      print('WARNING! file %s does not exist for message %s'
+        % (os.path.join(options.local_folder, message_filename),
+          message_num))
+      print('  this message will be skipped.')
+      continue
+    eml2sql.process_message(os.path.join(options.local_folder, message_filename),
+      options.email, notes_sqlconn, notes_sqlcur, options.raw, options.on_duplicate)
+    notesdb.set_db_setting(notes_sqlconn, last_setting, str(message_internaldate))
+  notes_sqlconn.commit()
+  notes_sqlconn.close()
+
 def main(argv):
   global options
   options = SetupOptionParser(argv)
   if options.debug:
+    import httplib2
     httplib2.debuglevel = 4
   if options.version:
     print(getGYBVersion())
@@ -171,27 +296,29 @@ def main(argv):
 
   # LIST-FILES #
   if options.action == 'list-files':
-    sqlcur.execute('''SELECT message_num, message_internaldate, \
-      message_filename FROM messages
-                      ORDER BY \
-                      message_internaldate DESC''') # All messages
+    after = parse_internaldate(options.after)
+    before = parse_internaldate(options.before)
+    select_messages(sqlcur, after, before, options.labels, 'DESC')
 
-    messages_to_restore_results = sqlcur.fetchall()
+    dir_cache = {}
     current = 0
-    for x in messages_to_restore_results:
+    for x in sqlcur:
       current += 1
       message_filename = x[2]
       message_num = x[0]
-      if not os.path.isfile(os.path.join(options.local_folder,
-        message_filename)):
+      if not message_file_exists(options.local_folder, message_filename, dir_cache):
         print('WARNING! file %s does not exist for message %s'
           % (os.path.join(options.local_folder, message_filename),
-            message_num))
-        print('  this message will be skipped.')
+            message_num), file=sys.stderr)
+        print('  this message will be skipped.', file=sys.stderr)
         continue
       print(os.path.join(options.local_folder, message_filename))
     sqlconn.commit()
 
+  # LOAD-NOTES #
+  elif options.action == 'load-notes':
+    load_notes(options, sqlcur)
+
 if __name__ == '__main__':
   if sys.version_info[0] < 3 or sys.version_info[1] < 6:
     print('ERROR: GYB2EML requires Python 3.6 or greater.')
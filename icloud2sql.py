@@ -7,17 +7,12 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 from datetime import datetime
 
-import hashlib
 import shutil
 
+import concurrent.futures
+
 import notesdb
 import common
 import constants
@@ -60,8 +55,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -75,9 +70,35 @@ def _get_option_parser():
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output SQLite directory")
+    parser.add_option('', "--link-mode",
+                      action="store", dest="link_mode", default="copy",
+                      type="choice", choices=common.LINK_MODES,
+                      help="How attachments are placed in the resources directory (%s)" % (', '.join(common.LINK_MODES),))
+    parser.add_option('', "--copy-threads",
+                      action="store", dest="copy_threads", type="int", default=8,
+                      help="Number of threads used to copy attachments")
+    parser.add_option('', "--workers",
+                      action="store", dest="workers", type="int", default=None,
+                      help="Number of processes used to convert notes (default: number of CPUs)")
+    parser.add_option('', "--batch-size",
+                      action="store", dest="batch_size", type="int", default=1000,
+                      help="Number of notes written per transaction")
+    parser.add_option('', "--raw",
+                      action="store_true", dest="raw", default=False,
+                      help="Store notes in their original format (convert later with convertnotes)")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
-def process_icloud_note(sqlconn, resources_path, columns):
+def process_icloud_note(resources_path, columns, raw=False):
+  # Returns the note columns and the (source, destination) attachment copies
   note_title = columns['note_title']
 
   # note_title
@@ -136,32 +157,33 @@ def process_icloud_note(sqlconn, resources_path, columns):
   first_image  = False
   first_attach = False
   attachment_urls = '\n'
+  copy_jobs = []
   for filepath in note_attachments:
     pathname, filename = os.path.split(filepath)
 
     basename, file_extension = os.path.splitext(filename)
 
-    if os.path.isfile(filepath) == True:
-      unique_id = common.create_uuid_string()
-      output_filepath = os.path.join(resources_path, unique_id+file_extension)
-      shutil.copy2(filepath, output_filepath)
+    # Named by contents so a note loaded again has the same text and hash
+    unique_id = common.create_file_uuid_string(filepath)
+    output_filepath = os.path.join(resources_path, unique_id+file_extension)
+    copy_jobs.append((filepath, output_filepath))
 
-      mime_type, mime_subtype = common.getFileMimeType(filename)
+    mime_type, mime_subtype = common.getFileMimeType(filepath)
 
-      if mime_type != "image" and first_attach == False:
-        first_attach = True
-        # pick first non-image attachment as the Apple note attachment
-        apple_attachment_id = common.format_univesally_unique_identifier(unique_id)
-        apple_attachment_path = output_filepath
-      elif first_image == False:
-        first_image = True
-        # otherwise, pick first image attachment as the Apple note attachment
-        apple_attachment_id = common.format_univesally_unique_identifier(unique_id)
-        apple_attachment_path = output_filepath
+    if mime_type != "image" and first_attach == False:
+      first_attach = True
+      # pick first non-image attachment as the Apple note attachment
+      apple_attachment_id = common.format_univesally_unique_identifier(unique_id)
+      apple_attachment_path = output_filepath
+    elif first_image == False:
+      first_image = True
+      # otherwise, pick first image attachment as the Apple note attachment
+      apple_attachment_id = common.format_univesally_unique_identifier(unique_id)
+      apple_attachment_path = output_filepath
 
-      attachment_urls += '\n'
-      attachment_urls += '[' + filename + ']('
-      attachment_urls += 'file://' + output_filepath + ')\n'
+    attachment_urls += '\n'
+    attachment_urls += '[' + filename + ']('
+    attachment_urls += 'file://' + output_filepath + ')\n'
 
   # update note text with new location of local attachment URLs
 
@@ -170,25 +192,17 @@ def process_icloud_note(sqlconn, resources_path, columns):
   # apple_data
   apple_data = note_data
 
-  markdown_text = ''
-  if note_data_format == 'text/plain':
-    markdown_text = common.text_to_markdown(note_data)
-  elif note_data_format == 'text/html':
-    markdown_text = common.html_to_markdown(note_data)
-  elif note_data_format == 'text/markdown':
-    # no conversion required
-    markdown_text = note_data
+  # note_converter_version
+  note_converter_version = None
 
-  # note_data
-  note_data = markdown_text
-
-  # note_data_format
-  note_data_format = 'text/markdown'
+  if not raw:
+    # convert to markdown (raw notes are converted later by convertnotes)
+    note_data = common.convert_to_markdown(note_data, note_data_format)
+    note_data_format = 'text/markdown'
+    note_converter_version = constants.CONVERTER_VERSION
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   # apple_account_description
   apple_account_description = None
@@ -220,6 +234,7 @@ def process_icloud_note(sqlconn, resources_path, columns):
   columns["note_data"] = note_data
   columns["note_data_format"] = note_data_format
   columns["note_url"] = note_url
+  columns["note_converter_version"] = note_converter_version
   columns["apple_id"] = apple_id
   columns["apple_title"] = apple_title
   columns["apple_snippet"] = apple_snippet
@@ -236,8 +251,83 @@ def process_icloud_note(sqlconn, resources_path, columns):
   columns["apple_user"] = apple_user
   columns["apple_source"] = apple_source
 
-  notesdb.add_apple_note(sqlconn, columns)
-  sqlconn.commit()
+  del columns["note_attachments"]
+
+  return (columns, copy_jobs)
+
+def scandir_list(path):
+  # os.scandir caches the file type of each entry
+  with os.scandir(path) as it:
+    return list(it)
+
+def read_icloud_note(note_folder, note_path):
+  note_internal_date = datetime.now()
+  note_title = os.path.basename(note_path)
+  note_attachments = []
+  note_text_lines = []
+  note_link_lines = []
+  for notepart_entry in scandir_list(note_path):
+    notepart = notepart_entry.name
+    notepartPath = notepart_entry.path
+    if notepart_entry.is_dir() == True:
+      if notepart == "Attachments":
+        # attachments
+        for attachment_entry in scandir_list(notepartPath):
+          if attachment_entry.is_file() == True:
+            note_attachments.append(attachment_entry.path)
+    elif notepart_entry.is_file() == True:
+      if notepart == "Links.txt":
+        # links
+        with open(notepartPath, 'r') as fp:
+          for line in fp:
+            note_link_lines.append(line)
+      elif notepart.split('.')[-1] == "txt":
+        # note created date
+        try:
+          note_internal_date = datetime.strptime(notepart[-24:-4], '%Y-%m-%dT%H/%M/%SZ')
+        except ValueError as ve:
+          try:
+            note_internal_date = datetime.strptime(notepart[-24:-4], '%Y-%m-%dT%H:%M:%SZ')
+          except ValueError as ve:
+            note_internal_date = datetime.now()
+        # note text
+        with open(notepartPath, 'r') as fp:
+          for line in fp:
+            note_text_lines.append(line)
+  all_lines = note_text_lines
+  all_lines.append('\n')
+  all_lines.extend(note_link_lines)
+  note_data = ''.join(all_lines)
+
+  columns = {}
+  columns["note_attachments"] = note_attachments # not stored in database
+  columns["note_type"] = "note"
+  columns["note_uuid"] = None
+  columns["note_parent_uuid"] = None
+  columns["note_original_format"] = None
+  columns["note_internal_date"] = note_internal_date
+  columns["note_hash"] = None
+  columns["note_title"] = note_title
+  columns["note_url"] = None
+  columns["note_data"] = note_data
+  columns["note_data_format"] = None
+  columns["apple_folder"] = note_folder
+  return columns
+
+def load_icloud_note(task):
+  # Runs in a worker process
+  resources_path, note_folder, note_path, raw = task
+  return process_icloud_note(resources_path, read_icloud_note(note_folder, note_path), raw)
+
+def icloud_note_tasks(input_path, resources_path, raw):
+  for folder_entry in scandir_list(input_path):
+    if folder_entry.is_dir() == True:
+      # a note folder
+      note_folder = folder_entry.name
+      for note_entry in scandir_list(folder_entry.path):
+        if note_entry.is_dir() == True:
+          # a note
+          yield (resources_path, note_folder, note_entry.path, raw)
 
 def main(args):
   parser = _get_option_parser()
@@ -274,85 +364,52 @@ def main(args):
   
   outputResourcesPath = os.path.join(outputPath, 'resources')
 
-  notesdbfile = os.path.join(options.output_path, 'notesdb.sqlite')
 
-  new_database = (not os.path.isfile(notesdbfile))
-
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-    
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   # Create SQLite resources directory
   if not os.path.isdir(outputResourcesPath):
     os.makedirs(outputResourcesPath)
 
-  for filename in os.listdir(inputPath):
-    filePath = os.path.join(inputPath, filename)
-    if os.path.isdir(filePath) == True:
-      # a note folder
-      note_folder = filename
-      for note in os.listdir(filePath):
-        notePath = os.path.join(filePath, note)
-        if os.path.isdir(notePath) == True:
-          # a note
-          note_internal_date = datetime.now()
-          note_title = note
-          note_attachments = []
-          note_text_lines = []
-          note_link_lines = []
-          for notepart in os.listdir(notePath):
-            notepartPath = os.path.join(notePath, notepart)
-            if os.path.isdir(notepartPath) == True:
-              if notepart == "Attachments":
-                # attachments
-                for attachment in os.listdir(notepartPath):
-                  attachmentPath = os.path.join(notepartPath, attachment)
-                  note_attachments.append(attachmentPath)
-            elif os.path.isfile(notepartPath) == True:
-              if notepart == "Links.txt":
-                # links
-                with open(notepartPath, 'r') as fp:
-                  for line in fp:
-                    note_link_lines.append(line)
-              elif notepart.split('.')[-1] == "txt":
-                # note created date
-                try:
-                  note_internal_date = datetime.strptime(notepart[-24:-4], '%Y-%m-%dT%H/%M/%SZ')
-                except ValueError as ve:
-                  try:
-                    note_internal_date = datetime.strptime(notepart[-24:-4], '%Y-%m-%dT%H:%M:%SZ')
-                  except ValueError as ve:
-                    note_internal_date = datetime.now()
-                # note text
-                with open(notepartPath, 'r') as fp:
-                  for line in fp:
-                    note_text_lines.append(line)
-          all_lines = note_text_lines
-          all_lines.append('\n')
-          all_lines.extend(note_link_lines)
-          note_data = ''.join(all_lines)
-
-          columns = {}
-          columns["note_attachments"] = note_attachments # not stored in database
-          columns["note_type"] = "note"
-          columns["note_uuid"] = None
-          columns["note_parent_uuid"] = None
-          columns["note_original_format"] = None
-          columns["note_internal_date"] = note_internal_date
-          columns["note_hash"] = None
-          columns["note_title"] = note_title
-          columns["note_url"] = None
-          columns["note_data"] = note_data
-          columns["note_data_format"] = None
-          columns["apple_folder"] = note_folder
-
-          process_icloud_note(sqlconn, outputResourcesPath, columns)
+  first_note_id = notesdb.max_note_id(sqlcur)
+
+  writer = notesdb.BatchWriter(sqlconn, options.batch_size, options.on_duplicate)
+
+  copy_futures = {}
+  changed_note_ids = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=options.copy_threads) as copy_executor:
+    tasks = icloud_note_tasks(inputPath, outputResourcesPath, options.raw)
+    for columns, copy_jobs in common.parallel_map(load_icloud_note, tasks, options.workers):
+      note_id = writer.add(notesdb.add_apple_note, columns)
+      if note_id is not None and note_id <= first_note_id:
+        # A loaded note replaced or merged into (--on-duplicate)
+        changed_note_ids.append(note_id)
+      # The attachments of a duplicate note are copied too in case an earlier
+      # run stopped before copying them
+      for filepath, output_filepath in copy_jobs:
+        if output_filepath in copy_futures or os.path.exists(output_filepath):
+          # Another note has an attachment with the same contents
+          continue
+        copy_futures[output_filepath] = copy_executor.submit(common.copy_resource_file, filepath, output_filepath, options.link_mode)
+
+    writer.close()
+
+    # Wait for the attachment copies to finish
+    failed = 0
+    for output_filepath, future in copy_futures.items():
+      try:
+        future.result()
+      except OSError as e:
+        print('WARNING! attachment %s could not be copied (%s)' % (output_filepath, e))
+        failed += 1
+
+  # Index the attachments referenced by the new and changed notes
+  notesdb.index_note_resources(sqlconn, outputResourcesPath, first_note_id, changed_note_ids)
+
+  if failed > 0:
+    common.error("%d attachments could not be copied (run again to copy them)." % (failed,))
 
 if __name__ == "__main__":
   main(sys.argv[1:])
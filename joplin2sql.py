@@ -7,15 +7,8 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 from datetime import datetime
 
-import hashlib
 import shutil
 
 import notesdb
@@ -60,8 +53,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -75,9 +68,18 @@ def _get_option_parser():
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output SQLite directory")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
-def process_joplin_note(sqlconn, resources_path, columns):
+def process_joplin_note(sqlconn, resource_index, columns, on_duplicate):
   note_title = columns['note_title']
 
   # note_title
@@ -105,10 +107,8 @@ def process_joplin_note(sqlconn, resources_path, columns):
   # note_data_format
   note_data_format = 'text/markdown'
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   # apple_id
   apple_id = None
@@ -140,25 +140,22 @@ def process_joplin_note(sqlconn, resources_path, columns):
   apple_attachment_path = None
 
   # Get resource attachments
-  lines = note_data.split()
-  links = common.getResourceLinks(lines)
+  resources = common.getNoteResources(note_data, resource_index)
   first_image = False
-  for url, filename, resource in links:
-    matches = common.getResourceFileName(resources_path, resource)
-    if len(matches) > 0:
-      filename = matches[0]
-      mime_type, mime_subtype = common.getFileMimeType(filename)
+  for resource, resource_path, mime, size in resources:
+    if resource_path is not None and resource_index.size(resource_path) is not None:
+      mime_type, mime_subtype = mime.split('/', 1)
 
       if mime_type != "image":
         # pick first non-image attachment as the Apple note attachment
         apple_attachment_id = common.format_univesally_unique_identifier(resource)
-        apple_attachment_path = os.path.join(resources_path, filename)
+        apple_attachment_path = resource_path
         break
       elif first_image == False:
         first_image = True
         # otherwise, pick first image attachment as the Apple note attachment
         apple_attachment_id = common.format_univesally_unique_identifier(resource)
-        apple_attachment_path = os.path.join(resources_path, filename)
+        apple_attachment_path = resource_path
 
   # apple_account_description
   apple_account_description = None
@@ -201,7 +198,9 @@ def process_joplin_note(sqlconn, resources_path, columns):
   columns["apple_user"] = apple_user
   columns["apple_source"] = apple_source
 
-  notesdb.add_joplin_note(sqlconn, columns)
+  note_id = notesdb.add_joplin_note(sqlconn, columns, on_duplicate)
+  if note_id is not None:
+    notesdb.set_note_resources(sqlconn, note_id, resources)
   sqlconn.commit()
 
 def parse_joplin_note(filePath):
@@ -291,29 +290,24 @@ def main(args):
 
   outputResourcesPath = os.path.join(outputPath, 'resources')
 
-  notesdbfile = os.path.join(outputPath, 'notesdb.sqlite')
-
-  new_database = (not os.path.isfile(notesdbfile))
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-    
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   # Create SQLite resources directory
   if not os.path.isdir(outputResourcesPath):
     os.makedirs(outputResourcesPath)
 
+  # Index the SQLite resources directory once instead of listing it for every link
+  resource_index = common.ResourceIndex(outputResourcesPath)
+
   # Copy resources from Joplin resources directory to SQLite resources directory
   for filename in os.listdir(inputResourcesPath):
-    filePath = os.path.join(inputPath, filename)
+    filePath = os.path.join(inputResourcesPath, filename)
     if os.path.isfile(filePath) == True:
       shutil.copy2(filePath, outputResourcesPath)
+      resource_index.add(filename)
 
   # Parse Joplin notes
   for filename in os.listdir(inputPath):
@@ -325,7 +319,7 @@ def main(args):
           parentPath = os.path.join(inputPath, columns['joplin_parent_id'] + '.md')
           parent_columns = parse_joplin_note(parentPath)
           columns["apple_folder"] = parent_columns['note_title']
-      process_joplin_note(sqlconn, outputResourcesPath, columns)
+      process_joplin_note(sqlconn, resource_index, columns, options.on_duplicate)
 
 if __name__ == "__main__":
   main(sys.argv[1:])
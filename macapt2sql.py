@@ -7,16 +7,8 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 from datetime import datetime
 
-import hashlib
-
 import notesdb
 import common
 import constants
@@ -59,8 +51,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -80,9 +72,149 @@ def _get_option_parser():
     parser.add_option("", "--exclude",
                       action="store", dest="exclude_folders", default=None,
                       help="Folder names to exclude from folder name override")
+    parser.add_option('', "--workers",
+                      action="store", dest="workers", type="int", default=None,
+                      help="Number of processes used to convert notes (default: number of CPUs)")
+    parser.add_option('', "--batch-size",
+                      action="store", dest="batch_size", type="int", default=1000,
+                      help="Number of notes written per transaction")
+    parser.add_option('', "--raw", "--no-convert",
+                      action="store_true", dest="no_convert", default=False,
+                      help="Copy notes in their original format (convert later with convertnotes)")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
-def process_apple_note(sqlconn, columns):
+def apple_internal_date(last_modified):
+  # Stored the same way as the sqlite3 datetime adapter
+  try:
+    note_internal_date = datetime.strptime(last_modified, "%Y-%m-%d %H:%M:%S.%f")
+  except (TypeError, ValueError):
+    note_internal_date = datetime.now()
+  return note_internal_date.isoformat(" ")
+
+def apple_note_title(title):
+  if title is None:
+    return "New Note"
+  return common.remove_line_breakers(title).strip()
+
+def copy_apple_notes(sqlconn, macosdbfile, merge_folder, exclude_merge, on_duplicate):
+  # Copy notes without converting them to markdown using INSERT ... SELECT
+  # statements from the attached mac_apt database
+  sqlconn.create_function('apple_note_format', 1, common.sniff_note_format, deterministic=True)
+  sqlconn.create_function('apple_internal_date', 1, apple_internal_date)
+  sqlconn.create_function('apple_note_title', 1, apple_note_title, deterministic=True)
+
+  sqlconn.execute('''ATTACH DATABASE ? AS macapt;''', (macosdbfile,))
+
+  exclude_params = ', '.join('?' * len(exclude_merge))
+
+  # Hash and date of each note, computed once
+  sqlconn.execute('''DROP TABLE IF EXISTS temp.macapt_notes;''')
+  sqlconn.execute('''CREATE TEMP TABLE macapt_notes AS SELECT
+  rowid AS source_id,
+  apple_internal_date(LastModified) AS note_internal_date,
+  note_fingerprint(Data) AS note_hash FROM macapt.Notes;''')
+  sqlconn.execute('''CREATE INDEX temp.macapt_notes_hash ON macapt_notes (note_hash);''')
+
+  # Notes already in the database (or earlier in the mac_apt database) are
+  # rejected, replaced or merged into by hash in rowid order
+  written = sqlconn.execute('''INSERT INTO notes (
+  note_type,
+  note_original_format,
+  note_internal_date,
+  note_hash,
+  note_title,
+  note_data,
+  note_data_format) SELECT
+  'note',
+  'apple',
+  s.note_internal_date,
+  s.note_hash,
+  apple_note_title(m.Title),
+  note_compress(COALESCE(m.Data, '')),
+  apple_note_format(m.Data) FROM temp.macapt_notes AS s
+  JOIN macapt.Notes AS m ON m.rowid = s.source_id
+  WHERE true ORDER BY s.source_id
+  %s %s RETURNING note_id, note_hash;''' % (notesdb.NOTE_CONFLICT_TARGET, notesdb.duplicate_policies[on_duplicate])).fetchall()
+
+  # Notes whose side table rows are written
+  sqlconn.execute('''DROP TABLE IF EXISTS temp.macapt_written;''')
+  sqlconn.execute('''CREATE TEMP TABLE macapt_written (note_id INTEGER PRIMARY KEY, note_hash BLOB);''')
+  if on_duplicate == "merge-metadata":
+    # Every note with the hash of a copied note, changed or not
+    sqlconn.execute('''INSERT INTO temp.macapt_written (note_id, note_hash) SELECT notes.note_id, notes.note_hash FROM notes
+WHERE notes.note_type = 'note' AND notes.note_hash IN (SELECT note_hash FROM temp.macapt_notes);''')
+  else:
+    sqlconn.executemany('''INSERT OR IGNORE INTO temp.macapt_written (note_id, note_hash) VALUES (?, ?);''', written)
+  if on_duplicate == "keep-newest":
+    for table_name in notesdb.sideTables:
+      sqlconn.execute('''DELETE FROM %s WHERE note_id IN (SELECT note_id FROM temp.macapt_written);''' % (table_name,))
+
+  # The row that won for each hash comes first: the newest for keep-newest,
+  # otherwise the first copied (merge-metadata merges all of them in order)
+  order = '''s.source_id'''
+  if on_duplicate == "keep-newest":
+    order = '''s.note_internal_date DESC, s.source_id'''
+
+  # apple_data is the same as note_data so it is not stored
+  apple_columns = notesdb.appleColumns[:-1]
+  side_written = sqlconn.execute('''INSERT INTO note_apple (
+  note_id,
+  apple_id,
+  apple_title,
+  apple_snippet,
+  apple_folder,
+  apple_created,
+  apple_last_modified,
+  apple_attachment_id,
+  apple_attachment_path,
+  apple_account_description,
+  apple_account_identifier,
+  apple_account_username,
+  apple_version,
+  apple_user,
+  apple_source) SELECT
+  w.note_id,
+  m.ID,
+  m.Title,
+  m.Snippet,
+  CASE WHEN ? IS NULL OR m.Folder IN (%s) THEN m.Folder ELSE ? END,
+  m.Created,
+  m.LastModified,
+  m.AttachmentID,
+  m.AttachmentPath,
+  m.AccountDescription,
+  m.AccountIdentifier,
+  m.AccountUsername,
+  m.Version,
+  m.User,
+  m.Source FROM temp.macapt_written AS w
+  JOIN temp.macapt_notes AS s ON s.note_hash = w.note_hash
+  JOIN macapt.Notes AS m ON m.rowid = s.source_id
+  WHERE true ORDER BY %s
+  %s RETURNING note_id;''' % (exclude_params, order, notesdb.side_conflict_sql("note_apple", apple_columns, on_duplicate)),
+    [merge_folder] + exclude_merge + [merge_folder]).fetchall()
+
+  # Notes copied that did not add or change a note
+  changed = set([row[0] for row in written] + [row[0] for row in side_written])
+  duplicates = sqlconn.execute('''SELECT COUNT(*) FROM temp.macapt_notes;''').fetchone()[0] - len(changed)
+  sqlconn.commit()
+  sqlconn.execute('''DROP TABLE temp.macapt_written;''')
+  sqlconn.execute('''DROP TABLE temp.macapt_notes;''')
+  sqlconn.execute('''DETACH DATABASE macapt;''')
+  if duplicates > 0:
+    print("%d duplicate notes not added (%s)" % (duplicates, on_duplicate))
+
+def process_apple_note(columns):
+  # Runs in a worker process
   # note_title
   if columns["apple_title"] is None:
     note_title = "New Note"
@@ -106,24 +238,10 @@ def process_apple_note(sqlconn, columns):
     note_data = ''
 
   # note_data_format
-  if note_data.find('<http') != -1:
-    note_data_format = 'text/markdown'
-  elif note_data.find('<div') != -1 or note_data.find('<span') != -1 or note_data.find('<html>') != -1:
-    note_data_format = 'text/html'
-  else:
-    note_data_format = 'text/plain'
-
-  markdown_text = ''
-  if note_data_format == 'text/plain':
-    markdown_text = common.text_to_markdown(note_data)
-  elif note_data_format == 'text/html':
-    markdown_text = common.html_to_markdown(note_data)
-  elif note_data_format == 'text/markdown':
-    # no conversion required
-    markdown_text = note_data
+  note_data_format = common.sniff_note_format(note_data)
 
   # note_data
-  note_data = markdown_text
+  note_data = common.convert_to_markdown(note_data, note_data_format)
 
   # note_data_format
   note_data_format = 'text/markdown'
@@ -131,10 +249,8 @@ def process_apple_note(sqlconn, columns):
   # NOTE: BeautifulSoup loses URL for <a href="url">text</a>
   #       when converting HTML to plain text
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   columns["note_original_format"] = note_original_format
   columns["note_internal_date"] = note_internal_date
@@ -143,9 +259,59 @@ def process_apple_note(sqlconn, columns):
   columns["note_url"] = None
   columns["note_data"] = note_data
   columns["note_data_format"] = note_data_format
+  columns["note_converter_version"] = constants.CONVERTER_VERSION
 
-  notesdb.add_apple_note(sqlconn, columns)
-  sqlconn.commit()
+  return columns
+
+def fetch_rows(cursor, size=500):
+  # Stream rows instead of loading the whole table with fetchall()
+  while True:
+    rows = cursor.fetchmany(size)
+    if len(rows) == 0:
+      break
+    for row in rows:
+      yield row
+
+def note_columns(rows, merge_folder, exclude_merge):
+  for row in rows:
+    apple_folder = row['Folder']
+
+    if merge_folder is not None:
+      if apple_folder in exclude_merge:
+        pass
+      else:
+        # merge folder
+        apple_folder = merge_folder
+
+    columns = {}
+    columns["note_type"] = "note"
+    columns["note_uuid"] = None
+    columns["note_parent_uuid"] = None
+    columns["note_tag_uuid"] = None
+    columns["note_note_uuid"] = None
+    columns["note_original_format"] = None
+    columns["note_internal_date"] = None
+    columns["note_hash"] = None
+    columns["note_title"] = None
+    columns["note_url"] = None
+    columns["note_data"] = None
+    columns["note_data_format"] = None
+    columns["apple_id"] = row['ID']
+    columns["apple_title"] = row['Title']
+    columns["apple_snippet"] = row['Snippet']
+    columns["apple_folder"] = apple_folder
+    columns["apple_created"] = row['Created']
+    columns["apple_last_modified"] = row['LastModified']
+    columns["apple_data"] = row['Data']
+    columns["apple_attachment_id"] = row['AttachmentID']
+    columns["apple_attachment_path"] = row['AttachmentPath']
+    columns["apple_account_description"] = row['AccountDescription']
+    columns["apple_account_identifier"] = row['AccountIdentifier']
+    columns["apple_account_username"] = row['AccountUsername']
+    columns["apple_version"] = row['Version']
+    columns["apple_user"] = row['User']
+    columns["apple_source"] = row['Source']
+    yield columns
 
 def main(args):
   parser = _get_option_parser()
@@ -191,27 +357,27 @@ def main(args):
 
   macosdbfile = os.path.join(inputPath, 'mac_apt.db')
 
-  notesdbfile = os.path.join(outputPath, 'notesdb.sqlite')
+  outputResourcesPath = os.path.join(outputPath, 'resources')
 
   if not os.path.isfile(macosdbfile):
     common.error("input file does not exist")
 
-  new_database = (not os.path.isfile(notesdbfile))
-
   macos_sqlconn = sqlite3.connect(macosdbfile,
     detect_types=sqlite3.PARSE_DECLTYPES)
   macos_sqlconn.row_factory = sqlite3.Row
   macos_sqlcur = macos_sqlconn.cursor()
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
+  first_note_id = notesdb.max_note_id(sqlcur)
 
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
+  if options.no_convert:
+    copy_apple_notes(sqlconn, macosdbfile, merge_folder, exclude_merge, options.on_duplicate)
+    # Index the attachments referenced by the new notes
+    notesdb.index_note_resources(sqlconn, outputResourcesPath, first_note_id)
+    return
 
   macos_sqlcur.execute('''SELECT ID,
 Title,
@@ -229,51 +395,20 @@ Version,
 User,
 Source FROM Notes''')
 
-  notes_to_convert_results = macos_sqlcur.fetchall()
-  current = 0
-  for row in notes_to_convert_results:
-    apple_folder = row['Folder']
+  writer = notesdb.BatchWriter(sqlconn, options.batch_size, options.on_duplicate)
 
-    if merge_folder is not None:
-      if apple_folder in exclude_merge:
-        pass
-      else:
-        # merge folder
-        apple_folder = merge_folder
+  changed_note_ids = []
+  rows = note_columns(fetch_rows(macos_sqlcur), merge_folder, exclude_merge)
+  for columns in common.parallel_map(process_apple_note, rows, options.workers):
+    note_id = writer.add(notesdb.add_apple_note, columns)
+    if note_id is not None and note_id <= first_note_id:
+      # A loaded note replaced or merged into (--on-duplicate)
+      changed_note_ids.append(note_id)
 
-    current += 1
-    columns = {}
-    columns["note_type"] = "note"
-    columns["note_uuid"] = None
-    columns["note_parent_uuid"] = None
-    columns["note_tag_uuid"] = None
-    columns["note_note_uuid"] = None
-    columns["note_original_format"] = None
-    columns["note_internal_date"] = None
-    columns["note_hash"] = None
-    columns["note_title"] = None
-    columns["note_url"] = None
-    columns["note_data"] = None
-    columns["note_data_format"] = None
-    columns["apple_id"] = row['ID']
-    columns["apple_title"] = row['Title']
-    columns["apple_snippet"] = row['Snippet']
-    columns["apple_folder"] = apple_folder
-    columns["apple_created"] = row['Created']
-    columns["apple_last_modified"] = row['LastModified']
-    columns["apple_data"] = row['Data']
-    columns["apple_attachment_id"] = row['AttachmentID']
-    columns["apple_attachment_path"] = row['AttachmentPath']
-    columns["apple_account_description"] = row['AccountDescription']
-    columns["apple_account_identifier"] = row['AccountIdentifier']
-    columns["apple_account_username"] = row['AccountUsername']
-    columns["apple_version"] = row['Version']
-    columns["apple_user"] = row['User']
-    columns["apple_source"] = row['Source']
+  writer.close()
 
-    process_apple_note(sqlconn, columns)
- 
-  sqlconn.commit()
+  # Index the attachments referenced by the new and changed notes
+  notesdb.index_note_resources(sqlconn, outputResourcesPath, first_note_id, changed_note_ids)
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -1,4 +1,3 @@
-import regex
 import re
 import os
 import argparse
@@ -8,12 +7,6 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 import hashlib
 
 import mailbox
@@ -0,0 +1,121 @@
+import re
+import os
+import argparse
+import sys
+import errno
+import optparse
+import sqlite3
+
+import notesdb
+import constants
+import common
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program upgrades a notes database to the current version of the
+# database schema.
+#
+
+global __name__, __author__, __email__, __version__, __license__
+__program_name__ = 'migratedb'
+__author__ = 'Rene Sugar'
+__email__ = 'rene.sugar@gmail.com'
+__version__ = '1.00'
+__license__ = 'MIT License (https://opensource.org/licenses/MIT)'
+__website__ = 'https://github.com/renesugar'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '1'
+
+def _get_option_parser():
+    parser = optparse.OptionParser('%prog [options]',
+                                   version='%prog ' + __version__)
+    parser.add_option('', "--email",
+                      action="store", dest="email_address", default=None,
+                      help="Email address")
+    parser.add_option("", "--input",
+                      action="store", dest="input_path", default=[],
+                      help="Path to input SQLite directory")
+    parser.add_option('', "--vacuum",
+                      action="store_true", dest="vacuum", default=False,
+                      help="Rebuild the database file after upgrading it to reclaim unused space")
+    parser.add_option('', "--chunk-size",
+                      action="store", dest="chunk_size", type="int", default=10000,
+                      help="Number of notes copied or compressed per transaction")
+    parser.add_option('', "--compression",
+                      action="store", dest="compression", type="choice", choices=["none"] + list(notesdb.compression_codecs.keys()), default=None,
+                      help="Compress the text of notes with zlib or zstd (needs the zstandard module), or store it uncompressed with none. Notes loaded later are stored the same way")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
+    return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  email_address = ''
+  if hasattr(options, 'email_address') and options.email_address:
+    email_address = options.email_address
+    if common.check_email_address(email_address) == False:
+      # Check if email address is valid
+      common.error("email address '%s' is not valid." % (email_address,))
+  else:
+    common.error("email address not specified.")
+
+  inputPath = ''
+
+  if hasattr(options, 'input_path') and options.input_path:
+    inputPath = os.path.abspath(os.path.expanduser(options.input_path))
+    if os.path.isdir(inputPath) == False:
+      # Check if input directory exists
+      common.error("input path '%s' does not exist." % (inputPath,))
+  else:
+    common.error("input path not specified.")
+
+
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=False, preset=options.db_preset)
+  sqlcur = sqlconn.cursor()
+
+  if notesdb.db_version(db_settings['db_version']) < notesdb.db_version(__db_schema_version__):
+    notesdb.migrate_database(sqlconn, __db_schema_version__, options.chunk_size)
+  else:
+    print("database is already at version %s" % (db_settings['db_version'],))
+
+  if options.compression is not None:
+    notesdb.compress_database(sqlconn, options.compression, options.chunk_size)
+
+  if options.vacuum:
+    print("vacuuming database...")
+    sqlconn.execute('''VACUUM;''')
+
+  sqlconn.close()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
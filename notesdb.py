@@ -2,8 +2,11 @@ import os
 import argparse
 import sys
 import sqlite3
+import zlib
+import codecs
 
 import constants
+import common
 
 #
 # MIT License
@@ -98,6 +101,243 @@ joplinColumnTypes = [
 	"TEXT"
 ]
 
+# Columns of the notes table other than note_id (schema version 2)
+
+coreColumns = [
+  "note_type",
+  "note_uuid",
+  "note_parent_uuid",
+  "note_tag_uuid",
+  "note_note_uuid",
+  "note_original_format",
+  "note_internal_date",
+  "note_hash",
+  "note_title",
+  "note_converter_version",
+  "note_url",
+  "note_data_format",
+  "note_data"
+]
+
+# Per-origin side tables (schema version 2)
+
+sideTables = ["note_email", "note_apple", "note_joplin"]
+
+# Columns of the per-origin side tables (schema version 2)
+
+emailColumns = [
+  "email_filename",
+  "email_from",
+  "email_x_uniform_type_identifier",
+  "email_content_type",
+  "email_content_transfer_encoding",
+  "email_mime_version",
+  "email_date",
+  "email_x_mail_created_date",
+  "email_subject",
+  "email_x_universally_unique_identifier",
+  "email_message_id",
+  "email_body"
+]
+
+appleColumns = [
+  "apple_id",
+  "apple_title",
+  "apple_snippet",
+  "apple_folder",
+  "apple_created",
+  "apple_last_modified",
+  "apple_attachment_id",
+  "apple_attachment_path",
+  "apple_account_description",
+  "apple_account_identifier",
+  "apple_account_username",
+  "apple_version",
+  "apple_user",
+  "apple_source",
+  "apple_data"
+]
+
+appleColumnTypes = [
+  "INTEGER",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT",
+  "TEXT"
+]
+
+# Columns holding the (often large) text of a note. A value is stored
+# either as text or, when the database is compressed (the compression
+# setting), as a BLOB starting with a byte naming the codec, so each row
+# records how it is stored. Read them with note_text() in SQL.
+
+compressedColumns = [("notes", "note_data"), ("note_email", "email_body"), ("note_apple", "apple_data")]
+
+compression_codecs = {
+  "zlib": b'\x01',
+  "zstd": b'\x02'
+}
+
+# Text shorter than this (in bytes) is stored as it is
+COMPRESS_MIN_SIZE = 512
+
+def _zstandard():
+  # zstd needs the zstandard module, which is optional
+  try:
+    import zstandard
+  except ImportError:
+    common.error("zstd compression requires the zstandard module (pip install zstandard)")
+  return zstandard
+
+def compress_text(text, compression):
+  # Returns the value stored for text with compression ("none", "zlib" or
+  # "zstd"), which is the text itself if compressing it does not help
+  if text is None or compression == "none":
+    return text
+  data = text.encode('utf-8')
+  if len(data) < COMPRESS_MIN_SIZE:
+    return text
+  if compression == "zlib":
+    compressed = zlib.compress(data, 6)
+  else:
+    compressed = _zstandard().ZstdCompressor(level=3).compress(data)
+  if len(compressed) + 1 >= len(data):
+    return text
+  return compression_codecs[compression] + compressed
+
+def decompress_text(value):
+  # Returns the text of a value stored by compress_text
+  if not isinstance(value, bytes):
+    return value
+  codec = value[:1]
+  if codec == compression_codecs["zlib"]:
+    data = zlib.decompress(value[1:])
+  elif codec == compression_codecs["zstd"]:
+    data = _zstandard().ZstdDecompressor().decompress(value[1:])
+  else:
+    common.error("note text is stored in an unknown format")
+  return data.decode('utf-8')
+
+def text_size(value):
+  # Returns the size in bytes of the text of a value stored by
+  # compress_text, decompressing it a chunk at a time to count it
+  if value is None:
+    return None
+  if not isinstance(value, bytes):
+    return len(value.encode('utf-8'))
+  codec = value[:1]
+  size = 0
+  if codec == compression_codecs["zlib"]:
+    decompressor = zlib.decompressobj()
+    data = value[1:]
+    while data:
+      size += len(decompressor.decompress(data, common.STREAMING_CHUNK_SIZE))
+      data = decompressor.unconsumed_tail
+    size += len(decompressor.flush())
+  elif codec == compression_codecs["zstd"]:
+    reader = _zstandard().ZstdDecompressor().stream_reader(value[1:])
+    data = reader.read(common.STREAMING_CHUNK_SIZE)
+    while data:
+      size += len(data)
+      data = reader.read(common.STREAMING_CHUNK_SIZE)
+  else:
+    common.error("note text is stored in an unknown format")
+  return size
+
+def text_size_sql(column_name):
+  # SQL for the size in bytes of the text of a column. Text is measured by
+  # SQLite so that a large value is not passed to Python to be measured.
+  return '''(CASE typeof(%s) WHEN 'blob' THEN note_size(%s) ELSE length(CAST(%s AS BLOB)) END)''' % (column_name, column_name, column_name)
+
+def iter_text(sqlconn, table_name, column_name, rowid, chunk_size=common.STREAMING_CHUNK_SIZE):
+  # Yields the text of a value stored by compress_text in chunks, reading
+  # it with blob I/O so the whole value is never in memory at once
+  sqlcur = sqlconn.cursor()
+  sqlcur.execute('''SELECT typeof("%s") FROM "%s" WHERE rowid = ?''' % (column_name, table_name), (rowid,))
+  row = sqlcur.fetchone()
+  if row is None or row[0] == 'null':
+    return
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  with sqlconn.blobopen(table_name, column_name, rowid, readonly=True) as blob:
+    if row[0] != 'blob':
+      # text values are read as their utf-8 bytes
+      data = blob.read(chunk_size)
+      while data:
+        yield decoder.decode(data)
+        data = blob.read(chunk_size)
+      yield decoder.decode(b'', final=True)
+      return
+    codec = blob.read(1)
+    if codec == compression_codecs["zlib"]:
+      decompressor = zlib.decompressobj()
+      data = blob.read(chunk_size)
+      while data:
+        while data:
+          yield decoder.decode(decompressor.decompress(data, chunk_size))
+          data = decompressor.unconsumed_tail
+        data = blob.read(chunk_size)
+      yield decoder.decode(decompressor.flush(), final=True)
+    elif codec == compression_codecs["zstd"]:
+      reader = _zstandard().ZstdDecompressor().stream_reader(blob)
+      data = reader.read(chunk_size)
+      while data:
+        yield decoder.decode(data)
+        data = reader.read(chunk_size)
+      yield decoder.decode(b'', final=True)
+    else:
+      common.error("note text is stored in an unknown format")
+
+def create_text_functions(sqlconn, compression):
+  # note_compress(text) is the value to store in a compressed column,
+  # note_text(value) is the text of a stored value and note_size(value) is
+  # the size of that text in bytes
+  sqlconn.create_function('note_compress', 1, lambda text: compress_text(text, compression), deterministic=True)
+  sqlconn.create_function('note_text', 1, decompress_text, deterministic=True)
+  sqlconn.create_function('note_size', 1, text_size, deterministic=True)
+
+# What a loader does with a note whose note_hash is already in the
+# database (--on-duplicate): keep-first rejects it, keep-newest replaces the
+# loaded note and its side table rows if the new note is newer and
+# merge-metadata fills in the columns the loaded note is missing. The text
+# of the note is the same either way.
+
+NOTE_CONFLICT_TARGET = '''ON CONFLICT (note_hash) WHERE note_type = 'note' '''
+
+_replacedColumns = [name for name in coreColumns if name not in ["note_type", "note_hash", "note_data", "note_data_format"]]
+
+def _merge_sql(table_name, column_names):
+  # Sets the NULL columns of the row in table_name, only updating the row
+  # if one of them has a value in the new row
+  return '''DO UPDATE SET %s WHERE %s''' % (
+    ', '.join(['''%s = COALESCE("%s".%s, excluded.%s)''' % (name, table_name, name, name) for name in column_names]),
+    ' OR '.join(['''("%s".%s IS NULL AND excluded.%s IS NOT NULL)''' % (table_name, name, name) for name in column_names]))
+
+duplicate_policies = {
+  "keep-first": '''DO NOTHING''',
+  "keep-newest": '''DO UPDATE SET %s WHERE excluded.note_internal_date > notes.note_internal_date'''
+    % (', '.join(['''%s = excluded.%s''' % (name, name) for name in _replacedColumns]),),
+  "merge-metadata": _merge_sql("notes", _replacedColumns)
+}
+
+def side_conflict_sql(table_name, column_names, on_duplicate):
+  # Conflict clause for adding the side table row of a note. Only
+  # merge-metadata adds to an existing row (keep-newest deletes the rows of
+  # a note it replaces). apple_data NULL means "same as note_data" so it is
+  # never merged.
+  if on_duplicate == "merge-metadata":
+    return '''ON CONFLICT (note_id) %s''' % (_merge_sql(table_name, [name for name in column_names if name != "apple_data"]),)
+  return '''ON CONFLICT (note_id) DO NOTHING'''
+
 def create_database(sqlconn, db_schema_version, email_address):
   print("creating database...")
   sqlconn.execute('''CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT);''')
@@ -105,7 +345,19 @@ def create_database(sqlconn, db_schema_version, email_address):
        ('email_address', email_address))
   sqlconn.execute('''INSERT INTO settings (name, value) VALUES (?, ?);''',
        ('db_version', db_schema_version))
-  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "notes" (
+  create_notes_table(sqlconn, "notes")
+  create_side_tables(sqlconn)
+  create_notes_indexes(sqlconn, "notes")
+  create_search_index(sqlconn)
+  create_note_resources_table(sqlconn)
+  create_url_titles_table(sqlconn)
+  # notes added from now on have their resources indexed
+  set_db_setting(sqlconn, 'note_resources_indexed', '1')
+  sqlconn.commit()
+
+def create_notes_table(sqlconn, table_name):
+  # Columns common to notes from every origin
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "%s" (
   "note_id"  INTEGER,
   "note_type" TEXT,
   "note_uuid" TEXT,
@@ -114,79 +366,232 @@ def create_database(sqlconn, db_schema_version, email_address):
   "note_note_uuid" TEXT,
   "note_original_format"  TEXT,
   "note_internal_date"  DATETIME DEFAULT CURRENT_TIMESTAMP,
-  "note_hash"  TEXT,
+  "note_hash"  BLOB,
   "note_title"  TEXT,
-  "note_data"  TEXT,
-  "note_data_format"  TEXT,
+  "note_converter_version" INTEGER,
   "note_url" TEXT,
-  "email_filename"  TEXT,
-  "email_from"  TEXT,
-  "email_x_uniform_type_identifier"  TEXT,
-  "email_content_type"  TEXT,
-  "email_content_transfer_encoding"  TEXT,
-  "email_mime_version"  TEXT,
-  "email_date"  TEXT,
-  "email_x_mail_created_date"  TEXT,
-  "email_subject"  TEXT,
-  "email_x_universally_unique_identifier"  TEXT,
-  "email_message_id"  TEXT,
-  "email_body"  TEXT,
-  "apple_id"  INTEGER,
-  "apple_title"  TEXT,
-  "apple_snippet"  TEXT,
-  "apple_folder"  TEXT,
-  "apple_created"  TEXT,
-  "apple_last_modified"  TEXT,
-  "apple_data"  TEXT,
-  "apple_attachment_id"  TEXT,
-  "apple_attachment_path"  TEXT,
-  "apple_account_description"  TEXT,
-  "apple_account_identifier"  TEXT,
-  "apple_account_username"  TEXT,
-  "apple_version"  TEXT,
-  "apple_user"  TEXT,
-  "apple_source"  TEXT,
-  "joplin_id"  TEXT,
-  "joplin_parent_id"  TEXT,
-  "joplin_type_"  INTEGER,
-  "joplin_created_time"  TEXT,
-  "joplin_updated_time"  TEXT,
-  "joplin_is_conflict"  INTEGER,
-  "joplin_latitude"  FLOAT,
-  "joplin_longitude"  FLOAT,
-  "joplin_altitude"  FLOAT,
-  "joplin_author"  TEXT,
-  "joplin_source_url"  TEXT,
-  "joplin_is_todo"  INTEGER,
-  "joplin_todo_due"  INTEGER,
-  "joplin_todo_completed"  INTEGER,
-  "joplin_source"  TEXT,
-  "joplin_source_application"  TEXT,
-  "joplin_application_data"  TEXT,
-  "joplin_order"  INTEGER,
-  "joplin_user_created_time"  TEXT,
-  "joplin_user_updated_time"  TEXT,
-  "joplin_encryption_cipher_text"  TEXT,
-  "joplin_encryption_applied"  INTEGER,
-  "joplin_encryption_blob_encrypted"  INTEGER,
-  "joplin_size"  INTEGER,
-  "joplin_markup_language"  INTEGER,
-  "joplin_is_shared"  INTEGER,
-  "joplin_note_id"  TEXT,
-  "joplin_tag_id"  TEXT,
-  "joplin_mime"  TEXT,
-  "joplin_filename"  TEXT,
-	"joplin_file_extension" TEXT,
+  "note_data_format"  TEXT,
+  "note_data"  TEXT,
   PRIMARY KEY("note_id")
-  );''')
-  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "hashidx" ON "notes" (
+  );''' % (table_name,))
+
+def create_notes_indexes(sqlconn, table_name):
+  # Notes (but not folders, tags, etc.) are unique by hash
+  sqlconn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS "hashidx" ON "%s" (
     "note_hash"
-  );''')
-  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "dateidx" ON "notes" (
+  ) WHERE note_type = 'note';''' % (table_name,))
+  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "dateidx" ON "%s" (
     "note_internal_date"
+  );''' % (table_name,))
+
+def _side_table_sql(table_name, column_names, column_types):
+  lines = ['''  "%s"  %s,''' % (name, type_) for name, type_ in zip(column_names, column_types)]
+  return '''CREATE TABLE IF NOT EXISTS "%s" (
+  "note_id"  INTEGER NOT NULL,
+%s
+  PRIMARY KEY("note_id")
+  );''' % (table_name, '\n'.join(lines))
+
+def create_side_tables(sqlconn):
+  # Columns only used by notes from one origin, one row per note
+  sqlconn.execute(_side_table_sql("note_email", emailColumns, ["TEXT"] * len(emailColumns)))
+  sqlconn.execute(_side_table_sql("note_apple", appleColumns, appleColumnTypes))
+  sqlconn.execute(_side_table_sql("note_joplin", joplinColumns, joplinColumnTypes))
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_side_delete" AFTER DELETE ON "notes" BEGIN
+  DELETE FROM note_email WHERE note_id = old.note_id;
+  DELETE FROM note_apple WHERE note_id = old.note_id;
+  DELETE FROM note_joplin WHERE note_id = old.note_id;
+  END;''')
+  create_apple_data_trigger(sqlconn)
+
+def create_apple_data_trigger(sqlconn):
+  # apple_data is not stored when it is the same as note_data, so keep the
+  # original text before note_data is replaced (e.g. by convertnotes)
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_apple_data" BEFORE UPDATE OF note_data ON "notes" BEGIN
+  UPDATE note_apple SET apple_data = old.note_data WHERE note_id = old.note_id AND apple_data IS NULL;
+  END;''')
+
+def compression_setting(sqlconn):
+  row = sqlconn.execute('''SELECT value FROM settings WHERE name = 'compression';''').fetchone()
+  if row is None:
+    return "none"
+  return row[0]
+
+def create_search_index(sqlconn, compressed=None):
+  # Full-text index over the notes table kept in sync by triggers. It reads
+  # the text of notes through the notes_text view. When note_data may be
+  # compressed (compressed is None: the compression setting is not "none")
+  # the view and the triggers call note_text(), so notes can then only be
+  # changed and searched through a connection from open_database.
+  if compressed is None:
+    compressed = (compression_setting(sqlconn) != "none")
+  text_sql = '%s'
+  if compressed:
+    text_sql = 'note_text(%s)'
+  # The view and the triggers are created again in case the setting changed
+  drop_search_triggers(sqlconn)
+  sqlconn.execute('''CREATE VIEW IF NOT EXISTS "notes_text" AS SELECT note_id,
+  note_title,
+  %s AS note_data,
+  note_url FROM notes;''' % (text_sql % ('note_data',),))
+  sqlconn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS "notes_fts" USING fts5(
+  note_title,
+  note_data,
+  note_url,
+  content='notes_text',
+  content_rowid='note_id',
+  tokenize='unicode61 remove_diacritics 2'
   );''')
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_fts_insert" AFTER INSERT ON "notes" BEGIN
+  INSERT INTO notes_fts (rowid, note_title, note_data, note_url)
+    VALUES (new.note_id, new.note_title, %s, new.note_url);
+  END;''' % (text_sql % ('new.note_data',),))
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_fts_delete" AFTER DELETE ON "notes" BEGIN
+  INSERT INTO notes_fts (notes_fts, rowid, note_title, note_data, note_url)
+    VALUES ('delete', old.note_id, old.note_title, %s, old.note_url);
+  END;''' % (text_sql % ('old.note_data',),))
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_fts_update" AFTER UPDATE OF note_title, note_data, note_url ON "notes" BEGIN
+  INSERT INTO notes_fts (notes_fts, rowid, note_title, note_data, note_url)
+    VALUES ('delete', old.note_id, old.note_title, %s, old.note_url);
+  INSERT INTO notes_fts (rowid, note_title, note_data, note_url)
+    VALUES (new.note_id, new.note_title, %s, new.note_url);
+  END;''' % (text_sql % ('old.note_data',), text_sql % ('new.note_data',)))
+
+def drop_search_triggers(sqlconn):
+  # Drops the notes_text view and the triggers that keep notes_fts in sync
+  # with notes (notes_fts itself is kept)
+  sqlconn.execute('''DROP VIEW IF EXISTS "notes_text";''')
+  for event in ["insert", "delete", "update"]:
+    sqlconn.execute('''DROP TRIGGER IF EXISTS "notes_fts_%s";''' % (event,))
+
+def create_note_resources_table(sqlconn):
+  # Resources (attachments) referenced by each note
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "note_resources" (
+  "note_id"  INTEGER NOT NULL,
+  "resource_id"  TEXT,
+  "path"  TEXT,
+  "mime"  TEXT,
+  "size"  INTEGER
+  );''')
+  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "resourceidx" ON "note_resources" (
+    "resource_id"
+  );''')
+  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "resourcenoteidx" ON "note_resources" (
+    "note_id"
+  );''')
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "note_resources_delete" AFTER DELETE ON "notes" BEGIN
+  DELETE FROM note_resources WHERE note_id = old.note_id;
+  END;''')
+
+def create_url_titles_table(sqlconn):
+  # Titles of web pages fetched by url2sql (title is NULL when the page has
+  # no title; pages that could not be fetched are not stored)
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "url_titles" (
+  "url"  TEXT NOT NULL,
+  "title"  TEXT,
+  "fetched_date"  DATETIME DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY("url")
+  );''')
+
+def get_url_title(sqlcur, url):
+  # Returns the cached row (title) for the url or None if it was not fetched
+  sqlcur.execute('''SELECT title FROM url_titles WHERE url = ?''', (url,))
+  return sqlcur.fetchone()
+
+def set_url_title(sqlconn, url, title):
+  sqlconn.execute('''INSERT OR REPLACE INTO url_titles (url, title) VALUES (?, ?);''',
+       (url, title))
+
+def add_missing_columns(sqlconn):
+  # Columns added to the notes table after version 1 of the schema was released
+  columns = [row[1] for row in sqlconn.execute('''PRAGMA table_info(notes);''')]
+  if "note_converter_version" not in columns:
+    sqlconn.execute('''ALTER TABLE notes ADD COLUMN "note_converter_version" INTEGER;''')
+    sqlconn.commit()
+  # Full-text index added after version 1 of the schema was released
+  tables = [row[0] for row in sqlconn.execute('''SELECT name FROM sqlite_master WHERE type = 'table';''')]
+  if "notes_fts" not in tables:
+    print("building search index...")
+    create_search_index(sqlconn)
+    sqlconn.execute('''INSERT INTO notes_fts (notes_fts) VALUES ('rebuild');''')
+    sqlconn.commit()
+  # Resource references added after version 1 of the schema was released
+  # (filled in by index_note_resources)
+  if "note_resources" not in tables:
+    create_note_resources_table(sqlconn)
+    sqlconn.commit()
+
+def search_notes(sqlcur, query, limit=None):
+  # Returns the notes matching an FTS5 query, best match first
+  sql = '''SELECT notes.note_id,
+notes.note_title,
+notes.note_url,
+snippet(notes_fts, 1, '[', ']', '...', 16) AS note_snippet,
+bm25(notes_fts, 10.0, 1.0, 5.0) AS note_rank
+FROM notes_fts JOIN notes ON notes.note_id = notes_fts.rowid
+WHERE notes_fts MATCH ?
+ORDER BY note_rank'''
+  if limit is not None:
+    sql += ''' LIMIT %d''' % (limit,)
+  sqlcur.execute(sql, (query,))
+  return sqlcur
+
+def max_note_id(sqlcur):
+  sqlcur.execute('''SELECT MAX(note_id) FROM notes''')
+  note_id = sqlcur.fetchone()[0]
+  if note_id is None:
+    return 0
+  return note_id
+
+def add_note_resources(sqlconn, note_id, resources):
+  # resources is a list of (resource_id, path, mime, size)
+  sqlconn.executemany('''INSERT INTO note_resources (note_id, resource_id, path, mime, size) VALUES (?, ?, ?, ?, ?);''',
+    [(note_id, resource_id, path, mime, size) for resource_id, path, mime, size in resources])
+
+def set_note_resources(sqlconn, note_id, resources):
+  # Replaces the resource references of a note (e.g. one replaced by a newer
+  # duplicate)
+  sqlconn.execute('''DELETE FROM note_resources WHERE note_id = ?;''', (note_id,))
+  add_note_resources(sqlconn, note_id, resources)
+
+def note_resources_indexed(sqlcur):
+  sqlcur.execute('''SELECT value FROM settings WHERE name = ?''', ('note_resources_indexed',))
+  return sqlcur.fetchone() is not None
+
+def index_note_resources(sqlconn, resources_path, after_note_id=0, note_ids=()):
+  # Rebuild the resource references of the notes added after after_note_id
+  # and of the notes in note_ids (e.g. notes a loader replaced or merged
+  # into with --on-duplicate)
+  resource_index = common.ResourceIndex(resources_path)
+  sqlconn.execute('''DELETE FROM note_resources WHERE note_id > ?;''', (after_note_id,))
+  select_sql = '''SELECT notes.note_id,
+note_text(notes.note_data),
+note_apple.apple_attachment_id,
+note_apple.apple_attachment_path FROM notes
+LEFT JOIN note_apple ON note_apple.note_id = notes.note_id
+WHERE %s'''
+  sqlcur = sqlconn.cursor()
+  sqlcur.execute(select_sql % ('''notes.note_id > ?''',), (after_note_id,))
+  for row in sqlcur:
+    resources = common.getNoteResources(row[1], resource_index, row[2], row[3])
+    if len(resources) > 0:
+      add_note_resources(sqlconn, row[0], resources)
+  for note_id in note_ids:
+    if note_id > after_note_id:
+      continue
+    sqlcur.execute(select_sql % ('''notes.note_id = ?''',), (note_id,))
+    for row in sqlcur.fetchall():
+      set_note_resources(sqlconn, row[0], common.getNoteResources(row[1], resource_index, row[2], row[3]))
+  if after_note_id == 0:
+    set_db_setting(sqlconn, 'note_resources_indexed', '1')
   sqlconn.commit()
 
+def note_references(sqlcur, resource_id):
+  # Returns True if the text of a note contains the resource id
+  sqlcur.execute('''SELECT rowid FROM notes_fts WHERE notes_fts MATCH ? LIMIT 1;''',
+    ('note_data : "%s"' % (resource_id.replace('"', '""'),),))
+  return sqlcur.fetchone() is not None
+
 #
 # Use settings schema from gyb2eml
 #
@@ -199,15 +604,108 @@ def get_db_settings(sqlcur, db_schema_version):
     print("%s" % e)
     sys.exit(6)
 
+def set_db_setting(sqlconn, name, value):
+  sqlconn.execute('''INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?);''',
+       (name, value))
+
 def check_db_settings(db_settings, prog, version, db_schema_min_version, db_schema_version):
-  if (db_settings['db_version'] < db_schema_min_version  or
-      db_settings['db_version'] > db_schema_version):
+  if (db_version(db_settings['db_version']) < db_version(db_schema_min_version) or
+      db_version(db_settings['db_version']) > db_version(db_schema_version)):
     print("\n\nThis database was created with version %s of the \
 database schema while this program %s requires version %s - %s"
 % (db_settings['db_version'], prog, db_schema_min_version,
 db_schema_version))
+    if db_version(db_settings['db_version']) < db_version(db_schema_min_version):
+      print("Upgrade the database with the --migrate option or migratedb.py")
     sys.exit(4)
 
+# SQLite settings applied when the notes database is opened. In WAL mode
+# readers (e.g. an export) can run while a loader writes, and with
+# synchronous=NORMAL a commit only waits for the disk when the log is
+# checkpointed into the database. cache_size is in KiB when negative.
+db_presets = {
+  "default": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -65536),
+    ("mmap_size", 268435456)
+  ],
+  # Bulk loads: larger page cache, checkpoint the log less often
+  "load": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -262144),
+    ("mmap_size", 268435456),
+    ("wal_autocheckpoint", 10000)
+  ],
+  # Read-mostly exports: map more of the database file into memory
+  "export": [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -65536),
+    ("mmap_size", 1073741824)
+  ]
+}
+
+def open_database(path, email_address, version, db_schema_min_version, db_schema_version,
+                  create=False, migrate=False, preset="default"):
+  # Opens the notes database in the directory path (creating it if create is
+  # True) and checks that the program can use its version of the schema
+  notesdbfile = os.path.join(path, 'notesdb.sqlite')
+
+  new_database = (not os.path.isfile(notesdbfile))
+
+  if new_database and not create:
+    common.error("database not found")
+
+  sqlconn = sqlite3.connect(notesdbfile,
+    detect_types=sqlite3.PARSE_DECLTYPES)
+  for name, value in db_presets[preset]:
+    sqlconn.execute('''PRAGMA %s = %s;''' % (name, value))
+  sqlconn.create_function('note_fingerprint', 1, common.note_fingerprint, deterministic=True)
+  sqlcur = sqlconn.cursor()
+
+  if (new_database):
+    create_database(sqlconn=sqlconn, db_schema_version=db_schema_version, email_address=email_address)
+
+  db_settings = get_db_settings(sqlcur, db_schema_version)
+  create_text_functions(sqlconn, db_settings.get('compression', 'none'))
+  if migrate:
+    db_settings = migrate_database(sqlconn, db_schema_version)
+  check_db_settings(db_settings, '%prog', version, db_schema_min_version, db_schema_version)
+  return sqlconn, db_settings
+
+class BatchWriter(object):
+  # Adds notes through a single connection, committing every batch_size notes
+  def __init__(self, sqlconn, batch_size=1000, on_duplicate="keep-first"):
+    self.sqlconn_ = sqlconn
+    self.batch_size_ = batch_size
+    self.on_duplicate_ = on_duplicate
+    self.count_ = 0
+    self.duplicates_ = 0
+
+  def add(self, add_note, columns):
+    # Returns the note id or None (see add_apple_note)
+    note_id = add_note(self.sqlconn_, columns, self.on_duplicate_)
+    if note_id is None:
+      self.duplicates_ += 1
+    self.count_ += 1
+    if self.count_ >= self.batch_size_:
+      self.commit()
+    return note_id
+
+  def commit(self):
+    self.sqlconn_.commit()
+    self.count_ = 0
+
+  def close(self):
+    self.commit()
+    if self.duplicates_ > 0:
+      print("%d duplicate notes not added (%s)" % (self.duplicates_, self.on_duplicate_))
+
 def create_macapt_database(sqlconn):
   print("creating database...")
   sqlconn.execute('''CREATE TABLE IF NOT EXISTS "Notes" (
@@ -261,108 +759,10 @@ def add_macapt_note(sqlconn, columns):
           columns["apple_user"],
           columns["apple_source"]))
 
-def add_email_note(sqlconn, columns):
-  sqlconn.execute('''INSERT INTO notes (
-  note_type,
-  note_uuid,
-  note_parent_uuid,
-  note_original_format,
-  note_internal_date,
-  note_hash,
-  note_title,
-  note_data,
-  note_data_format,
-  note_url,
-  email_filename,
-  email_from,
-  email_x_uniform_type_identifier,
-  email_content_type,
-  email_content_transfer_encoding,
-  email_mime_version,
-  email_date,
-  email_x_mail_created_date,
-  email_subject,
-  email_x_universally_unique_identifier,
-  email_message_id,
-  email_body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
-         (columns["note_type"],
-          columns["note_uuid"],
-          columns["note_parent_uuid"],
-          columns["note_original_format"],
-          columns["note_internal_date"],
-          columns["note_hash"],
-          columns["note_title"],
-          columns["note_data"],
-          columns["note_data_format"],
-          columns["note_url"],
-          columns["email_filename"],
-          columns["email_from"],
-          columns["email_x_uniform_type_identifier"],
-          columns["email_content_type"],
-          columns["email_content_transfer_encoding"],
-          columns["email_mime_version"],
-          columns["email_date"],
-          columns["email_x_mail_created_date"],
-          columns["email_subject"],
-          columns["email_x_universally_unique_identifier"],
-          columns["email_message_id"],
-          columns["email_body"]))
-
-def add_apple_note(sqlconn, columns):
-  sqlconn.execute('''INSERT INTO notes (
-  note_type,
-  note_uuid,
-  note_parent_uuid,
-  note_original_format,
-  note_internal_date,
-  note_hash,
-  note_title,
-  note_data,
-  note_data_format,
-  note_url,
-  apple_id,
-  apple_title,
-  apple_snippet,
-  apple_folder,
-  apple_created,
-  apple_last_modified,
-  apple_data,
-  apple_attachment_id,
-  apple_attachment_path,
-  apple_account_description,
-  apple_account_identifier,
-  apple_account_username,
-  apple_version,
-  apple_user,
-  apple_source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
-         (columns["note_type"],
-          columns["note_uuid"],
-          columns["note_parent_uuid"],
-          columns["note_original_format"],
-          columns["note_internal_date"],
-          columns["note_hash"],
-          columns["note_title"],
-          columns["note_data"],
-          columns["note_data_format"],
-          columns["note_url"],
-          columns["apple_id"],
-          columns["apple_title"],
-          columns["apple_snippet"],
-          columns["apple_folder"],
-          columns["apple_created"],
-          columns["apple_last_modified"],
-          columns["apple_data"],
-          columns["apple_attachment_id"],
-          columns["apple_attachment_path"],
-          columns["apple_account_description"],
-          columns["apple_account_identifier"],
-          columns["apple_account_username"],
-          columns["apple_version"],
-          columns["apple_user"],
-          columns["apple_source"]))
-
-def add_joplin_note(sqlconn, columns):
-  sqlconn.execute('''INSERT INTO notes (
+def _add_note(sqlconn, columns, on_duplicate):
+  # Returns (note_id, changed) where note_id is None if the note was
+  # rejected as a duplicate
+  row = sqlconn.execute('''INSERT INTO notes (
   note_type,
   note_uuid,
   note_parent_uuid,
@@ -372,110 +772,312 @@ def add_joplin_note(sqlconn, columns):
   note_internal_date,
   note_hash,
   note_title,
-  note_data,
-  note_data_format,
+  note_converter_version,
   note_url,
-  apple_id,
-  apple_title,
-  apple_snippet,
-  apple_folder,
-  apple_created,
-  apple_last_modified,
-  apple_data,
-  apple_attachment_id,
-  apple_attachment_path,
-  apple_account_description,
-  apple_account_identifier,
-  apple_account_username,
-  apple_version,
-  apple_user,
-  apple_source,
-  joplin_id,
-  joplin_parent_id,
-  joplin_type_,
-  joplin_created_time,
-  joplin_updated_time,
-  joplin_is_conflict,
-  joplin_latitude,
-  joplin_longitude,
-  joplin_altitude,
-  joplin_author,
-  joplin_source_url,
-  joplin_is_todo,
-  joplin_todo_due,
-  joplin_todo_completed,
-  joplin_source,
-  joplin_source_application,
-  joplin_application_data,
-  joplin_order,
-  joplin_user_created_time,
-  joplin_user_updated_time,
-  joplin_encryption_cipher_text,
-  joplin_encryption_applied,
-  joplin_encryption_blob_encrypted,
-  joplin_size,
-  joplin_markup_language,
-  joplin_is_shared,
-  joplin_note_id,
-  joplin_tag_id,
-  joplin_mime,
-  joplin_filename,
-	joplin_file_extension) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+  note_data_format,
+  note_data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, note_compress(?))
+  %s %s RETURNING note_id;''' % (NOTE_CONFLICT_TARGET, duplicate_policies[on_duplicate]),
          (columns["note_type"],
           columns["note_uuid"],
           columns["note_parent_uuid"],
-          columns["note_tag_uuid"],
-          columns["note_note_uuid"],
+          columns.get("note_tag_uuid"),
+          columns.get("note_note_uuid"),
           columns["note_original_format"],
           columns["note_internal_date"],
           columns["note_hash"],
           columns["note_title"],
-          columns["note_data"],
+          columns.get("note_converter_version"),
+          columns["note_url"],
           columns["note_data_format"],
-					columns["note_url"],
-          columns["apple_id"],
-          columns["apple_title"],
-          columns["apple_snippet"],
-          columns["apple_folder"],
-          columns["apple_created"],
-          columns["apple_last_modified"],
-          columns["apple_data"],
-          columns["apple_attachment_id"],
-          columns["apple_attachment_path"],
-          columns["apple_account_description"],
-          columns["apple_account_identifier"],
-          columns["apple_account_username"],
-          columns["apple_version"],
-          columns["apple_user"],
-          columns["apple_source"],
-          columns["joplin_id"],
-          columns["joplin_parent_id"],
-          columns["joplin_type_"],
-          columns["joplin_created_time"],
-          columns["joplin_updated_time"],
-          columns["joplin_is_conflict"],
-          columns["joplin_latitude"],
-          columns["joplin_longitude"],
-          columns["joplin_altitude"],
-          columns["joplin_author"],
-          columns["joplin_source_url"],
-          columns["joplin_is_todo"],
-          columns["joplin_todo_due"],
-          columns["joplin_todo_completed"],
-          columns["joplin_source"],
-          columns["joplin_source_application"],
-          columns["joplin_application_data"],
-          columns["joplin_order"],
-          columns["joplin_user_created_time"],
-          columns["joplin_user_updated_time"],
-          columns["joplin_encryption_cipher_text"],
-          columns["joplin_encryption_applied"],
-          columns["joplin_encryption_blob_encrypted"],
-          columns["joplin_size"],
-          columns["joplin_markup_language"],
-          columns["joplin_is_shared"],
-          columns["joplin_note_id"],
-          columns["joplin_tag_id"],
-          columns["joplin_mime"],
-          columns["joplin_filename"],
-					columns["joplin_file_extension"]))
+          columns["note_data"])).fetchone()
+  if row is not None:
+    if on_duplicate == "keep-newest":
+      # The side table rows of a replaced note are replaced too
+      for table_name in sideTables:
+        sqlconn.execute('''DELETE FROM %s WHERE note_id = ?;''' % (table_name,), (row[0],))
+    return (row[0], True)
+  if on_duplicate == "merge-metadata":
+    # The side table rows are merged even if the note itself is unchanged
+    return (note_id_for_hash(sqlconn.cursor(), columns["note_hash"]), False)
+  return (None, False)
+
+def note_id_for_hash(sqlcur, note_hash):
+  sqlcur.execute('''SELECT note_id FROM notes WHERE note_hash = ? AND note_type = 'note';''', (note_hash,))
+  row = sqlcur.fetchone()
+  if row is None:
+    return None
+  return row[0]
+
+def merge_note(sqlconn, note_id, from_note_id):
+  # Fills in the NULL columns of a note and of its side table rows from
+  # another note (like merge-metadata)
+  sqlconn.execute('''UPDATE notes SET %s FROM notes AS other WHERE notes.note_id = ? AND other.note_id = ?;'''
+    % (', '.join(['''%s = COALESCE(notes.%s, other.%s)''' % (name, name, name) for name in _replacedColumns]),),
+    (note_id, from_note_id))
+  for table_name, column_names in [("note_email", emailColumns), ("note_apple", appleColumns), ("note_joplin", joplinColumns)]:
+    sqlconn.execute('''INSERT INTO %s (note_id, %s) SELECT ?, %s FROM %s WHERE note_id = ? %s;'''
+      % (table_name, ', '.join(column_names), ', '.join(column_names), table_name,
+         side_conflict_sql(table_name, column_names, "merge-metadata")), (note_id, from_note_id))
+
+def _add_side_columns(sqlconn, table_name, column_names, note_id, values, on_duplicate):
+  # Returns True if a row was added or changed
+  placeholders = ['''note_compress(?)''' if (table_name, name) in compressedColumns else '''?''' for name in column_names]
+  cursor = sqlconn.execute('''INSERT INTO %s (note_id, %s) VALUES (?, %s) %s;'''
+    % (table_name, ', '.join(column_names), ', '.join(placeholders), side_conflict_sql(table_name, column_names, on_duplicate)),
+    [note_id] + values)
+  return cursor.rowcount > 0
+
+def _add_apple_columns(sqlconn, note_id, columns, on_duplicate):
+  values = [columns[name] for name in appleColumns]
+  if columns["apple_data"] == columns["note_data"]:
+    # apple_data is read as COALESCE(apple_data, note_data)
+    values[-1] = None
+  return _add_side_columns(sqlconn, "note_apple", appleColumns, note_id, values, on_duplicate)
+
+# The add_*_note functions return the note id, or None if the note was a
+# duplicate that did not change the database (see duplicate_policies)
+
+def add_email_note(sqlconn, columns, on_duplicate="keep-first"):
+  note_id, changed = _add_note(sqlconn, columns, on_duplicate)
+  if note_id is None:
+    return None
+  changed = _add_side_columns(sqlconn, "note_email", emailColumns, note_id,
+    [columns[name] for name in emailColumns], on_duplicate) or changed
+  return note_id if changed else None
+
+def add_apple_note(sqlconn, columns, on_duplicate="keep-first"):
+  note_id, changed = _add_note(sqlconn, columns, on_duplicate)
+  if note_id is None:
+    return None
+  changed = _add_apple_columns(sqlconn, note_id, columns, on_duplicate) or changed
+  return note_id if changed else None
+
+def add_joplin_note(sqlconn, columns, on_duplicate="keep-first"):
+  note_id, changed = _add_note(sqlconn, columns, on_duplicate)
+  if note_id is None:
+    return None
+  changed = _add_apple_columns(sqlconn, note_id, columns, on_duplicate) or changed
+  changed = _add_side_columns(sqlconn, "note_joplin", joplinColumns, note_id,
+    [columns[name] for name in joplinColumns], on_duplicate) or changed
+  return note_id if changed else None
+
+def copy_rows_chunked(sqlconn, name, copies, chunk_size):
+  # Copy the rows of the notes table to other tables in note_id ranges of
+  # chunk_size, committing after each range so other connections can use
+  # the database in between. Triggers copy the notes added, changed or
+  # deleted while the copy runs. The last range copied is kept in the
+  # settings table so an interrupted copy resumes where it stopped.
+  #
+  # copies is a list of (table_name, column_names, select_expressions, condition)
+  statements = []
+  trigger_sql = []
+  for table_name, column_names, expressions, condition in copies:
+    condition_sql = ''
+    if condition is not None:
+      condition_sql = ''' AND %s''' % (condition,)
+    statements.append('''INSERT OR REPLACE INTO "%s" (note_id, %s) SELECT note_id, %s FROM notes
+WHERE note_id > ? AND note_id <= ?%s;''' % (table_name, ', '.join(column_names), ', '.join(expressions), condition_sql))
+    trigger_sql.append('''  DELETE FROM "%s" WHERE note_id = new.note_id;
+  INSERT INTO "%s" (note_id, %s) SELECT note_id, %s FROM notes WHERE note_id = new.note_id%s;'''
+      % (table_name, table_name, ', '.join(column_names), ', '.join(expressions), condition_sql))
+
+  for event in ["INSERT", "UPDATE"]:
+    sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_copy_%s_%s" AFTER %s ON "notes" BEGIN
+%s
+  END;''' % (name, event.lower(), event, '\n'.join(trigger_sql)))
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "notes_copy_%s_delete" AFTER DELETE ON "notes" BEGIN
+%s
+  END;''' % (name, '\n'.join(['''  DELETE FROM "%s" WHERE note_id = old.note_id;''' % (copy[0],) for copy in copies])))
+  sqlconn.commit()
+
+  sqlcur = sqlconn.cursor()
+  checkpoint_name = 'copy_checkpoint_' + name
+  sqlcur.execute('''SELECT value FROM settings WHERE name = ?''', (checkpoint_name,))
+  row = sqlcur.fetchone()
+  start_id = 0 if row is None else int(row[0])
+  end_of_notes = max_note_id(sqlcur)
+  while start_id < end_of_notes:
+    end_id = start_id + chunk_size
+    for statement in statements:
+      sqlconn.execute(statement, (start_id, end_id))
+    set_db_setting(sqlconn, checkpoint_name, str(end_id))
+    sqlconn.commit()
+    print("copied notes up to %d of %d" % (min(end_id, end_of_notes), end_of_notes))
+    start_id = end_id
+
+def finish_rows_chunked(sqlconn, name):
+  # Stop copying changes made to the notes table (call inside the
+  # transaction that replaces it)
+  for event in ["insert", "update", "delete"]:
+    sqlconn.execute('''DROP TRIGGER IF EXISTS "notes_copy_%s_%s";''' % (name, event))
+  sqlconn.execute('''DELETE FROM settings WHERE name = ?;''', ('copy_checkpoint_' + name,))
+
+def migrate_v1_to_v2(sqlconn, chunk_size):
+  # Move the email_*, apple_* and joplin_* columns of the version 1 notes
+  # table to side tables and rebuild notes with the remaining columns
+  add_missing_columns(sqlconn)
+  create_side_tables(sqlconn)
+  create_notes_table(sqlconn, "notes_v2")
+  sqlconn.commit()
+
+  apple_select = appleColumns[:-1] + ['''CASE WHEN apple_data = note_data THEN NULL ELSE apple_data END''']
+  copy_rows_chunked(sqlconn, "v2", [
+    ("note_email", emailColumns, emailColumns, '''COALESCE(%s) IS NOT NULL''' % (', '.join(emailColumns),)),
+    ("note_apple", appleColumns, apple_select, '''COALESCE(%s) IS NOT NULL''' % (', '.join(appleColumns),)),
+    ("note_joplin", joplinColumns, joplinColumns, '''COALESCE(%s) IS NOT NULL''' % (', '.join(joplinColumns),)),
+    ("notes_v2", coreColumns, coreColumns, None),
+  ], chunk_size)
+
+  # Index names are shared by all tables, so build the indexes on the new
+  # table before it replaces notes (looking up notes by hash or date is
+  # slower until they are built)
+  for index_name in ["hashidx", "dateidx"]:
+    sqlconn.execute('''DROP INDEX IF EXISTS "%s";''' % (index_name,))
+    sqlconn.commit()
+  print("building indexes...")
+  # Version 2 indexes (hashidx is made unique by migrate_v2_to_v3)
+  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "hashidx" ON "notes_v2" (
+    "note_hash"
+  );''')
+  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "dateidx" ON "notes_v2" (
+    "note_internal_date"
+  );''')
+  sqlconn.commit()
+
+  sqlconn.execute('''BEGIN;''')
+  finish_rows_chunked(sqlconn, "v2")
+  # The notes_text view (created by add_missing_columns) would stop the
+  # rename, so it is dropped with the search triggers and created again
+  drop_search_triggers(sqlconn)
+  sqlconn.execute('''DROP TABLE notes;''')
+  sqlconn.execute('''ALTER TABLE notes_v2 RENAME TO notes;''')
+  # note ids are unchanged so the search index is still valid
+  create_search_index(sqlconn)
+  create_note_resources_table(sqlconn)
+  create_side_tables(sqlconn)
+
+def remove_duplicate_notes(sqlconn):
+  # Remove notes with the same hash, keeping the first one loaded (like
+  # removedups)
+  cursor = sqlconn.execute('''DELETE FROM notes
+WHERE note_type = 'note' AND note_hash IS NOT NULL AND note_id NOT IN
+       (
+       SELECT MIN(note_id)
+       FROM notes
+       WHERE note_type = 'note' AND note_hash IS NOT NULL
+       GROUP BY note_hash
+       );''')
+  print("removed %d duplicate notes" % (cursor.rowcount,))
+
+def migrate_v2_to_v3(sqlconn, chunk_size):
+  # Make notes unique by hash
+  remove_duplicate_notes(sqlconn)
+  sqlconn.execute('''DROP INDEX IF EXISTS "hashidx";''')
+  create_notes_indexes(sqlconn, "notes")
+
+def migrate_v3_to_v4(sqlconn, chunk_size):
+  # Replace the SHA-512 hex digests in note_hash with binary fingerprints
+  # (common.note_fingerprint), chunk_size notes per transaction. Hex digests
+  # are TEXT so an interrupted upgrade continues with the notes it has not
+  # rehashed yet.
+  sqlconn.execute('''DROP INDEX IF EXISTS "hashidx";''')
+  sqlconn.commit()
+  sqlcur = sqlconn.cursor()
+  start_id = 0
+  end_of_notes = max_note_id(sqlcur)
+  while start_id < end_of_notes:
+    end_id = start_id + chunk_size
+    sqlconn.execute('''UPDATE notes SET note_hash = note_fingerprint(note_data)
+WHERE note_id > ? AND note_id <= ? AND typeof(note_hash) = 'text';''', (start_id, end_id))
+    sqlconn.commit()
+    print("rehashed notes up to %d of %d" % (min(end_id, end_of_notes), end_of_notes))
+    start_id = end_id
+  # Notes whose text was changed without updating their hash
+  remove_duplicate_notes(sqlconn)
+  print("building indexes...")
+  create_notes_indexes(sqlconn, "notes")
+
+def migrate_v4_to_v5(sqlconn, chunk_size):
+  # Rebuild the search index to read notes through the notes_text view
+  # (the text can then be compressed with migratedb --compression)
+  drop_search_triggers(sqlconn)
+  sqlconn.execute('''DROP TABLE IF EXISTS "notes_fts";''')
+  create_search_index(sqlconn)
+  print("rebuilding search index...")
+  sqlconn.execute('''INSERT INTO notes_fts (notes_fts) VALUES ('rebuild');''')
+
+def compress_database(sqlconn, compression, chunk_size=10000):
+  # Store the text columns of every note with compression ("none" stores
+  # them uncompressed), chunk_size note ids per transaction. The setting is
+  # changed first so notes added in the meantime are stored the same way,
+  # and values already stored that way are skipped, so an interrupted run
+  # continues where it stopped when it is run again.
+  if compression == "zstd":
+    _zstandard()
+  set_db_setting(sqlconn, 'compression', compression)
+  sqlconn.commit()
+  create_text_functions(sqlconn, compression)
+  # Until every value is stored the new way some may be compressed, so the
+  # search index reads them with note_text()
+  create_search_index(sqlconn, compressed=True)
+  sqlconn.commit()
+  sqlcur = sqlconn.cursor()
+  start_id = 0
+  end_of_notes = max_note_id(sqlcur)
+  while start_id < end_of_notes:
+    end_id = start_id + chunk_size
+    sqlconn.execute('''BEGIN;''')
+    # The text does not change so the search index is not updated and
+    # apple_data is not set to the (recompressed) note_data
+    sqlconn.execute('''DROP TRIGGER IF EXISTS "notes_fts_update";''')
+    sqlconn.execute('''DROP TRIGGER IF EXISTS "notes_apple_data";''')
+    # Copies of note_data left in apple_data by earlier versions of this
+    # function
+    sqlconn.execute('''UPDATE note_apple SET apple_data = NULL WHERE note_id > ? AND note_id <= ? AND
+apple_data = (SELECT note_data FROM notes WHERE notes.note_id = note_apple.note_id);''', (start_id, end_id))
+    for table_name, column_name in compressedColumns:
+      sqlcur.execute('''SELECT note_id, %s FROM %s WHERE note_id > ? AND note_id <= ? AND %s IS NOT NULL;'''
+        % (column_name, table_name, column_name), (start_id, end_id))
+      updates = []
+      for note_id, value in sqlcur.fetchall():
+        stored = compress_text(decompress_text(value), compression)
+        if stored != value:
+          updates.append((stored, note_id))
+      sqlconn.executemany('''UPDATE %s SET %s = ? WHERE note_id = ?;''' % (table_name, column_name), updates)
+    create_search_index(sqlconn, compressed=True)
+    create_apple_data_trigger(sqlconn)
+    sqlconn.commit()
+    print("compressed notes up to %d of %d" % (min(end_id, end_of_notes), end_of_notes))
+    start_id = end_id
+  # Uncompressed notes are read as they are stored
+  create_search_index(sqlconn)
+  sqlconn.commit()
+
+def db_version(value):
+  # Versions are stored as text in the settings table
+  return int(value)
+
+# Schema migrations in order as (db_version, migrate). Each step upgrades
+# the database from the version before it and can be run again after an
+# interruption. The last transaction of a step is left open so that it is
+# committed together with the new db_version.
+migrations = [
+  ('2', migrate_v1_to_v2),
+  ('3', migrate_v2_to_v3),
+  ('4', migrate_v3_to_v4),
+  ('5', migrate_v4_to_v5),
+]
+
+def migrate_database(sqlconn, db_schema_version, chunk_size=10000):
+  # Apply the migrations up to db_schema_version missing from the database
+  sqlcur = sqlconn.cursor()
+  db_settings = get_db_settings(sqlcur, db_schema_version)
+  for version, migrate in migrations:
+    if (db_version(db_settings['db_version']) < db_version(version) and
+        db_version(version) <= db_version(db_schema_version)):
+      print("upgrading database to version %s..." % (version,))
+      migrate(sqlconn, chunk_size)
+      set_db_setting(sqlconn, 'db_version', version)
+      sqlconn.commit()
+      db_settings['db_version'] = version
+  return db_settings
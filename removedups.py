@@ -8,11 +8,6 @@ import sqlite3
 import uuid
 
 import mimetypes
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
 
 from datetime import datetime, timezone
 #from pytz import timezone
@@ -62,8 +57,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '2'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -74,6 +69,12 @@ def _get_option_parser():
     parser.add_option("", "--input",
                       action="store", dest="input_path", default=[],
                       help="Path to input SQLite directory")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="default",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: default)")
     return parser
 
 def main(args):
@@ -99,21 +100,12 @@ def main(args):
   else:
     common.error("input path not specified.")
 
-  notesdbfile = os.path.join(inputPath, 'notesdb.sqlite')
 
-  new_database = (not os.path.isfile(notesdbfile))
-
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
   sqlconn.row_factory = sqlite3.Row
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    common.error("database not found")
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   # Remove notes with duplicate hash values
   
   sqlcur.execute('''DELETE FROM notes
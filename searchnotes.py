@@ -0,0 +1,129 @@
+import re
+import os
+import argparse
+import sys
+import errno
+import optparse
+import sqlite3
+
+import notesdb
+import constants
+import common
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program searches the notes in the database using the full-text index.
+#
+
+global __name__, __author__, __email__, __version__, __license__
+__program_name__ = 'searchnotes'
+__author__ = 'Rene Sugar'
+__email__ = 'rene.sugar@gmail.com'
+__version__ = '1.00'
+__license__ = 'MIT License (https://opensource.org/licenses/MIT)'
+__website__ = 'https://github.com/renesugar'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '2'
+
+def _get_option_parser():
+    parser = optparse.OptionParser('%prog [options] query',
+                                   version='%prog ' + __version__)
+    parser.add_option('', "--email",
+                      action="store", dest="email_address", default=None,
+                      help="Email address")
+    parser.add_option("", "--input",
+                      action="store", dest="input_path", default=[],
+                      help="Path to input SQLite directory")
+    parser.add_option('', "--limit",
+                      action="store", dest="limit", type="int", default=20,
+                      help="Maximum number of notes listed (0 for no limit)")
+    parser.add_option('', "--ids",
+                      action="store_true", dest="ids_only", default=False,
+                      help="Only list the note ids")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="export",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: export)")
+    return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  email_address = ''
+  if hasattr(options, 'email_address') and options.email_address:
+    email_address = options.email_address
+    if common.check_email_address(email_address) == False:
+      # Check if email address is valid
+      common.error("email address '%s' is not valid." % (email_address,))
+  else:
+    common.error("email address not specified.")
+
+  inputPath = ''
+
+  if hasattr(options, 'input_path') and options.input_path:
+    inputPath = os.path.abspath(os.path.expanduser(options.input_path))
+    if os.path.isdir(inputPath) == False:
+      # Check if input directory exists
+      common.error("input path '%s' does not exist." % (inputPath,))
+  else:
+    common.error("input path not specified.")
+
+  # FTS5 query syntax, e.g. 'apple AND note_title:recipe'
+  query = ' '.join(args).strip()
+  if query == '':
+    common.error("search query not specified.")
+
+  limit = None
+  if options.limit > 0:
+    limit = options.limit
+
+
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
+  sqlconn.row_factory = sqlite3.Row
+  sqlcur = sqlconn.cursor()
+
+  try:
+    rows = notesdb.search_notes(sqlcur, query, limit)
+    for row in rows:
+      if options.ids_only:
+        print(row['note_id'])
+        continue
+      print("%d\t%.4f\t%s" % (row['note_id'], -row['note_rank'], row['note_title']))
+      if row['note_url'] is not None:
+        print("  %s" % (row['note_url'],))
+      print("  %s" % (common.remove_line_breakers(row['note_snippet'] or '').strip(),))
+  except sqlite3.OperationalError as e:
+    common.error("search query '%s' is not valid (%s)." % (query, e))
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -59,8 +59,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '2'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -74,6 +74,12 @@ def _get_option_parser():
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output emails directory")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="export",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: export)")
     return parser
 
 def _save_email(output_path, columns):
@@ -440,93 +446,33 @@ def main(args):
   else:
     common.error("output path not specified.")
   
-  notesdbfile = os.path.join(options.input_path, 'notesdb.sqlite')
 
-  new_database = (not os.path.isfile(notesdbfile))
-
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
   sqlconn.row_factory = sqlite3.Row
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    common.error("database not found")
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
-  sqlcur.execute('''SELECT note_id,
-note_type,
-note_uuid,
-note_parent_uuid,
-note_tag_uuid,
-note_note_uuid,
-note_original_format,
-note_internal_date,
-note_hash,
-note_title,
-note_data,
-note_data_format,
-note_url,
-email_filename,
-email_from,
-email_x_uniform_type_identifier,
-email_content_type,
-email_content_transfer_encoding,
-email_mime_version,
-email_date,
-email_x_mail_created_date,
-email_subject,
-email_x_universally_unique_identifier,
-email_message_id,
-email_body,
-apple_id,
-apple_title,
-apple_snippet,
-apple_folder,
-apple_created,
-apple_last_modified,
-apple_data,
-apple_attachment_id,
-apple_attachment_path,
-apple_account_description,
-apple_account_identifier,
-apple_account_username,
-apple_version,
-apple_user,
-apple_source,
-joplin_id,
-joplin_parent_id,
-joplin_type_,
-joplin_created_time,
-joplin_updated_time,
-joplin_is_conflict,
-joplin_latitude,
-joplin_longitude,
-joplin_altitude,
-joplin_author,
-joplin_source_url,
-joplin_is_todo,
-joplin_todo_due,
-joplin_todo_completed,
-joplin_source,
-joplin_source_application,
-joplin_application_data,
-joplin_order,
-joplin_user_created_time,
-joplin_user_updated_time,
-joplin_encryption_cipher_text,
-joplin_encryption_applied,
-joplin_encryption_blob_encrypted,
-joplin_size,
-joplin_markup_language,
-joplin_is_shared,
-joplin_note_id,
-joplin_tag_id,
-joplin_mime,
-joplin_filename FROM notes
+  # Only the columns used to create the EML files are read
+  sqlcur.execute('''SELECT notes.note_id,
+notes.note_type,
+notes.note_original_format,
+notes.note_internal_date,
+notes.note_title,
+notes.note_data_format,
+note_text(notes.note_data) AS note_data,
+note_email.email_content_type,
+note_email.email_date,
+note_email.email_x_mail_created_date,
+note_email.email_subject,
+note_email.email_x_universally_unique_identifier,
+note_email.email_message_id,
+note_text(note_email.email_body) AS email_body,
+note_apple.apple_created FROM notes
+                    LEFT JOIN note_email ON note_email.note_id = notes.note_id
+                    LEFT JOIN note_apple ON note_apple.note_id = notes.note_id
+                    WHERE notes.note_type = 'note'
                     ORDER BY
-                    note_internal_date DESC''')
+                    notes.note_internal_date DESC''')
 
   notes_to_convert_results = sqlcur.fetchall()
   current = 0
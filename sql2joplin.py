@@ -11,11 +11,6 @@ import urllib
 from urllib.parse import urlparse
 
 import mimetypes
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
 
 import mistune
 
@@ -69,8 +64,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '2'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -84,6 +79,12 @@ def _get_option_parser():
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output emails directory")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="export",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: export)")
     return parser
 
 def process_joplin_folder(output_path, email_address, folder_dict, folder_name, folder_id, folder_parent_id):
@@ -158,17 +159,20 @@ def process_joplin_note(output_path, email_address, folder_dict, row):
   # Convert note text to markdown format
 
   markdown_text = ''
-  if note_data_format == 'text/plain':
-    markdown_text = common.text_to_markdown(note_data)
-  elif note_data_format == 'text/html':
-    markdown_text = common.html_to_markdown(note_data)
-  elif note_data_format == 'text/markdown':
-    # no conversion required
-    markdown_text = note_data
+  if row['note_data_streamed']:
+    # A large note is converted a chunk at a time as it is written
+    markdown_chunks = common.iter_markdown(row['note_chunks'], note_data_format)
+  else:
+    if note_data_format == 'text/plain':
+      markdown_text = common.text_to_markdown(note_data)
+    elif note_data_format == 'text/html':
+      markdown_text = common.html_to_markdown(note_data)
+    elif note_data_format == 'text/markdown':
+      # no conversion required
+      markdown_text = note_data
+    markdown_chunks = [markdown_text]
 
-  lines  = markdown_text
-  
-  lines += '\n'
+  lines = '\n'
 
   for column_key in row.keys():
     if column_key.startswith('joplin_'):
@@ -187,6 +191,8 @@ def process_joplin_note(output_path, email_address, folder_dict, row):
 
   # save note to file
   with open(outputFilename, 'w') as fp:
+    for markdown_text in markdown_chunks:
+      fp.write(markdown_text)
     fp.write(lines)
 
 
@@ -288,13 +294,18 @@ def _save_note(output_path, email_address, folder_dict, columns):
   # Convert note text to markdown format
 
   markdown_text = ''
-  if note_data_format == 'text/plain':
-    markdown_text = common.text_to_markdown(note_data)
-  elif note_data_format == 'text/html':
-    markdown_text = common.html_to_markdown(note_data)
-  elif note_data_format == 'text/markdown':
-    # no conversion required
-    markdown_text = note_data
+  if columns.get('note_chunks') is not None:
+    # A large note is converted a chunk at a time as it is written
+    markdown_chunks = common.iter_markdown(columns['note_chunks'], note_data_format)
+  else:
+    if note_data_format == 'text/plain':
+      markdown_text = common.text_to_markdown(note_data)
+    elif note_data_format == 'text/html':
+      markdown_text = common.html_to_markdown(note_data)
+    elif note_data_format == 'text/markdown':
+      # no conversion required
+      markdown_text = note_data
+    markdown_chunks = [markdown_text]
 
   # NOTE: SQLite3 returning column as string even though sqlite3.PARSE_DECLTYPES specified
   note_internal_date = common.string_to_datetime(note_internal_date)
@@ -332,11 +343,6 @@ type_: 1'''
 
   lines += '\n'
   lines += '  \n'
-  
-  lines += markdown_text
-  lines += '\n'
-
-  lines += data % (note_uuid, note_parent_uuid, created_time, created_time, created_time, created_time)
 
   filename = note_uuid + ".md"
 
@@ -345,6 +351,10 @@ type_: 1'''
   # save note to file
   with open(outputFilename, 'w') as fp:
     fp.write(lines)
+    for markdown_text in markdown_chunks:
+      fp.write(markdown_text)
+    fp.write('\n')
+    fp.write(data % (note_uuid, note_parent_uuid, created_time, created_time, created_time, created_time))
 
 class LinkUpdateRenderer(mistune.Renderer):
   def __init__(self, output_path, note_internal_date, attach_id=None, escape=True, allow_harmful_protocols=None):
@@ -465,6 +475,25 @@ def process_note(output_path, email_address, folder_dict, row):
 
   # Convert note text to markdown
 
+  if row['note_data_streamed']:
+    # A large note is converted a chunk at a time as it is written
+    note_chunks = row['note_chunks']
+    update_links = True
+    if note_data_format == 'text/plain' or note_data_format == 'text/html':
+      note_chunks = common.iter_markdown(note_chunks, note_data_format)
+      columns["note_data_format"] = 'text/markdown'
+    elif note_original_format in ['joplin', 'twitterarchive', 'twitterapi']:
+      # Markdown text does not contain local links
+      update_links = False
+    if update_links == True:
+      linkUpdateRenderer = LinkUpdateRenderer(output_path, note_internal_date)
+      markdown = mistune.Markdown(renderer=linkUpdateRenderer)
+      note_chunks = common.iter_rendered_markdown(note_chunks, markdown.render)
+      columns["note_data_format"] = 'text/markdown'
+    columns["note_chunks"] = note_chunks
+    _save_note(output_path, email_address, folder_dict, columns)
+    return
+
   update_links = True
   markdown_text = ''
   if note_data_format == 'text/plain':
@@ -543,21 +572,12 @@ def main(args):
 
   outputResourcesPath = os.path.join(outputPath, 'resources')
 
-  notesdbfile = os.path.join(options.input_path, 'notesdb.sqlite')
-
-  new_database = (not os.path.isfile(notesdbfile))
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(inputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=False, migrate=options.migrate, preset=options.db_preset)
   sqlconn.row_factory = sqlite3.Row
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    common.error("database not found")
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   # Create input Joplin resources directory
   if not os.path.isdir(inputResourcesPath):
     os.makedirs(inputResourcesPath)
@@ -566,9 +586,18 @@ def main(args):
   if not os.path.isdir(outputResourcesPath):
     os.makedirs(outputResourcesPath)
 
-  # Copy resources from SQLite resources directory to Joplin resources directory
-  for filename in os.listdir(inputResourcesPath):
-    filePath = os.path.join(inputPath, filename)
+  if not notesdb.note_resources_indexed(sqlcur):
+    print("indexing note resources...")
+    notesdb.index_note_resources(sqlconn, inputResourcesPath)
+
+  # Copy resources referenced by Joplin notes from SQLite resources directory to Joplin resources directory
+  # (file:// links in other notes are copied when the links are updated)
+  sqlcur.execute('''SELECT DISTINCT note_resources.path FROM note_resources
+                    JOIN notes ON notes.note_id = note_resources.note_id
+                    WHERE notes.note_original_format = 'joplin' AND NOT note_resources.path IS NULL''')
+  for row in sqlcur.fetchall():
+    # resources are looked up by name in case the database directory was moved
+    filePath = os.path.join(inputResourcesPath, os.path.basename(row['path']))
     if os.path.isfile(filePath) == True:
       shutil.copy2(filePath, outputResourcesPath)
 
@@ -576,12 +605,14 @@ def main(args):
   # Create folders for notes from email, apple, icloud
   # 
   sqlcur.execute('''SELECT DISTINCT 
-apple_folder,
-joplin_id,
-joplin_parent_id FROM notes
-                    WHERE note_original_format != "joplin" AND NOT apple_folder IS NULL
+note_apple.apple_folder,
+note_joplin.joplin_id,
+note_joplin.joplin_parent_id FROM notes
+                    JOIN note_apple ON note_apple.note_id = notes.note_id
+                    LEFT JOIN note_joplin ON note_joplin.note_id = notes.note_id
+                    WHERE notes.note_original_format != 'joplin' AND NOT note_apple.apple_folder IS NULL
                     ORDER BY
-                    note_internal_date DESC''')
+                    notes.note_internal_date DESC''')
 
   folder_dict = {}
 
@@ -611,79 +642,31 @@ joplin_parent_id FROM notes
     if folder_name is not None:
       folder_dict[folder_name] = folder_id
 
-  sqlcur.execute('''SELECT note_id,
-note_type,
-note_uuid,
-note_parent_uuid,
-note_tag_uuid,
-note_note_uuid,
-note_original_format,
-note_internal_date,
-note_hash,
-note_title,
-note_data,
-note_data_format,
-note_url,
-email_filename,
-email_from,
-email_x_uniform_type_identifier,
-email_content_type,
-email_content_transfer_encoding,
-email_mime_version,
-email_date,
-email_x_mail_created_date,
-email_subject,
-email_x_universally_unique_identifier,
-email_message_id,
-email_body,
-apple_id,
-apple_title,
-apple_snippet,
-apple_folder,
-apple_created,
-apple_last_modified,
-apple_data,
-apple_attachment_id,
-apple_attachment_path,
-apple_account_description,
-apple_account_identifier,
-apple_account_username,
-apple_version,
-apple_user,
-apple_source,
-joplin_id,
-joplin_parent_id,
-joplin_type_,
-joplin_created_time,
-joplin_updated_time,
-joplin_is_conflict,
-joplin_latitude,
-joplin_longitude,
-joplin_altitude,
-joplin_author,
-joplin_source_url,
-joplin_is_todo,
-joplin_todo_due,
-joplin_todo_completed,
-joplin_source,
-joplin_source_application,
-joplin_application_data,
-joplin_order,
-joplin_user_created_time,
-joplin_user_updated_time,
-joplin_encryption_cipher_text,
-joplin_encryption_applied,
-joplin_encryption_blob_encrypted,
-joplin_size,
-joplin_markup_language,
-joplin_is_shared,
-joplin_note_id,
-joplin_tag_id,
-joplin_mime,
-joplin_filename,
-joplin_file_extension FROM notes
+  # The email_* columns are not used to create Joplin notes
+  sqlcur.execute('''SELECT notes.note_id,
+notes.note_type,
+notes.note_uuid,
+notes.note_parent_uuid,
+notes.note_tag_uuid,
+notes.note_note_uuid,
+notes.note_original_format,
+notes.note_internal_date,
+notes.note_hash,
+notes.note_title,
+notes.note_url,
+notes.note_data_format,
+CASE WHEN %s > %d THEN NULL ELSE note_text(notes.note_data) END AS note_data,
+%s > %d AS note_data_streamed,
+note_apple.apple_folder,
+note_apple.apple_attachment_id,
+note_apple.apple_attachment_path,
+%s FROM notes
+                      LEFT JOIN note_apple ON note_apple.note_id = notes.note_id
+                      LEFT JOIN note_joplin ON note_joplin.note_id = notes.note_id
                       ORDER BY
-                      note_internal_date DESC''')
+                      notes.note_internal_date DESC''' % (notesdb.text_size_sql('notes.note_data'), common.STREAMING_MIN_SIZE,
+                        notesdb.text_size_sql('notes.note_data'), common.STREAMING_MIN_SIZE,
+                        ',\n'.join('note_joplin.' + name for name in notesdb.joplinColumns)))
 
   notes_to_convert_results = sqlcur.fetchall()
   current = 0
@@ -691,6 +674,12 @@ joplin_file_extension FROM notes
     current += 1
     note_original_format = row['note_original_format']
 
+    if row['note_data_streamed']:
+      # The text of a large note is read a chunk at a time (blob I/O) as
+      # the note is written
+      row = dict(row)
+      row['note_chunks'] = notesdb.iter_text(sqlconn, 'notes', 'note_data', row['note_id'])
+
     if note_original_format == "email":
       process_note(outputPath, email_address, folder_dict, row)
     elif note_original_format == "joplin":
@@ -0,0 +1,152 @@
+import re
+import os
+import sys
+import optparse
+import subprocess
+import statistics
+import time
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program measures how long each command line tool takes to start up
+# (running it with --help) and which modules it spends that time importing.
+#
+
+global __name__, __author__, __email__, __version__, __license__
+__program_name__ = 'startuptime'
+__author__ = 'Rene Sugar'
+__email__ = 'rene.sugar@gmail.com'
+__version__ = '1.00'
+__license__ = 'MIT License (https://opensource.org/licenses/MIT)'
+__website__ = 'https://github.com/renesugar'
+
+# Command line tools (all of them accept --help)
+TOOLS = [
+  "cleanres",
+  "convertnotes",
+  "eml2mbox",
+  "eml2sql",
+  "expandurls",
+  "gyb2eml",
+  "icloud2sql",
+  "indexres",
+  "joplin2sql",
+  "macapt2sql",
+  "mbox2eml",
+  "migratedb",
+  "removedups",
+  "searchnotes",
+  "sql2eml",
+  "sql2joplin",
+  "twitterarchivelikes2sql",
+  "twitterlikes2sql",
+  "url2sql"
+]
+
+# Lines written to stderr by python -X importtime
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def _get_option_parser():
+    parser = optparse.OptionParser('%prog [options] [tool ...]',
+                                   version='%prog ' + __version__)
+    parser.add_option('', "--runs",
+                      action="store", dest="runs", type="int", default=10,
+                      help="Number of times each tool is started (default: 10)")
+    parser.add_option('', "--budget",
+                      action="store", dest="budget", type="float", default=100.0,
+                      help="Milliseconds a tool may take to start on top of the Python interpreter itself (default: 100)")
+    parser.add_option('', "--top",
+                      action="store", dest="top", type="int", default=5,
+                      help="Number of the slowest imports to list for each tool (default: 5)")
+    return parser
+
+def run_tool(args, cwd):
+  # Returns the wall-clock time in milliseconds and the stderr of one run
+  start = time.perf_counter()
+  result = subprocess.run(args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+  elapsed = (time.perf_counter() - start) * 1000
+  return (elapsed, result.stderr)
+
+def median_time(args, cwd, runs):
+  return statistics.median([run_tool(args, cwd)[0] for i in range(runs)])
+
+def parse_importtime(importtime_output):
+  # Returns (cumulative milliseconds, module) for each top-level import
+  imports = []
+  for line in importtime_output.splitlines():
+    match = IMPORTTIME_RE.match(line)
+    if match is None or len(match.group(3)) != 1:
+      continue
+    imports.append((int(match.group(2)) / 1000, match.group(4)))
+  return imports
+
+def slowest_imports(importtime_output, startup_modules, top):
+  # Top-level imports of the tool, leaving out the modules imported when
+  # the interpreter starts
+  imports = [i for i in parse_importtime(importtime_output) if i[1] not in startup_modules]
+  imports.sort(reverse=True)
+  return imports[:top]
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  tools = args if len(args) > 0 else TOOLS
+
+  toolsPath = os.path.dirname(os.path.abspath(__file__))
+
+  # Interpreter startup, which the tools can't do anything about
+  interpreter_ms = median_time([sys.executable, "-c", "pass"], toolsPath, options.runs)
+  elapsed, importtime_output = run_tool([sys.executable, "-X", "importtime", "-c", "pass"], toolsPath)
+  startup_modules = set([module for import_ms, module in parse_importtime(importtime_output)])
+  print("python: %.1f ms" % (interpreter_ms,))
+
+  over_budget = []
+  for tool in tools:
+    toolFile = tool + ".py"
+    if os.path.isfile(os.path.join(toolsPath, toolFile)) == False:
+      print("ERROR: tool '%s' does not exist." % (tool,))
+      over_budget.append(tool)
+      continue
+    tool_ms = median_time([sys.executable, toolFile, "--help"], toolsPath, options.runs) - interpreter_ms
+    status = "ok"
+    if tool_ms > options.budget:
+      status = "OVER BUDGET"
+      over_budget.append(tool)
+    print("%s: %.1f ms (%s)" % (tool, tool_ms, status))
+    elapsed, importtime_output = run_tool([sys.executable, "-X", "importtime", toolFile, "--help"], toolsPath)
+    for import_ms, module in slowest_imports(importtime_output, startup_modules, options.top):
+      print("  %8.1f ms  %s" % (import_ms, module))
+
+  if len(over_budget) > 0:
+    print("%d of %d tools took longer than %.0f ms to start: %s" % (len(over_budget), len(tools), options.budget, ", ".join(over_budget)))
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import unittest
+
+from html2txt import converters
+
+import common
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Tests for the helpers shared by the programs (run with python3 -m unittest
+# or pytest).
+#
+
+# HTML as it is found in Apple Notes, rendered by mistune for text notes
+# (common.text_to_html) and in the body of note email messages
+APPLE_NOTES_HTML = [
+  '<div><b>Shopping</b></div><div><br></div><div>Eggs</div><div>Milk<br></div>',
+  '<div><h1>Trip</h1></div><div>Day <i>one</i>: <a href="https://example.com/a?b=1&amp;c=2">map</a></div>',
+  '<div><ul><li>first</li><li>second <b>bold</b></li></ul></div><div>after</div>',
+  '<div><ol><li>one</li><li>two</li></ol></div>',
+  '<div>Fish &amp; chips &lt;3</div><div><span style="font-size: 14px">big</span></div>',
+  '<div><img src="file:///tmp/resources/a.png"><br></div><div>caption</div>',
+  '<html><body><div>Body note</div><div><h2>Sub</h2></div><div><h3>Subsub</h3></div></body></html>',
+  '<div><strong>x</strong> and <em>y</em></div><p>para</p>'
+]
+
+MISTUNE_TEXT = [
+  'A plain note\n\nwith two paragraphs\nand a line break',
+  '* item one\n* item two\n\n1. first\n2. second',
+  '# Heading\n\nSome *emphasis* and **strong** text <not a tag> & more',
+  'See https://example.com/page?x=1 for details'
+]
+
+EMAIL_HTML = [
+  '<html><body style="word-wrap: break-word;"><div>Sent from my note</div><div><br></div><div><b>Bold</b> line</div></body></html>',
+  '<div dir="ltr">Hello<div>World</div></div>'
+]
+
+class MarkdownParserTest(unittest.TestCase):
+  def assertSameMarkdown(self, html):
+    self.assertEqual(common.MarkdownParser().convert(html), converters.Html2Markdown().convert(html))
+
+  def test_apple_notes(self):
+    for html in APPLE_NOTES_HTML:
+      with self.subTest(html=html):
+        self.assertSameMarkdown(html)
+
+  def test_mistune(self):
+    for text in MISTUNE_TEXT:
+      with self.subTest(text=text):
+        self.assertSameMarkdown(common.text_to_html(text))
+
+  def test_email(self):
+    for html in EMAIL_HTML:
+      with self.subTest(html=html):
+        self.assertSameMarkdown(html)
+
+  def test_unsupported(self):
+    for html in ['<table><tr><td>cell</td></tr></table>',
+                 '<div>text<!-- comment --></div>',
+                 '<div><marquee>text</marquee></div>',
+                 '<div class="a" class="b">text</div>',
+                 '<!DOCTYPE html><div>text</div>']:
+      with self.subTest(html=html):
+        with self.assertRaises(common.UnsupportedHtml):
+          common.MarkdownParser().convert(html)
+
+  def test_html_to_markdown_fallback(self):
+    # html2txt converts what the parser does not support
+    html = '<div>text<!-- comment --></div><table><tr><td>cell</td></tr></table>'
+    self.assertEqual(common.html_to_markdown(html), converters.Html2Markdown().convert(html))
+
+# Beginnings of the files attached to notes
+PNG_HEAD = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00'
+HEIC_HEAD = b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic\x00\x00\x01\x00meta'
+QUICKTIME_HEAD = b'\x00\x00\x00\x14ftypqt  \x00\x00\x02\x00qt  \x00\x00\x00\x08wide'
+
+class MimeTypeTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir_ = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tempdir_.cleanup()
+
+  def write_file(self, name, data):
+    filepath = os.path.join(self.tempdir_.name, name)
+    with open(filepath, 'wb') as fp:
+      fp.write(data)
+    return filepath
+
+  def test_magic(self):
+    for data, mimetype in [(PNG_HEAD, 'image/png'),
+                           (b'\xff\xd8\xff\xe0\x00\x10JFIF\x00', 'image/jpeg'),
+                           (b'GIF89a\x01\x00\x01\x00', 'image/gif'),
+                           (b'RIFF\x24\x00\x00\x00WEBPVP8 ', 'image/webp'),
+                           (b'RIFF\x24\x00\x00\x00WAVEfmt ', 'audio/x-wav'),
+                           (b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n', 'application/pdf'),
+                           (b'PK\x03\x04\x14\x00\x06\x00', 'application/zip'),
+                           (b'BEGIN:VCARD\r\nVERSION:3.0\r\n', 'text/vcard')]:
+      with self.subTest(mimetype=mimetype):
+        self.assertEqual(common.sniffFileMimeType(self.write_file('attachment', data)), mimetype)
+
+  def test_ftyp_brands(self):
+    self.assertEqual(common.sniffFileMimeType(self.write_file('photo', HEIC_HEAD)), 'image/heic')
+    self.assertEqual(common.sniffFileMimeType(self.write_file('movie', QUICKTIME_HEAD)), 'video/quicktime')
+    self.assertIsNone(common.sniffFileMimeType(self.write_file('unknown', b'\x00\x00\x00\x14ftypxxxx\x00\x00\x00\x00')))
+
+  def test_text(self):
+    for data, mimetype in [(b'A note about walruses\n', 'text/plain'),
+                           # a character cut off at the end of the bytes read
+                           (b'a' * (common.MIME_SNIFF_SIZE - 1) + '\u00e9'.encode('utf-8'), 'text/plain'),
+                           (b'  <!DOCTYPE html>\n<html><body></body></html>', 'text/html'),
+                           (b'<HTML><BODY>walrus</BODY></HTML>', 'text/html'),
+                           (b'<?xml version="1.0"?><plist></plist>', 'application/xml'),
+                           (b'\x00\x01\x02binary', None),
+                           (b'\xff\xfe\xfdnot utf-8', None),
+                           (b'', None)]:
+      with self.subTest(data=data[:16]):
+        self.assertEqual(common.sniffFileMimeType(self.write_file('attachment', data)), mimetype)
+
+  def test_file_mime_type(self):
+    # The extension is used when it is known, the contents otherwise
+    self.assertEqual(common.getFileMimeType(self.write_file('photo.png', b'not really a png')), ('image', 'png'))
+    self.assertEqual(common.getFileMimeType(self.write_file('IMG_0001', PNG_HEAD)), ('image', 'png'))
+    self.assertEqual(common.getFileMimeType(self.write_file('IMG_0002', HEIC_HEAD)), ('image', 'heic'))
+    self.assertEqual(common.getFileMimeType(self.write_file('IMG_0003', QUICKTIME_HEAD)), ('video', 'quicktime'))
+    self.assertEqual(common.getFileMimeType(self.write_file('data.unknownext', b'\x00\x01')), ('application', 'octet-stream'))
+    self.assertEqual(common.getFileMimeType(os.path.join(self.tempdir_.name, 'missing')), ('application', 'octet-stream'))
+    self.assertEqual(common.getFileMimeType(None), ('application', 'octet-stream'))
+
+if __name__ == "__main__":
+  unittest.main()
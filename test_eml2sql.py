@@ -0,0 +1,146 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import eml2sql
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Tests for reading note email messages (run with python3 -m unittest or
+# pytest).
+#
+
+# Messages read by the header-only fast path: single part text of the kind
+# Apple Notes stores in the Notes mailbox
+FAST_MESSAGES = [
+  b"Subject: Walrus\r\n"
+  b"X-Uniform-Type-Identifier: com.apple.mail-note\r\n"
+  b"X-Universally-Unique-Identifier: 6A1C2F6B-3D1E-4C5B-9E0A-2B7D8C9E0F1A\r\n"
+  b"X-Mail-Created-Date: Mon, 1 Jun 2020 10:00:00 +0000\r\n"
+  b"Date: Tue, 2 Jun 2020 11:30:00 +0000\r\n"
+  b"Message-Id: <1@example.com>\r\n"
+  b"Mime-Version: 1.0 (Mac OS X Notes 4.7)\r\n"
+  b"Content-Type: text/html; charset=utf-8\r\n"
+  b"Content-Transfer-Encoding: quoted-printable\r\n"
+  b"\r\n"
+  b"<div>Caf=C3=A9 notes about <b>walruses</b></div>=\r\n"
+  b"<div><br></div>\r\n",
+  b"Subject: =?utf-8?q?Caf=C3=A9?=\n"
+  b" and tea\n"
+  b"Date: Wed, 3 Jun 2020 09:00:00 -0400\n"
+  b"Content-Type: text/plain; charset=us-ascii\n"
+  b"Content-Transfer-Encoding: 7bit\n"
+  b"\n"
+  b"A plain note\n"
+  b"on two lines\n",
+  b"Subject: Base64\n"
+  b"Date: Thu, 4 Jun 2020 12:00:00 +0000\n"
+  b"Content-Type: text/plain; charset=utf-8\n"
+  b"Content-Transfer-Encoding: base64\n"
+  b"\n"
+  b"QSBub3RlIGFib3V0IHBlbmd1aW5zCg==\n"
+]
+
+# Messages read by the full parser
+FALLBACK_MESSAGES = [
+  b"Subject: Multipart\n"
+  b"Date: Fri, 5 Jun 2020 12:00:00 +0000\n"
+  b"Mime-Version: 1.0\n"
+  b"Content-Type: multipart/alternative; boundary=\"b1\"\n"
+  b"\n"
+  b"--b1\n"
+  b"Content-Type: text/plain; charset=utf-8\n"
+  b"\n"
+  b"Plain part\n"
+  b"--b1\n"
+  b"Content-Type: text/html; charset=utf-8\n"
+  b"\n"
+  b"<div>HTML part</div>\n"
+  b"--b1--\n",
+  b"Subject: Multipart CRLF\r\n"
+  b"Mime-Version: 1.0\r\n"
+  b"Content-Type: multipart/alternative; boundary=\"b2\"\r\n"
+  b"\r\n"
+  b"--b2\r\n"
+  b"Content-Type: text/html; charset=utf-8\r\n"
+  b"Content-Transfer-Encoding: quoted-printable\r\n"
+  b"\r\n"
+  b"<div>Caf=C3=A9</div>\r\n"
+  b"<div>notes</div>\r\n"
+  b"--b2--\r\n",
+  # headers that are not ASCII
+  b"Subject: Caf\xc3\xa9\n"
+  b"Date: Sat, 6 Jun 2020 12:00:00 +0000\n"
+  b"Content-Type: text/plain; charset=utf-8\n"
+  b"\n"
+  b"Not ASCII\n"
+]
+
+class ReadMessageTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir_ = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tempdir_.cleanup()
+
+  def write_message(self, data):
+    filename = os.path.join(self.tempdir_.name, 'note.eml')
+    with open(filename, 'wb') as fp:
+      fp.write(data)
+    return filename
+
+  def test_fast_path(self):
+    for data in FAST_MESSAGES:
+      with self.subTest(data=data):
+        filename = self.write_message(data)
+        with mock.patch('eml2sql._read_full_message', wraps=eml2sql._read_full_message) as read_full_message:
+          message = eml2sql.read_message(filename)
+          read_full_message.assert_not_called()
+        self.assertEqual(message, eml2sql._read_full_message(data))
+
+  def test_fallback(self):
+    for data in FALLBACK_MESSAGES:
+      with self.subTest(data=data):
+        filename = self.write_message(data)
+        with mock.patch('eml2sql._read_full_message', wraps=eml2sql._read_full_message) as read_full_message:
+          message = eml2sql.read_message(filename)
+          read_full_message.assert_called_once_with(data)
+        self.assertEqual(message, eml2sql._read_full_message(data))
+
+  def test_crlf(self):
+    # Line endings are read as LF whichever way the message is parsed (like
+    # email.message_from_binary_file)
+    email_body = eml2sql.read_message(self.write_message(FAST_MESSAGES[0]))[1]
+    self.assertEqual(email_body, '<div>Caf\u00e9 notes about <b>walruses</b></div><div><br></div>\n')
+    email_body = eml2sql.read_message(self.write_message(FALLBACK_MESSAGES[1]))[1]
+    self.assertEqual(email_body, '<div>Caf\u00e9</div>\n<div>notes</div>')
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import hashlib
+import tempfile
+import unittest
+
+import notesdb
+import common
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Tests for the notes database (run with python3 -m unittest or pytest).
+#
+
+DB_SCHEMA_VERSION = notesdb.migrations[-1][0]
+
+# Columns of the version 1 notes table (the notes table without
+# note_converter_version followed by the columns of the side tables)
+V1_COLUMNS = ([(name, "TEXT") for name in notesdb.coreColumns if name != "note_converter_version"] +
+  [(name, "TEXT") for name in notesdb.emailColumns] +
+  list(zip(notesdb.appleColumns, notesdb.appleColumnTypes)) +
+  list(zip(notesdb.joplinColumns, notesdb.joplinColumnTypes)))
+
+def create_v1_database(path, email_address, notes):
+  # Creates a database the way version 1 of the tools did (SHA-512 hex
+  # digests in note_hash, apple_data and email_* in the notes table)
+  sqlconn = sqlite3.connect(os.path.join(path, 'notesdb.sqlite'))
+  sqlconn.execute('''CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT);''')
+  sqlconn.execute('''INSERT INTO settings (name, value) VALUES (?, ?);''', ('email_address', email_address))
+  sqlconn.execute('''INSERT INTO settings (name, value) VALUES (?, ?);''', ('db_version', '1'))
+  sqlconn.execute('''CREATE TABLE "notes" ("note_id" INTEGER, %s, PRIMARY KEY("note_id"));'''
+    % (', '.join(['''"%s" %s''' % (name, type_) for name, type_ in V1_COLUMNS]),))
+  sqlconn.execute('''CREATE INDEX "hashidx" ON "notes" ("note_hash");''')
+  for columns in notes:
+    columns = dict(columns)
+    columns["note_hash"] = hashlib.sha512(columns["note_data"].encode('utf-8')).hexdigest()
+    sqlconn.execute('''INSERT INTO notes (%s) VALUES (%s);''' % (', '.join(columns.keys()), ', '.join(['?'] * len(columns))),
+      list(columns.values()))
+  sqlconn.commit()
+  sqlconn.close()
+
+def apple_note(note_data, **columns):
+  # Columns of an Apple note as the loaders pass them to add_apple_note
+  note = dict.fromkeys(notesdb.coreColumns + notesdb.appleColumns)
+  note.update({"note_type": "note", "note_original_format": "apple", "note_data": note_data,
+    "note_data_format": "text/markdown", "note_hash": common.note_fingerprint(note_data)})
+  note.update(columns)
+  return note
+
+class DuplicateNotesTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir_ = tempfile.TemporaryDirectory()
+    self.path_ = self.tempdir_.name
+    self.sqlconn_, db_settings = notesdb.open_database(self.path_, 'me@example.com', '1.00', '1', DB_SCHEMA_VERSION,
+      create=True)
+    self.first_ = apple_note('A note about walruses', note_title='Walrus', note_internal_date='2020-01-02',
+      apple_folder='Notes', apple_id=1)
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, self.first_), 1)
+
+  def tearDown(self):
+    self.sqlconn_.close()
+    self.tempdir_.cleanup()
+
+  def note(self, note_id):
+    return self.sqlconn_.execute('''SELECT notes.note_title, notes.note_url, notes.note_internal_date,
+note_apple.apple_id, note_apple.apple_folder, note_apple.apple_title FROM notes
+LEFT JOIN note_apple ON note_apple.note_id = notes.note_id WHERE notes.note_id = ?''', (note_id,)).fetchone()
+
+  def count_notes(self):
+    return self.sqlconn_.execute('''SELECT COUNT(*) FROM notes''').fetchone()[0]
+
+  def test_keep_first(self):
+    duplicate = apple_note('A note about walruses', note_title='Walrus again', note_internal_date='2021-01-01',
+      apple_folder='Archive', apple_id=2)
+    self.assertIsNone(notesdb.add_apple_note(self.sqlconn_, duplicate, "keep-first"))
+    self.assertEqual(self.count_notes(), 1)
+    self.assertEqual(self.note(1), ('Walrus', None, '2020-01-02', 1, 'Notes', None))
+
+  def test_keep_newest(self):
+    older = apple_note('A note about walruses', note_title='Older walrus', note_internal_date='2019-01-01',
+      apple_folder='Archive', apple_id=2)
+    self.assertIsNone(notesdb.add_apple_note(self.sqlconn_, older, "keep-newest"))
+    self.assertEqual(self.note(1), ('Walrus', None, '2020-01-02', 1, 'Notes', None))
+
+    newer = apple_note('A note about walruses', note_title='Newer walrus', note_internal_date='2021-01-01',
+      apple_folder='Archive', apple_id=3)
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, newer, "keep-newest"), 1)
+    self.assertEqual(self.count_notes(), 1)
+    # the side table row is replaced along with the note
+    self.assertEqual(self.note(1), ('Newer walrus', None, '2021-01-01', 3, 'Archive', None))
+
+  def test_merge_metadata(self):
+    duplicate = apple_note('A note about walruses', note_title='Walrus again', note_url='https://example.com/walrus',
+      note_internal_date='2021-01-01', apple_folder='Archive', apple_id=2, apple_title='Walrus')
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, duplicate, "merge-metadata"), 1)
+    self.assertEqual(self.count_notes(), 1)
+    # only the columns that were NULL are filled in
+    self.assertEqual(self.note(1), ('Walrus', 'https://example.com/walrus', '2020-01-02', 1, 'Notes', 'Walrus'))
+    # nothing left to merge
+    self.assertIsNone(notesdb.add_apple_note(self.sqlconn_, duplicate, "merge-metadata"))
+
+  def test_other_note_types(self):
+    # Only notes are unique by hash (e.g. not folders with the same title)
+    folder = apple_note('Walrus', note_type='folder')
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, folder), 2)
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, folder), 3)
+    self.assertEqual(notesdb.add_apple_note(self.sqlconn_, apple_note('Walrus')), 4)
+    self.assertIsNone(notesdb.add_apple_note(self.sqlconn_, apple_note('Walrus')))
+    self.assertEqual(self.count_notes(), 4)
+
+class MigrateDatabaseTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir_ = tempfile.TemporaryDirectory()
+    self.path_ = self.tempdir_.name
+
+  def tearDown(self):
+    self.tempdir_.cleanup()
+
+  def test_migrate_v1_database(self):
+    apple_text = '<div>Apple note about <b>walruses</b></div>'
+    create_v1_database(self.path_, 'me@example.com', [
+      {"note_type": "note", "note_original_format": "apple", "note_title": "Walrus",
+       "note_data": apple_text, "note_data_format": "text/html",
+       "apple_id": 1, "apple_folder": "Notes", "apple_data": apple_text},
+      {"note_type": "note", "note_original_format": "email", "note_title": "Penguin",
+       "note_data": "An email about penguins", "note_data_format": "text/plain",
+       "email_subject": "Penguin", "email_body": "An email about penguins"},
+      # same text as the first note
+      {"note_type": "note", "note_original_format": "apple", "note_title": "Walrus again",
+       "note_data": apple_text, "note_data_format": "text/html", "apple_id": 2}
+    ])
+
+    sqlconn, db_settings = notesdb.open_database(self.path_, 'me@example.com', '1.00', '1', DB_SCHEMA_VERSION,
+      migrate=True)
+    sqlcur = sqlconn.cursor()
+
+    self.assertEqual(db_settings['db_version'], DB_SCHEMA_VERSION)
+    sqlcur.execute('''SELECT note_id, note_title, typeof(note_hash) FROM notes ORDER BY note_id''')
+    self.assertEqual(sqlcur.fetchall(), [(1, 'Walrus', 'blob'), (2, 'Penguin', 'blob')])
+    # apple_data is not stored when it is the same as note_data
+    sqlcur.execute('''SELECT note_id, apple_folder, apple_data FROM note_apple''')
+    self.assertEqual(sqlcur.fetchall(), [(1, 'Notes', None)])
+    sqlcur.execute('''SELECT note_id, email_subject FROM note_email''')
+    self.assertEqual(sqlcur.fetchall(), [(2, 'Penguin')])
+
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'walruses')], [1])
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'penguins')], [2])
+    # the search index follows changes to notes
+    sqlconn.execute('''UPDATE notes SET note_data = ? WHERE note_id = 2''', ('An email about puffins',))
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'penguins')], [])
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'puffins')], [2])
+    sqlconn.close()
+
+    # An uncompressed database can be changed without the functions that
+    # open_database adds (e.g. with the sqlite3 shell)
+    sqlconn = sqlite3.connect(os.path.join(self.path_, 'notesdb.sqlite'))
+    sqlconn.execute('''UPDATE notes SET note_data = ? WHERE note_id = 2''', ('An email about gannets',))
+    sqlconn.execute('''INSERT INTO notes (note_type, note_title, note_data) VALUES ('note', 'Tern', 'A note about terns')''')
+    sqlcur = sqlconn.cursor()
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'gannets OR terns')], [2, 3])
+    sqlcur.execute('''SELECT note_data FROM notes_text WHERE note_id = 3''')
+    self.assertEqual(sqlcur.fetchall(), [('A note about terns',)])
+    sqlconn.close()
+
+  def test_migrate_v2_duplicates(self):
+    create_v1_database(self.path_, 'me@example.com', [
+      {"note_type": "note", "note_title": "Walrus", "note_data": "A note about walruses", "apple_id": 1, "apple_folder": "Notes"},
+      {"note_type": "note", "note_title": "Walrus again", "note_data": "A note about walruses", "apple_id": 2,
+       "apple_folder": "Archive", "email_subject": "Walrus"},
+      {"note_type": "folder", "note_title": "Notes", "note_data": "Notes"},
+      {"note_type": "folder", "note_title": "Notes", "note_data": "Notes"}
+    ])
+    sqlconn, db_settings = notesdb.open_database(self.path_, 'me@example.com', '1.00', '1', '2', migrate=True)
+    for note_id in [1, 2]:
+      notesdb.add_note_resources(sqlconn, note_id, [('a' * 32, '/resources/%s.png' % ('a' * 32,), 'image/png', 1)])
+    sqlconn.commit()
+    sqlcur = sqlconn.cursor()
+    sqlcur.execute('''SELECT note_id FROM note_email''')
+    self.assertEqual(sqlcur.fetchall(), [(2,)])
+
+    notesdb.migrate_database(sqlconn, DB_SCHEMA_VERSION)
+    sqlcur.execute('''SELECT note_id, note_type FROM notes ORDER BY note_id''')
+    self.assertEqual(sqlcur.fetchall(), [(1, 'note'), (3, 'folder'), (4, 'folder')])
+    sqlcur.execute('''SELECT note_id, apple_folder FROM note_apple ORDER BY note_id''')
+    self.assertEqual(sqlcur.fetchall(), [(1, 'Notes')])
+    sqlcur.execute('''SELECT note_id FROM note_email''')
+    self.assertEqual(sqlcur.fetchall(), [])
+    sqlcur.execute('''SELECT note_id FROM note_resources''')
+    self.assertEqual(sqlcur.fetchall(), [(1,)])
+    sqlconn.close()
+
+  def test_resume_rehash(self):
+    create_v1_database(self.path_, 'me@example.com', [
+      {"note_type": "note", "note_title": "Walrus", "note_data": "A note about walruses"},
+      {"note_type": "note", "note_title": "Penguin", "note_data": "A note about penguins"},
+      {"note_type": "note", "note_title": "Tern", "note_data": "A note about terns"},
+      {"note_type": "note", "note_title": "Gannet", "note_data": "A note about gannets"}
+    ])
+    sqlconn, db_settings = notesdb.open_database(self.path_, 'me@example.com', '1.00', '1', '3', migrate=True)
+
+    # An upgrade to version 4 interrupted after rehashing the first two notes
+    sqlconn.execute('''DROP INDEX IF EXISTS "hashidx";''')
+    sqlconn.execute('''UPDATE notes SET note_hash = note_fingerprint(note_data) WHERE note_id <= 2''')
+    # the text of the last note was changed to the text of the first one
+    # without updating its hash
+    sqlconn.execute('''UPDATE notes SET note_data = 'A note about walruses' WHERE note_id = 4''')
+    sqlconn.commit()
+    sqlcur = sqlconn.cursor()
+    sqlcur.execute('''SELECT note_id, typeof(note_hash) FROM notes ORDER BY note_id''')
+    self.assertEqual(sqlcur.fetchall(), [(1, 'blob'), (2, 'blob'), (3, 'text'), (4, 'text')])
+
+    db_settings = notesdb.migrate_database(sqlconn, DB_SCHEMA_VERSION, chunk_size=1)
+    self.assertEqual(db_settings['db_version'], DB_SCHEMA_VERSION)
+    sqlcur.execute('''SELECT note_id, note_data, note_hash FROM notes ORDER BY note_id''')
+    rows = sqlcur.fetchall()
+    self.assertEqual([row[0] for row in rows], [1, 2, 3])
+    for note_id, note_data, note_hash in rows:
+      self.assertEqual(note_hash, common.note_fingerprint(note_data))
+    sqlcur.execute('''SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?''', ('hashidx',))
+    self.assertEqual(sqlcur.fetchall(), [('hashidx',)])
+    sqlconn.close()
+
+class CompressDatabaseTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir_ = tempfile.TemporaryDirectory()
+    self.path_ = self.tempdir_.name
+
+  def tearDown(self):
+    self.tempdir_.cleanup()
+
+  def test_compress_database(self):
+    apple_text = '<div>Apple note about walruses</div>' * 100
+    create_v1_database(self.path_, 'me@example.com', [
+      {"note_type": "note", "note_original_format": "apple", "note_title": "Walrus",
+       "note_data": apple_text, "note_data_format": "text/html",
+       "apple_id": 1, "apple_folder": "Notes", "apple_data": apple_text}
+    ])
+    sqlconn, db_settings = notesdb.open_database(self.path_, 'me@example.com', '1.00', '1', DB_SCHEMA_VERSION,
+      migrate=True)
+    sqlcur = sqlconn.cursor()
+
+    notesdb.compress_database(sqlconn, "zlib")
+    sqlcur.execute('''SELECT typeof(note_data), note_text(note_data) FROM notes''')
+    self.assertEqual(sqlcur.fetchall(), [('blob', apple_text)])
+    # apple_data is still not stored
+    sqlcur.execute('''SELECT apple_data FROM note_apple''')
+    self.assertEqual(sqlcur.fetchall(), [(None,)])
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'walruses')], [1])
+
+    notesdb.compress_database(sqlconn, "none")
+    sqlcur.execute('''SELECT typeof(note_data), note_data FROM notes''')
+    self.assertEqual(sqlcur.fetchall(), [('text', apple_text)])
+    sqlcur.execute('''SELECT apple_data FROM note_apple''')
+    self.assertEqual(sqlcur.fetchall(), [(None,)])
+    sqlconn.close()
+
+    sqlconn = sqlite3.connect(os.path.join(self.path_, 'notesdb.sqlite'))
+    sqlconn.execute('''UPDATE notes SET note_data = 'A note about terns' WHERE note_id = 1''')
+    sqlcur = sqlconn.cursor()
+    self.assertEqual([row[0] for row in notesdb.search_notes(sqlcur, 'terns')], [1])
+    sqlconn.close()
+
+if __name__ == "__main__":
+  unittest.main()
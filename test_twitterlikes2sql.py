@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+
+import common
+import twitterlikes2sql
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Tests for splitting and expanding the text of tweets (run with python3 -m
+# unittest or pytest).
+#
+
+def split_tweet_line(line):
+  # How formatTwitterUrls split a line into words before TWEET_WORD_RE
+  line = line.replace("\u2066", " ")
+  line = line.replace("\u2069", " ")
+  line = line.replace("https://", " https://")
+  line = line.replace("http://", " http://")
+  return line.split()
+
+TWEET_LINES = [
+  'Walruses \u2066@walrus\u2069 and \u2066@tusks\u2069 #arctic #ice',
+  'Photo https://twitter.com/walrus/status/1/photo/1',
+  'see:https://example.com/ahttp://example.com/b and https://t.co/abcdefghij.',
+  '\u2066@walrus\u2069https://t.co/abcdefghij',
+  '  spaces\tand\ttabs  ',
+  '',
+  'https://https://'
+]
+
+# Expansions of the links used below, so nothing is fetched
+URL_DICT = {
+  'https://t.co/abcdefghij': 'https://example.com/walrus',
+  'http://t.co/xyz': 'http://example.com/tern',
+  'https://example.com/gannet': 'https://example.com/gannet'
+}
+
+class TweetWordsTest(unittest.TestCase):
+  def test_tweet_words(self):
+    for line in TWEET_LINES:
+      with self.subTest(line=line):
+        self.assertEqual(twitterlikes2sql.TWEET_WORD_RE.findall(line), split_tweet_line(line))
+
+class ExpandUrlsTest(unittest.TestCase):
+  def test_expand_urls(self):
+    txt = '\n\nRead this:https://t.co/abcdefghijand that http://t.co/xyz!\n\nhttps://t.co/abcdefghij again https://example.com/gannet'
+    with mock.patch('common.unshorten_url', wraps=common.unshorten_url) as unshorten_url:
+      expanded, url_dict, error_dict = common.expand_urls(txt, dict(URL_DICT), {})
+    # t.co links are spaced out, each url is expanded once and the lines
+    # before the first line with text are left out
+    self.assertEqual(expanded, 'Read this: https://example.com/walrus and that http://example.com/tern !\n\n'
+      'https://example.com/walrus again https://example.com/gannet')
+    self.assertEqual(sorted([call.args[0] for call in unshorten_url.call_args_list]),
+      ['http://t.co/xyz', 'https://example.com/gannet', 'https://t.co/abcdefghij'])
+    self.assertEqual(error_dict, {})
+
+  def test_space_tco_links(self):
+    for s in ['ahttps://t.co/abcdefghijb', 'http://t.co/xyz,https://t.co/abcdefghij', 'x http://t.co/a1b2.c']:
+      with self.subTest(s=s):
+        self.assertEqual(common.space_tco_links(s), common.space_http_tco_links(common.space_https_tco_links(s)))
+
+if __name__ == "__main__":
+  unittest.main()
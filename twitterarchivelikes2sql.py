@@ -7,16 +7,8 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 from datetime import datetime
 
-import hashlib
-
 import notesdb
 import common
 import constants
@@ -59,8 +51,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -80,9 +72,18 @@ def _get_option_parser():
     parser.add_option("", "--error",
                       action="store", dest="error_dict", default=None,
                       help="JSON dictionary containing unexpanded URLs and errors")                                         
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
-def process_twitter_archive_note(sqlconn, columns):
+def process_twitter_archive_note(sqlconn, columns, on_duplicate):
   # note_title
   if columns["note_title"] is None:
     note_title = constants.NOTES_UNTITLED
@@ -108,10 +109,8 @@ def process_twitter_archive_note(sqlconn, columns):
   # note_data_format
   note_data_format = columns['note_data_format']
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   # apple_id
   apple_id = None
@@ -180,7 +179,7 @@ def process_twitter_archive_note(sqlconn, columns):
   columns["apple_user"] = apple_user
   columns["apple_source"] = apple_source
 
-  notesdb.add_apple_note(sqlconn, columns)
+  notesdb.add_apple_note(sqlconn, columns, on_duplicate)
   sqlconn.commit()
 
 def main(args):
@@ -232,28 +231,18 @@ def main(args):
 
   twitterdbfile = inputPath
 
-  notesdbfile = os.path.join(outputPath, 'notesdb.sqlite')
-
   if not os.path.isfile(twitterdbfile):
     common.error("input file does not exist")
 
-  new_database = (not os.path.isfile(notesdbfile))
-
   twitter_sqlconn = sqlite3.connect(twitterdbfile,
     detect_types=sqlite3.PARSE_DECLTYPES)
   twitter_sqlconn.row_factory = sqlite3.Row
   twitter_sqlcur = twitter_sqlconn.cursor()
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   twitter_sqlcur.execute('''SELECT tweetId, 
 fullText, 
 expandedUrl
@@ -289,7 +278,7 @@ FROM archive_like''')
     columns["apple_created"] = add_date.strftime("%Y-%m-%d %H:%M:%S.%f")
     columns["apple_last_modified"] = columns["apple_created"]
 
-    process_twitter_archive_note(sqlconn, columns)
+    process_twitter_archive_note(sqlconn, columns, options.on_duplicate)
  
   sqlconn.commit()
 
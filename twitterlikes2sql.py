@@ -8,16 +8,8 @@ import sqlite3
 import uuid
 import json
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
 from datetime import datetime, timezone
 
-import hashlib
-
 import notesdb
 import common
 import constants
@@ -60,8 +52,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -81,6 +73,15 @@ def _get_option_parser():
     parser.add_option("", "--error",
                       action="store", dest="error_dict", default=None,
                       help="JSON dictionary containing unexpanded URLs and errors")                                         
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
 def makeTwitterTweetUrl(status_id):
@@ -122,21 +123,32 @@ def formatTwitterFrom(screen_name, name, profile_image_url):
 """
   return (txt % (profile_image_url, screen_name, name, screen_name, screen_name))
 
-def getTwitterMediaInfo(expanded_url, cursor):
-  query = ("""SELECT media_url_https, type as media_type, sizes, video_info, additional_media_info, source_status_id, source_user_id FROM media
-WHERE expanded_url = "%s" """ % (expanded_url,))
-  cursor.execute(query)
-  results = cursor.fetchall()
-  for row in results:
-    media_url_https = row['media_url_https']
-    media_type = row['media_type']
-    sizes = row['sizes']
-    video_info = row['video_info']
-    additional_media_info = row['additional_media_info']
-    source_status_id = row['source_status_id']
-    source_user_id = row['source_user_id']
-    return (media_url_https, media_type, sizes, video_info, additional_media_info, source_status_id, source_user_id)
-  return None
+def getTwitterMediaInfo(expanded_urls, cursor, media_dict):
+  # Looks up the media of the urls not already in media_dict, a few hundred
+  # urls per query, and adds them to it (None for urls without media)
+  lookup_urls = list(dict.fromkeys([url for url in expanded_urls if url not in media_dict]))
+  found = {}
+  # Stay well below SQLite's limit on the number of query parameters
+  for start in range(0, len(lookup_urls), 500):
+    chunk = lookup_urls[start:start + 500]
+    query = ("""SELECT expanded_url, media_url_https, type as media_type, sizes, video_info, additional_media_info, source_status_id, source_user_id FROM media
+WHERE expanded_url IN (%s)""" % (",".join(["?"] * len(chunk)),))
+    cursor.execute(query, chunk)
+    results = cursor.fetchall()
+    for row in results:
+      if row['expanded_url'] in found:
+        continue
+      media_url_https = row['media_url_https']
+      media_type = row['media_type']
+      sizes = row['sizes']
+      video_info = row['video_info']
+      additional_media_info = row['additional_media_info']
+      source_status_id = row['source_status_id']
+      source_user_id = row['source_user_id']
+      found[row['expanded_url']] = (media_url_https, media_type, sizes, video_info, additional_media_info, source_status_id, source_user_id)
+  for url in lookup_urls:
+    media_dict[url] = found.get(url)
+  return media_dict
 
 def getMediaWidthHeight(sizes):
   sizes_dict = json.loads(sizes)
@@ -204,34 +216,30 @@ def IsTwitterVideoUrl(url):
 def IsTwitterMediaUrl(url):
   return IsTwitterPhotoUrl(url) or IsTwitterVideoUrl(url)
 
-def formatTwitterUrls(txt, cursor):
-  lines = txt.splitlines()
-  expanded_lines = ""
-  for line in lines:
-    line = line.replace("\u2066", " ")
-    line = line.replace("\u2069", " ")
-    line = line.replace("https://", " https://")
-    line = line.replace("http://", " http://")
-    words = line.split()
-    expanded_line = ""
+# Words of a tweet: text is split on whitespace and the \u2066/\u2069
+# isolates around mentions, and before each http:// or https://
+TWEET_WORD_RE = re.compile(r'https?://(?:(?!https?://)[^\s\u2066\u2069])*|(?:(?!https?://)[^\s\u2066\u2069])+')
+
+def formatTwitterUrls(txt, cursor, media_dict):
+  lines = [TWEET_WORD_RE.findall(line) for line in txt.splitlines()]
+  media_urls = [word for words in lines for word in words if IsTwitterMediaUrl(word)]
+  media_dict = getTwitterMediaInfo(media_urls, cursor, media_dict)
+  expanded_lines = []
+  for words in lines:
+    expanded_words = []
     for word in words:
-      if IsTwitterMediaUrl(word):
-        media_info = getTwitterMediaInfo(word, cursor)
-        if media_info is None:
-          pass
-        else:
+      if word in media_dict:
+        media_info = media_dict[word]
+        if media_info is not None:
           word = formatTwitterMedia(word, media_info)
       elif word[0:1] == "@":
         word = formatTwitterUrl(word, makeTwitterScreennameUrl(word))
       elif word[0:1] == "#":
         word = formatTwitterUrl(word, makeTwitterHashtagUrl(word))
-      if expanded_line != "":
-        expanded_line += " "
-      expanded_line += word
-    if expanded_lines != "":
-      expanded_lines += "\n"
-    expanded_lines += expanded_line
-  return expanded_lines
+      expanded_words.append(word)
+    expanded_lines.append(" ".join(expanded_words))
+  # Lines before the first line with text are left out
+  return ("\n".join(expanded_lines).lstrip("\n"), media_dict)
 
 def formatTwitterReplyingTo(display, link):
   txt = """Replying to
@@ -258,7 +266,7 @@ WHERE id = "%s" """ % (source_id,))
     return (name, url)
   return ("Twitter Web App", "https://help.twitter.com/using-twitter/how-to-tweet#source-labels")
 
-def process_twitter_note(sqlconn, columns):
+def process_twitter_note(sqlconn, columns, on_duplicate):
   # note_title
   if columns["note_title"] is None:
     note_title = constants.NOTES_UNTITLED
@@ -284,10 +292,8 @@ def process_twitter_note(sqlconn, columns):
   # note_data_format
   note_data_format = columns['note_data_format']
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   # apple_id
   apple_id = None
@@ -356,7 +362,7 @@ def process_twitter_note(sqlconn, columns):
   columns["apple_user"] = apple_user
   columns["apple_source"] = apple_source
 
-  notesdb.add_apple_note(sqlconn, columns)
+  notesdb.add_apple_note(sqlconn, columns, on_duplicate)
   sqlconn.commit()
 
 def main(args):
@@ -408,28 +414,18 @@ def main(args):
 
   twitterdbfile = inputPath
 
-  notesdbfile = os.path.join(outputPath, 'notesdb.sqlite')
-
   if not os.path.isfile(twitterdbfile):
     common.error("input file does not exist")
 
-  new_database = (not os.path.isfile(notesdbfile))
-
   twitter_sqlconn = sqlite3.connect(twitterdbfile,
     detect_types=sqlite3.PARSE_DECLTYPES)
   twitter_sqlconn.row_factory = sqlite3.Row
   twitter_sqlcur = twitter_sqlconn.cursor()
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
   twitter_sqlcur.execute('''SELECT tweets.id as id, 
 tweets.user as user_id, 
 screen_name, 
@@ -443,6 +439,8 @@ FROM tweets
 INNER JOIN users ON tweets.user = users.id''')
 
   notes_to_convert_results = twitter_sqlcur.fetchall()
+  # Media of the tweets by expanded url
+  media_dict = {}
   current = 0
   for row in notes_to_convert_results:
     note_folder = "Twitter"
@@ -451,7 +449,7 @@ INNER JOIN users ON tweets.user = users.id''')
 
     note_url  = makeTwitterTweetUrl(row['id'])
     note_text, url_dict, error_dict = common.expand_urls(row['full_text'], url_dict, error_dict)
-    media_note_text = formatTwitterUrls(note_text, twitter_sqlconn.cursor())
+    media_note_text, media_dict = formatTwitterUrls(note_text, twitter_sqlconn.cursor(), media_dict)
     note_title = common.defaultTitleFromBody(note_text.splitlines()[0])
 
 # # NOTE: Change CSS in Joplin instead of putting CSS in markdown
@@ -495,7 +493,7 @@ INNER JOIN users ON tweets.user = users.id''')
     columns["apple_created"] = add_date.strftime("%Y-%m-%d %H:%M:%S.%f")
     columns["apple_last_modified"] = columns["apple_created"]
 
-    process_twitter_note(sqlconn, columns)
+    process_twitter_note(sqlconn, columns, options.on_duplicate)
  
   sqlconn.commit()
 
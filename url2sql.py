@@ -7,25 +7,21 @@ import optparse
 import sqlite3
 import uuid
 
-import email
-import email.utils
-from email.message import EmailMessage
-from email.parser import BytesParser, Parser
-from email.policy import default
-
-from bs4 import BeautifulSoup
-
 from datetime import datetime, timedelta, timezone
 
-import hashlib
-
 import plistlib
+import json
 
 import urllib
 from urllib.parse import urlparse
-import urllib.request
 
 import html
+import html.parser
+import codecs
+import itertools
+import collections
+import threading
+import concurrent.futures
 
 import notesdb
 import constants
@@ -69,8 +65,8 @@ __email__ = 'rene.sugar@gmail.com'
 __version__ = '1.00'
 __license__ = 'MIT License (https://opensource.org/licenses/MIT)'
 __website__ = 'https://github.com/renesugar'
-__db_schema_version__ = '1'
-__db_schema_min_version__ = '1'
+__db_schema_version__ = '5'
+__db_schema_min_version__ = '4'
 
 def _get_option_parser():
     parser = optparse.OptionParser('%prog [options]',
@@ -80,16 +76,350 @@ def _get_option_parser():
                       help="Email address")
     parser.add_option("", "--input",
                       action="store", dest="input_path", default=[],
-                      help="Path to input URL bookmarks")
+                      help="Path to input URL bookmarks ('-' reads text or JSONL bookmarks from stdin)")
+    parser.add_option('', "--format",
+                      action="store", dest="input_format", type="choice", choices=list(bookmark_readers.keys()), default="text",
+                      help="Format of the input: text, jsonl, firefox (places.sqlite), chrome (Bookmarks) or safari (Bookmarks.plist) (default: text)")
+    parser.add_option('', "--batch-size",
+                      action="store", dest="batch_size", type="int", default=1000,
+                      help="Number of bookmarks read, titled and written per transaction")
     parser.add_option('', "--output",
                       action="store", dest="output_path", default=None,
                       help="Path to output SQLite directory")
     parser.add_option("", "--folder",
                       action="store", dest="note_folder", default="Bookmarks",
                       help="Folder name to store bookmark notes")
+    parser.add_option('', "--fetch-threads",
+                      action="store", dest="fetch_threads", type="int", default=16,
+                      help="Number of page titles fetched at the same time (default: 16)")
+    parser.add_option('', "--host-connections",
+                      action="store", dest="host_connections", type="int", default=2,
+                      help="Number of page titles fetched from the same host at the same time (default: 2)")
+    parser.add_option('', "--timeout",
+                      action="store", dest="timeout", type="float", default=10,
+                      help="Seconds to wait for a web server to connect or send data (default: 10)")
+    parser.add_option('', "--max-title-bytes",
+                      action="store", dest="max_title_bytes", type="int", default=262144,
+                      help="Bytes of a web page read to find its title (default: 262144)")
+    parser.add_option('', "--refetch-titles",
+                      action="store_true", dest="refetch_titles", default=False,
+                      help="Fetch titles again for pages that had no title")
+    parser.add_option('', "--on-duplicate",
+                      action="store", dest="on_duplicate", type="choice", choices=list(notesdb.duplicate_policies.keys()), default="keep-first",
+                      help="What to do with a note that is already in the database: keep-first (skip it), keep-newest (replace the loaded note if this one is newer) or merge-metadata (fill in the fields the loaded note is missing) (default: keep-first)")
+    parser.add_option('', "--migrate",
+                      action="store_true", dest="migrate", default=False,
+                      help="Upgrade the database if it was created by an older version of the database schema")
+    parser.add_option('', "--db-preset",
+                      action="store", dest="db_preset", type="choice", choices=list(notesdb.db_presets.keys()), default="load",
+                      help="SQLite settings for the database: load (bulk loading), export (read-mostly) or default (default: load)")
     return parser
 
-def process_url_note(sqlconn, columns):
+HTML_CONTENT_TYPES = ["text/html", "application/xhtml+xml"]
+
+META_CHARSET_RE = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?([-\w.:]+)''', re.IGNORECASE)
+
+class TitleParser(html.parser.HTMLParser):
+  # Collects the text of the <title> element of an HTML page fed to it a
+  # chunk at a time
+  def __init__(self):
+    super().__init__()
+    self.in_title_ = False
+    self.done_ = False
+    self.title_ = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag == 'title' and not self.done_:
+      self.in_title_ = True
+    elif tag == 'body':
+      # The title is in the head of the page
+      self.done_ = True
+
+  def handle_endtag(self, tag):
+    if tag == 'title' and self.in_title_:
+      self.in_title_ = False
+      self.done_ = True
+
+  def handle_data(self, data):
+    if self.in_title_:
+      self.title_.append(data)
+
+  def title(self):
+    title = ''.join(self.title_).strip()
+    if title == '':
+      return None
+    return title
+
+_sessions = threading.local()
+
+def get_session():
+  # One session per thread, keeping connections to the hosts it has
+  # fetched from open for the next request
+  session = getattr(_sessions, 'session', None)
+  if session is None:
+    import requests
+    session = requests.Session()
+    _sessions.session = session
+  return session
+
+def page_encoding(content_type, data):
+  # Character set from the Content-Type header or a <meta> tag, or UTF-8
+  for param in content_type.split(';')[1:]:
+    name, _, value = param.partition('=')
+    if name.strip().lower() == 'charset' and value.strip() != '':
+      encoding = value.strip().strip('"\'')
+      break
+  else:
+    match = META_CHARSET_RE.search(data)
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+  try:
+    codecs.lookup(encoding)
+  except LookupError:
+    encoding = 'utf-8'
+  return encoding
+
+def fetch_title(url, timeout, max_bytes):
+  # Returns the title of an HTML page, reading the page only until the end
+  # of the title or max_bytes
+  with get_session().get(url, stream=True, timeout=timeout) as response:
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.split(';')[0].strip().lower() not in HTML_CONTENT_TYPES:
+      return None
+    parser = TitleParser()
+    decoder = None
+    size = 0
+    for chunk in response.iter_content(chunk_size=16384):
+      if decoder is None:
+        decoder = codecs.getincrementaldecoder(page_encoding(content_type, chunk))(errors='replace')
+      parser.feed(decoder.decode(chunk))
+      size += len(chunk)
+      if parser.done_ or size >= max_bytes:
+        break
+    return parser.title()
+
+class HostLimiter(object):
+  # Limits the number of requests made to each host at the same time
+  def __init__(self, limit):
+    self.limit_ = limit
+    self.lock_ = threading.Lock()
+    self.semaphores_ = {}
+
+  def semaphore(self, url):
+    host = urlparse(url).netloc.lower()
+    with self.lock_:
+      if host not in self.semaphores_:
+        self.semaphores_[host] = threading.BoundedSemaphore(self.limit_)
+      return self.semaphores_[host]
+
+def _fetch_title_limited(url, host_limiter, timeout, max_bytes):
+  with host_limiter.semaphore(url):
+    try:
+      return (url, fetch_title(url, timeout, max_bytes), True)
+    except Exception as e:
+      print("WARNING: title of '%s' not fetched (%s)" % (url, e))
+      return (url, None, False)
+
+def fetch_titles(urls, threads, host_connections, timeout, max_bytes):
+  # Fetches the titles of the urls concurrently, yielding (url, title,
+  # fetched) as each page is read (fetched is False if the page could not
+  # be read, e.g. the server did not respond). Urls are interleaved by host so that threads are not
+  # all waiting on the same host.
+  by_host = collections.OrderedDict()
+  for url in urls:
+    by_host.setdefault(urlparse(url).netloc.lower(), []).append(url)
+  ordered = [url for group in itertools.zip_longest(*by_host.values()) for url in group if url is not None]
+
+  host_limiter = HostLimiter(host_connections)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+    futures = [executor.submit(_fetch_title_limited, url, host_limiter, timeout, max_bytes) for url in ordered]
+    for future in concurrent.futures.as_completed(futures):
+      yield future.result()
+
+DATA_FILE_EXTENSIONS = [
+  ".png",
+  ".jpeg",
+  ".jpg",
+  ".bmp",
+  ".txt",
+  ".pdf",
+  ".zip",
+  ".csv",
+  ".xls",
+  ".gzip",
+  ".gz",
+  ".7z",
+  ".xlsx",
+]
+
+# Chrome timestamps are microseconds since 1601-01-01 UTC
+CHROME_EPOCH = datetime(1601, 1, 1)
+
+# Bookmarks are (note_title, add_date, last_modified, note_url) with dates
+# as naive UTC datetimes
+
+def _utc_now():
+  return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _utc_timestamp(seconds):
+  return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+def _utc_datetime(value):
+  if value.tzinfo is not None:
+    value = value.astimezone(timezone.utc).replace(tzinfo=None)
+  return value
+
+def _open_input(input_path):
+  if input_path == '-':
+    return open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)
+  return open(input_path, 'r', encoding='utf-8')
+
+def read_text_bookmarks(input_path):
+  # File consists of a title line followed by date created, date modified and a URL line
+  # for each bookmark
+  with _open_input(input_path) as fp:
+    while True:
+      lines = list(itertools.islice(fp, 4))
+      if len(lines) == 0:
+        break
+      if len(lines) != 4:
+        print("Error: Uneven number of lines in file.\n")
+        sys.exit(1)
+      yield (lines[0].strip(),
+        datetime.strptime(lines[1].strip(), '%Y-%m-%d %H:%M:%S.%f'),
+        datetime.strptime(lines[2].strip(), '%Y-%m-%d %H:%M:%S.%f'),
+        lines[3].strip())
+
+def read_jsonl_bookmarks(input_path):
+  # One JSON object per line: {"url": ..., "title": ..., "date_added": ...,
+  # "last_modified": ...} with ISO 8601 dates (only url is required)
+  with _open_input(input_path) as fp:
+    for line in fp:
+      line = line.strip()
+      if line == '':
+        continue
+      bookmark = json.loads(line)
+      add_date = bookmark.get('date_added')
+      add_date = _utc_now() if add_date is None else _utc_datetime(datetime.fromisoformat(add_date))
+      last_modified = bookmark.get('last_modified')
+      last_modified = add_date if last_modified is None else _utc_datetime(datetime.fromisoformat(last_modified))
+      yield (bookmark.get('title') or '', add_date, last_modified, bookmark['url'])
+
+def read_firefox_bookmarks(input_path):
+  # Firefox places.sqlite, opened read-only as immutable so that it can be
+  # read while Firefox has it open
+  import urllib.request
+  uri = 'file:%s?mode=ro&immutable=1' % (urllib.request.pathname2url(input_path),)
+  places_sqlconn = sqlite3.connect(uri, uri=True)
+  try:
+    places_sqlcur = places_sqlconn.cursor()
+    places_sqlcur.execute('''SELECT COALESCE(moz_bookmarks.title, moz_places.title, ''),
+moz_bookmarks.dateAdded,
+moz_bookmarks.lastModified,
+moz_places.url
+FROM moz_bookmarks JOIN moz_places ON moz_places.id = moz_bookmarks.fk
+WHERE moz_bookmarks.type = 1 AND moz_places.url NOT LIKE 'place:%'
+ORDER BY moz_bookmarks.id''')
+    for title, date_added, last_modified, url in places_sqlcur:
+      # Firefox timestamps are microseconds since the Unix epoch
+      add_date = _utc_timestamp((date_added or 0) / 1000000)
+      last_modified = add_date if last_modified is None else _utc_timestamp(last_modified / 1000000)
+      yield (title, add_date, last_modified, url)
+  finally:
+    places_sqlconn.close()
+
+def _chrome_datetime(value):
+  if value is None or value == '' or int(value) == 0:
+    return None
+  return CHROME_EPOCH + timedelta(microseconds=int(value))
+
+def _chrome_nodes(node):
+  if node.get('type') == 'url':
+    yield node
+  for child in node.get('children', []):
+    yield from _chrome_nodes(child)
+
+def read_chrome_bookmarks(input_path):
+  # Chrome Bookmarks JSON file (read as a whole; it is small even for many
+  # bookmarks)
+  with open(input_path, 'r', encoding='utf-8') as fp:
+    bookmarks = json.load(fp)
+  for root in bookmarks.get('roots', {}).values():
+    if not isinstance(root, dict):
+      continue
+    for node in _chrome_nodes(root):
+      add_date = _chrome_datetime(node.get('date_added')) or _utc_now()
+      last_modified = _chrome_datetime(node.get('date_modified')) or add_date
+      yield (node.get('name', ''), add_date, last_modified, node['url'])
+
+def _safari_nodes(node):
+  if node.get('WebBookmarkType') == 'WebBookmarkTypeLeaf':
+    yield node
+  for child in node.get('Children', []):
+    yield from _safari_nodes(child)
+
+def read_safari_bookmarks(input_path):
+  # Safari Bookmarks.plist (binary or XML property list)
+  with open(input_path, 'rb') as fp:
+    bookmarks = plistlib.load(fp)
+  for node in _safari_nodes(bookmarks):
+    # Only Reading List items have dates
+    reading_list = node.get('ReadingList', {})
+    add_date = reading_list.get('DateAdded') or _utc_now()
+    last_modified = reading_list.get('DateLastViewed') or add_date
+    yield (node.get('URIDictionary', {}).get('title', ''), _utc_datetime(add_date), _utc_datetime(last_modified), node['URLString'])
+
+bookmark_readers = {
+  "text": read_text_bookmarks,
+  "jsonl": read_jsonl_bookmarks,
+  "firefox": read_firefox_bookmarks,
+  "chrome": read_chrome_bookmarks,
+  "safari": read_safari_bookmarks
+}
+
+def needs_title(note_title, note_url):
+  # Bookmarks without a title of their own are named after their page
+  return note_title == note_url or note_url.endswith(note_title)
+
+def lookup_titles(sqlconn, bookmarks, options):
+  # Returns the titles of the pages of the bookmarks that need one, from the
+  # url_titles table or fetched from the web
+  sqlcur = sqlconn.cursor()
+  titles = {}
+  fetch_urls = []
+  for note_title, add_date, last_modified, note_url in bookmarks:
+    if not needs_title(note_title, note_url):
+      continue
+    if note_url in titles:
+      continue
+    # Don't download data files to get a title
+    if common.url_path_extension(note_url) in DATA_FILE_EXTENSIONS:
+      continue
+    row = notesdb.get_url_title(sqlcur, note_url)
+    if row is not None and (row[0] is not None or not options.refetch_titles):
+      # cached title
+      titles[note_url] = row[0]
+    else:
+      titles[note_url] = None
+      fetch_urls.append(note_url)
+
+  if len(fetch_urls) > 0:
+    print("fetching %d titles..." % (len(fetch_urls),))
+    count = 0
+    for note_url, note_title, fetched in fetch_titles(fetch_urls, options.fetch_threads, options.host_connections, options.timeout, options.max_title_bytes):
+      titles[note_url] = note_title
+      # A page that could not be read is not cached, so that it is fetched
+      # again the next time
+      if fetched:
+        notesdb.set_url_title(sqlconn, note_url, note_title)
+      count += 1
+      if count % 100 == 0:
+        sqlconn.commit()
+        print("fetched %d of %d titles" % (count, len(fetch_urls)))
+    sqlconn.commit()
+  return titles
+
+def process_url_note(writer, columns):
   # note_title
   if columns["note_title"] is None:
     note_title = constants.NOTES_UNTITLED
@@ -115,10 +445,8 @@ def process_url_note(sqlconn, columns):
   # note_data_format
   note_data_format = columns['note_data_format']
 
-	# note_hash (hash the markdown text)
-  h = hashlib.sha512()
-  h.update(note_data.encode('utf-8'))
-  note_hash = h.hexdigest()
+  # note_hash (fingerprint of the markdown text)
+  note_hash = common.note_fingerprint(note_data)
 
   # apple_id
   apple_id = None
@@ -187,8 +515,7 @@ def process_url_note(sqlconn, columns):
   columns["apple_user"] = apple_user
   columns["apple_source"] = apple_source
 
-  notesdb.add_apple_note(sqlconn, columns)
-  sqlconn.commit()
+  writer.add(notesdb.add_apple_note, columns)
 
 def main(args):
   parser = _get_option_parser()
@@ -207,7 +534,10 @@ def main(args):
 
   if hasattr(options, 'input_path') and options.input_path:
     inputPath = os.path.abspath(os.path.expanduser(options.input_path))
-    if os.path.isfile(inputPath) == False:
+    if options.input_path == '-':
+      # Read text or JSONL bookmarks from stdin
+      inputPath = '-'
+    elif os.path.isfile(inputPath) == False:
       # Check if input file exists
       common.error("input path '%s' does not exist." % (inputPath,))
   else:
@@ -227,84 +557,34 @@ def main(args):
   if hasattr(options, 'note_folder') and options.note_folder:
     note_folder = options.note_folder
 
-  notesdbfile = os.path.join(outputPath, 'notesdb.sqlite')
-
-  new_database = (not os.path.isfile(notesdbfile))
 
-  sqlconn = sqlite3.connect(notesdbfile,
-    detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn, db_settings = notesdb.open_database(outputPath, email_address, __version__, __db_schema_min_version__, __db_schema_version__,
+    create=True, migrate=options.migrate, preset=options.db_preset)
   sqlcur = sqlconn.cursor()
 
-  if (new_database):
-    notesdb.create_database(sqlconn=sqlconn, db_schema_version=__db_schema_version__, email_address=options.email_address)
-
-  db_settings = notesdb.get_db_settings(sqlcur, __db_schema_version__)
-  notesdb.check_db_settings(db_settings, '%prog', __version__, __db_schema_min_version__, __db_schema_version__)
-
-  data_file_extensions = [
-    ".png",
-    ".jpeg",
-    ".jpg",
-    ".bmp",
-    ".txt",
-    ".pdf",
-    ".zip",
-    ".csv",
-    ".xls",
-    ".gzip",
-    ".gz",
-    ".7z",
-    ".xlsx",
-  ]
-
-  with open(inputPath, 'r') as fp:
-    lines = fp.readlines()
-
-    if (len(lines) % 4) != 0:
-      # File consists of a title line followed by date created, date modified and a URL line
-      # for each bookmark
-      print("Error: Uneven number of lines in file.\n")
-      sys.exit(1)
-
-    titles = {}
-    index = 0
-    while index < len(lines):
-      note_title = lines[index].strip()
-      add_date = datetime.strptime(lines[index+1].strip(), '%Y-%m-%d %H:%M:%S.%f')
-      last_modified = datetime.strptime(lines[index+2].strip(), '%Y-%m-%d %H:%M:%S.%f')
-      note_url = lines[index+3].strip()
+  notesdb.create_url_titles_table(sqlconn)
+  writer = notesdb.BatchWriter(sqlconn, options.batch_size, options.on_duplicate)
 
+  bookmarks = bookmark_readers[options.input_format](inputPath)
+  while True:
+    batch = []
+    for note_title, add_date, last_modified, note_url in itertools.islice(bookmarks, options.batch_size):
       # Check for missing URL scheme
       urlTuple = urllib.parse.urlparse(note_url)
       if urlTuple.scheme == '':
         note_url = urllib.parse.urlunparse(urllib.parse.ParseResult(scheme="http", netloc=urlTuple.netloc, path=urlTuple.path, params=urlTuple.params, query=urlTuple.query, fragment=urlTuple.fragment))
-
-      # Get title for URL if possible
-      if note_title == note_url or note_url.endswith(note_title):
-        note_title = note_url
-        try:
-          if note_url in titles:
-            # cached title
-            note_title = titles[note_url]
-          # Don't download data files to get a title
-          elif common.url_path_extension(note_url) in data_file_extensions:
-            # Avoid HTTP request for non-HTML files
-            pass
-          else:
-            # request title
-            with urllib.request.urlopen(note_url) as response:
-              http_message = response.info()
-              if http_message['Content-type'].split(';')[0] == 'text/html':
-                html_text = response.read()
-                soup = BeautifulSoup(html_text, features="html.parser")
-                note_title = soup.title.string
-                if note_title is None:
-                  note_title = note_url
-                else:
-                  # cache title
-                  titles[note_url] = note_title
-        except:
-          pass
+      batch.append((note_title, add_date, last_modified, note_url))
+    if len(batch) == 0:
+      break
+
+    # Get titles for URLs if possible
+    titles = lookup_titles(sqlconn, batch, options)
+
+    for note_title, add_date, last_modified, note_url in batch:
+      if needs_title(note_title, note_url):
+        note_title = titles.get(note_url)
+        if note_title is None:
+          note_title = note_url
       if note_title == '':
         note_title = 'New Note'
 
@@ -313,7 +593,6 @@ def main(args):
       # Markdown text for note
       note_data = '[' + common.escape_html(note_title) + '](' + common.escape_url(note_url) + ')'
 
-
       columns = {}
       columns["note_type"] = "note"
       columns["note_uuid"] = None
@@ -328,9 +607,9 @@ def main(args):
       columns["apple_folder"] = note_folder
       columns["apple_created"] = add_date.strftime("%Y-%m-%d %H:%M:%S.%f")
       columns["apple_last_modified"] = last_modified.strftime("%Y-%m-%d %H:%M:%S.%f")
-      process_url_note(sqlconn, columns)
+      process_url_note(writer, columns)
 
-      index += 4
+  writer.close()
 
 if __name__ == "__main__":
   main(sys.argv[1:])